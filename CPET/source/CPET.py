@@ -2,8 +2,16 @@ from CPET.source.calculator import calculator
 from CPET.source.cluster import cluster
 import CPET.utils.visualize as visualize
 from CPET.source.pca import pca_pycpet
-from CPET.utils.io import save_numpy_as_dat
+from CPET.utils.io import (
+    save_numpy_as_dat,
+    save_volume,
+    Trajectory,
+    DCDTrajectory,
+    is_archive,
+    archive_members,
+)
 from CPET.utils.calculator import report_inside_box
+from CPET.utils.parallel import TopoPool, run_frames, format_layout
 from glob import glob
 from random import choice
 import os
@@ -35,10 +43,31 @@ class CPET:
             self.pca_pycpet = pca_pycpet(options)
 
         self.profile = self.options["profile"]
+        # structures parsed, computed or written at once and the memory they may hold in GB
+        self.frames_in_flight = self.options["frames_in_flight"] if "frames_in_flight" in self.options.keys() else 2
+        self.memory_budget = (
+            self.options["memory_budget"] * 1e9 if "memory_budget" in self.options.keys() else None
+        )
+        self.concurrency = self.options["concurrency"] if "concurrency" in self.options.keys() else "processes"
+        # input files are multi-MODEL trajectories, streamed frame by frame
+        self.trajectory = self.options["trajectory"] if "trajectory" in self.options.keys() else False
+        # pqr or pdb with the charges of dcd trajectories, by default the file of the same name
+        self.topology = self.options["topology"] if "topology" in self.options.keys() else None
+        # volume fields saved as text, read by Chimera, or as memory-mappable binary volume files
+        self.field_format = self.options["field_format"] if "field_format" in self.options.keys() else "text"
+        if self.field_format not in ("text", "binary"):
+            raise ValueError("field_format must be text or binary")
+        # worker pool shared by the calculators of every structure, started on first use
+        self.pool = TopoPool(
+            self.options["concur_slip"] if "concur_slip" in self.options.keys() else 4,
+            self.options["omp_threads"] if "omp_threads" in self.options.keys() else None,
+            self.options["pin_workers"] if "pin_workers" in self.options.keys() else True,
+        )
+        print(format_layout(self.pool.layout, self.concurrency))
 
 
     def run(self):
-        if self.m == "topo":
+        if self.m == "topo" or self.m == "topo_c_batch" or self.m == "topo_converge" or self.m == "topo_numba" or self.m == "topo_batch":
             self.run_topo()
         elif self.m == "topo_GPU":
             self.run_topo_GPU()
@@ -65,185 +94,334 @@ class CPET:
             )
             exit()
 
+    def input_files(self):
+        # gzip compressed structures and tar archives of them are read without extracting
+        files_input = []
+        for pattern in ("*.pdb", "*.pdb.gz", "*.pqr.gz", "*.tar", "*.tar.gz", "*.tgz", "*.tar.bz2", "*.tar.xz"):
+            files_input += glob(self.inputpath + "/" + pattern)
+        if self.trajectory:
+            files_input += glob(self.inputpath + "/*.pqr") + glob(self.inputpath + "/*.dcd")
+            # the topology of a dcd trajectory is not a trajectory of its own
+            topologies = {
+                os.path.abspath(self.dcd_topology(file)) for file in files_input if file.endswith(".dcd")
+            }
+            files_input = [file for file in files_input if os.path.abspath(file) not in topologies]
+        return files_input
+
+    def dcd_topology(self, file):
+        """
+        The pqr or pdb file holding the charges of a dcd trajectory
+        """
+        if self.topology is not None:
+            return self.topology
+        stem = file[: -len(".dcd")]
+        for suffix in (".pqr", ".pdb"):
+            if os.path.exists(stem + suffix):
+                return stem + suffix
+        raise ValueError("No topology for {}, set the topology option".format(file))
+
+    def protein_name(self, file):
+        # frames of a trajectory are (name, trajectory, coordinates), members of an
+        # archive (name, member, contents)
+        if isinstance(file, tuple):
+            return file[0]
+        return file.split("/")[-1].split(".")[0]
+
+    def members(self, file, keep=None):
+        """
+        Yields an input file, or the members of a tar archive in archive order as
+        (name, member, contents), streamed from the archive
+        Takes
+            file(str) - input file
+            keep(callable) - called with the name of every member, members it returns
+                False for are skipped without being read
+        """
+        if not is_archive(file):
+            yield file
+            return
+        for member, data in archive_members(
+            file, keep=None if keep is None else lambda member: keep(self.protein_name(member))
+        ):
+            yield self.protein_name(member), member, data
+
+    def structures(self, files_input):
+        """
+        Yields the input files and archive members, or with the trajectory option the
+        frames of every one of them in file order as (name, trajectory, coordinates),
+        named after the file and the frame number. Input files are multi-MODEL pdb or
+        pqr files, compressed or in archives, or dcd files read with the charges of
+        dcd_topology
+        """
+        if not self.trajectory:
+            for file in files_input:
+                yield from self.members(file)
+            return
+        for file in sorted(files_input):
+            for member in self.members(file):
+                if isinstance(member, tuple):
+                    trajectory = Trajectory(member[1], data=member[2])
+                elif member.endswith(".dcd"):
+                    trajectory = DCDTrajectory(member, self.dcd_topology(member))
+                else:
+                    trajectory = Trajectory(member)
+                with trajectory:
+                    for frame, x in trajectory.frames():
+                        yield "{}_{}".format(self.protein_name(member), frame), trajectory, x
+
+    def load(self, file):
+        """
+        Calculator of an input file, an archive member or a trajectory frame
+        """
+        if isinstance(file, tuple) and isinstance(file[1], Trajectory):
+            topo = calculator(self.options, pool=self.pool, frame=file[1:])
+        elif isinstance(file, tuple):
+            topo = calculator(self.options, path_to_pdb=file[1], pool=self.pool, data=file[2])
+        else:
+            topo = calculator(self.options, path_to_pdb=file, pool=self.pool)
+        self.calculator = topo
+        return topo
+
+    def frames_to_process(self, files_input, num, suffix):
+        """
+        Yields up to num input files in random order, skipping the ones whose output
+        file with the given suffix is in the output directory when they come up.
+        Members of an archive follow each other in archive order, the ones already
+        done are passed over without being read. Trajectory frames are streamed in
+        file order instead
+        """
+        if self.trajectory:
+            for i, frame in enumerate(self.structures(files_input)):
+                if i == num:
+                    return
+                protein = self.protein_name(frame)
+                print("protein file: {}".format(protein))
+                if not os.path.exists(self.outputpath + "/" + protein + suffix):
+                    yield frame
+            print("No more files to process!")
+            return
+        files_input = list(files_input)
+        count = 0
+
+        def keep(protein):
+            nonlocal count
+            if count == num:
+                return False
+            count += 1
+            print("protein file: {}".format(protein))
+            return not os.path.exists(self.outputpath + "/" + protein + suffix)
+
+        while count < num:
+            if len(files_input) == 0:
+                print("No more files to process!")
+                return
+            file = choice(files_input)
+            files_input.remove(file)
+            if is_archive(file):
+                yield from self.members(file, keep=keep)
+            elif keep(self.protein_name(file)):
+                yield file
+
+    def volume_meta_data(self, topo, mesh_shape):
+        """
+        Header of the volume field files of a calculator
+        """
+        return {
+            "dimensions": self.dimesions, 
+            "step_size": [self.step_size, self.step_size, self.step_size],
+            "num_steps": [mesh_shape[0], mesh_shape[1], mesh_shape[2]],
+            "transformation_matrix": topo.transformation_matrix,
+            "center": topo.center,
+        }
+
+    def run_frames(self, files, compute, write, compute_slots=1):
+        """
+        Runs structures through run_frames with up to frames_in_flight of them
+        parsed, computed or written at once
+        Takes
+            files(iterable) - input files to process
+            compute(callable) - results of a calculator, called as compute(file, calculator)
+            write(callable) - writes the results, called as write(file, calculator, results)
+            compute_slots(int) - most structures computing at once
+        """
+
+        run_frames(
+            files,
+            self.load,
+            compute,
+            write,
+            frames_in_flight=self.frames_in_flight,
+            compute_slots=compute_slots,
+            memory_budget=self.memory_budget,
+            size_fn=lambda topo: topo.nbytes(),
+        )
+
     def run_topo(self, num=100000, benchmarking=False):
-        files_input = glob(self.inputpath + "/*.pdb")
+        files_input = self.input_files()
         if len(files_input) == 0:
             raise ValueError("No pdb files found in the input directory")
-        if len(files_input) == 1:
+        if len(files_input) == 1 and not self.trajectory:
             warnings.warn("Only one pdb file found in the input directory")
-        for i in range(num):
-            if len(files_input) != 0:
-                file = choice(files_input)
-            else:
-                print("No more files to process!")
-                break
-            self.calculator = calculator(self.options, path_to_pdb=file)
-            protein = self.calculator.path_to_pdb.split("/")[-1].split(".")[0]
-            files_input.remove(file)
-            print("protein file: {}".format(protein))
-            files_done = [
-                x for x in os.listdir(self.outputpath) if x.split(".")[-1] == "top"
-            ]
-            if protein + ".top" not in files_done:
-                hist = self.calculator.compute_topo_complete_c_shared()
-                if not benchmarking:
-                    np.savetxt(self.outputpath + "/{}.top".format(protein), hist)
-                if benchmarking:
-                    np.savetxt(
-                        self.outputpath
-                        + "/{}_{}_{}_{}.top".format(
-                            protein,
-                            self.calculator.n_samples,
-                            str(self.calculator.step_size)[2:],
-                            self.replica,
-                        ),
-                        hist,
-                    )
+
+        def compute(file, topo):
+            if self.m == "topo_converge":
+                return topo.compute_topo_converged()
+            elif topo.field_method != "exact" or topo.lattice is not None:
+                return topo.compute_topo_vectorized()
+            elif self.m == "topo_c_batch":
+                return topo.compute_topo_complete_c_batch()
+            elif self.m == "topo_numba":
+                return topo.compute_topo_numba()
+            elif self.m == "topo_batch":
+                return topo.compute_topo_batched()
+            return topo.compute_topo_complete_c_shared()
+
+        def write(file, topo, hist):
+            protein = self.protein_name(file)
+            if not benchmarking:
+                np.savetxt(self.outputpath + "/{}.top".format(protein), hist)
+            if benchmarking:
+                np.savetxt(
+                    self.outputpath
+                    + "/{}_{}_{}_{}.top".format(
+                        protein,
+                        topo.n_samples,
+                        str(topo.step_size)[2:],
+                        self.replica,
+                    ),
+                    hist,
+                )
+
+        # the streamline pool takes chunks of several structures at once, the
+        # other engines already use every core on one structure
+        pooled = (
+            self.m == "topo_batch" or (self.m == "topo" and self.concurrency == "processes")
+        ) and ("field_method" not in self.options.keys() or self.options["field_method"] == "exact")
+        if pooled:
+            self.pool.start()
+        self.run_frames(
+            self.frames_to_process(files_input, num, ".top"),
+            compute,
+            write,
+            compute_slots=self.frames_in_flight if pooled else 1,
+        )
+        self.pool.close()
 
     def run_topo_GPU(self, num=100000, benchmarking=False):
-        files_input = glob(self.inputpath + "/*.pdb")
+        files_input = self.input_files()
         if len(files_input) == 0:
             raise ValueError("No pdb files found in the input directory")
-        if len(files_input) == 1:
+        if len(files_input) == 1 and not self.trajectory:
             warnings.warn("Only one pdb file found in the input directory")
-        for i in range(num):
-            if len(files_input) != 0:
-                file = choice(files_input)
-            else:
-                break
-            self.calculator = calculator(self.options, path_to_pdb=file)
-            protein = self.calculator.path_to_pdb.split("/")[-1].split(".")[0]
-            files_input.remove(file)
-            print("protein file: {}".format(protein))
-            files_done = [
-                x for x in os.listdir(self.outputpath) if x.split(".")[-1] == "top"
-            ]
-            if protein + ".top" not in files_done:
-                hist = (
-                    self.calculator.compute_topo_GPU_batch_filter()
+        for file in self.frames_to_process(files_input, num, ".top"):
+            self.load(file)
+            protein = self.protein_name(file)
+            hist = self.calculator.compute_topo_GPU_batch_filter()
+            if not benchmarking:
+                np.savetxt(self.outputpath + "/{}.top".format(protein), hist)
+            if benchmarking:
+                np.savetxt(
+                    self.outputpath
+                    + "/{}_{}_{}_{}.top".format(
+                        protein,
+                        self.calculator.n_samples,
+                        str(self.calculator.step_size)[2:],
+                        self.replica,
+                    ),
+                    hist,
                 )
-                if not benchmarking:
-                    np.savetxt(self.outputpath + "/{}.top".format(protein), hist)
-                if benchmarking:
-                    np.savetxt(
-                        self.outputpath
-                        + "/{}_{}_{}_{}.top".format(
-                            protein,
-                            self.calculator.n_samples,
-                            str(self.calculator.step_size)[2:],
-                            self.replica,
-                        ),
-                        hist,
-                    )
 
     def run_volume(self, num=100000):
         """
         Get the electric fields along a grid of points in the box
         """
 
-        files_input = glob(self.inputpath + "/*.pdb")
+        files_input = self.input_files()
         if len(files_input) == 0:
             raise ValueError("No pdb files found in the input directory")
         
-        if len(files_input) == 1:
+        if len(files_input) == 1 and not self.trajectory:
             warnings.warn("Only one pdb file found in the input directory")
-        
-        for i in range(num):
-            if len(files_input) != 0:
-                file = choice(files_input)
+
+        def compute(file, topo):
+            return topo.compute_box()
+
+        def write(file, topo, results):
+            field_box, mesh_shape = results
+            print(field_box.shape)
+            meta_data = self.volume_meta_data(topo, mesh_shape)
+            name = self.outputpath + "/{}_efield.dat".format(self.protein_name(file))
+            if self.field_format == "binary":
+                save_volume(meta_data, field_box, name)
             else:
-                print("No more files to process!")
-                break
-            self.calculator = calculator(self.options, path_to_pdb=file)
-            protein = self.calculator.path_to_pdb.split("/")[-1].split(".")[0]
-            files_input.remove(file)
-            print("protein file: {}".format(protein))
-            files_done = [
-                x for x in os.listdir(self.outputpath) if x[-11:] == "_efield.dat"
-            ]
-            
-            if protein + "_efield.dat" not in files_done:
-                field_box, mesh_shape = self.calculator.compute_box()
-                print(field_box.shape)
-                meta_data = {
-                    "dimensions": self.dimesions, 
-                    "step_size": [self.step_size, self.step_size, self.step_size],
-                    "num_steps": [mesh_shape[0], mesh_shape[1], mesh_shape[2]],
-                    "transformation_matrix": self.calculator.transformation_matrix,
-                    "center": self.calculator.center,
-                }
-                
                 save_numpy_as_dat(
-                    name=self.outputpath + "/{}_efield.dat".format(protein),
+                    name=name,
                     field=field_box,
                     meta_data=meta_data
                 )
 
+        self.run_frames(self.frames_to_process(files_input, num, "_efield.dat"), compute, write)
+
 
     def run_point_field(self):
-        files_input = glob(self.inputpath + "/*.pdb")
+        files_input = self.input_files()
         if len(files_input) == 0:
             raise ValueError("No pdb files found in the input directory")
-        if len(files_input) == 1:
+        if len(files_input) == 1 and not self.trajectory:
             warnings.warn("Only one pdb file found in the input directory")
         outfile = self.outputpath + "/point_field.dat"
         with open(outfile, "w") as f:
-            for file in files_input:
-                self.calculator = calculator(self.options, path_to_pdb=file)
-                protein = file.split("/")[-1].split(".")[0]
+            for file in self.structures(files_input):
+                self.load(file)
+                protein = self.protein_name(file)
                 print("protein file: {}".format(protein))
                 point_field = self.calculator.compute_point_field()
                 f.write("{}:{}\n".format(protein, point_field))
 
     def run_point_mag(self):
-        files_input = glob(self.inputpath + "/*.pdb")
+        files_input = self.input_files()
         if len(files_input) == 0:
             raise ValueError("No pdb files found in the input directory")
-        if len(files_input) == 1:
+        if len(files_input) == 1 and not self.trajectory:
             warnings.warn("Only one pdb file found in the input directory")
         outfile = self.outputpath + "/point_mag.dat"
         with open(outfile, "w") as f:
-            for file in files_input:
-                self.calculator = calculator(self.options, path_to_pdb=file)
-                protein = file.split("/")[-1].split(".")[0]
+            for file in self.structures(files_input):
+                self.load(file)
+                protein = self.protein_name(file)
                 print("protein file: {}".format(protein))
                 point_field = self.calculator.compute_point_mag()
                 f.write("{}:{}\n".format(protein, point_field))
 
     def run_volume_ESP(self, num=100000):
-        files_input = glob(self.inputpath + "/*.pdb")
+        files_input = self.input_files()
         if len(files_input) == 0:
             raise ValueError("No pdb files found in the input directory")
-        if len(files_input) == 1:
+        if len(files_input) == 1 and not self.trajectory:
             warnings.warn("Only one pdb file found in the input directory")
-        for i in range(num):
-            if len(files_input) != 0:
-                file = choice(files_input)
+
+        def compute(file, topo):
+            return topo.compute_box_ESP()
+
+        def write(file, topo, field_box):
+            name = self.outputpath + "/{}_esp.dat".format(self.protein_name(file))
+            if self.field_format == "binary":
+                save_volume(self.volume_meta_data(topo, topo.mesh.shape), field_box, name)
             else:
-                print("No more files to process!")
-                break
-            self.calculator = calculator(self.options, path_to_pdb=file)
-            protein = self.calculator.path_to_pdb.split("/")[-1].split(".")[0]
-            files_input.remove(file)
-            print("protein file: {}".format(protein))
-            files_done = [
-                x for x in os.listdir(self.outputpath) if x[-11:] == "_efield.dat"
-            ]
-            if protein + ".top" not in files_done:
-                field_box = self.calculator.compute_box_ESP()
                 np.savetxt(
-                    self.outputpath + "/{}_esp.dat".format(protein),
+                    name,
                     field_box,
                     fmt="%.3f",
                 )
 
+        self.run_frames(self.frames_to_process(files_input, num, "_esp.dat"), compute, write)
+
     def run_box_check(self, num=100000):
-        files_input = glob(self.inputpath + "/*.pdb")
+        files_input = self.input_files()
         if len(files_input) == 0:
             raise ValueError("No pdb files found in the input directory")
-        if len(files_input) == 1:
+        if len(files_input) == 1 and not self.trajectory:
             warnings.warn("Only one pdb file found in the input directory")
-        for file in files_input:
+        for file in self.structures(files_input):
             if "filter_radius" in self.options or "filter_resids" in self.options or "filter_resnum" in self.options:
                 #Error out, radius not compatible
                 raise ValueError(
@@ -251,8 +429,8 @@ class CPET:
                     )
             #Need to not filter in box to check, but can filter all else
             self.options["filter_in_box"] = False
-            self.calculator = calculator(self.options, path_to_pdb=file)
-            protein = self.calculator.path_to_pdb.split("/")[-1].split(".")[0]
+            self.load(file)
+            protein = self.protein_name(file)
             print("protein file: {}".format(protein))
             report_inside_box(self.calculator)
         print("No more files to process!")
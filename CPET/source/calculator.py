@@ -4,25 +4,50 @@
 
 import numpy as np
 import time
-from multiprocessing import Pool
+from functools import partial
 from torch.profiler import profile, ProfilerActivity
 import torch
 
 
-from CPET.utils.io import parse_pdb
-from CPET.utils.parallel import task, task_batch, task_base, task_complete_thread
+from CPET.utils.parallel import (
+    task_batch_shared,
+    task_base,
+    task_shared,
+    task_base_shared,
+    task_complete_thread,
+    task_complete_thread_shared,
+    streamline_chunk,
+    TopoPool,
+    run_chunks_threaded,
+    map_points_threaded,
+    parallel_layout,
+)
 from CPET.utils.calculator import (
     initialize_box_points_random,
     initialize_box_points_uniform,
     compute_field_on_grid,
     calculate_electric_field_dev_c_shared,
     compute_ESP_on_grid,
+    calculate_thread_batch_c_shared,
+    calculate_thread_batch_numba,
+    calculate_electric_field_points,
+    calculate_esp_points,
+    calculate_electric_field_native_points,
+    calculate_field_gradient_points,
+    compute_topo_field_batch,
+    compare_fields,
+    distance_numpy,
+    topology_histogram,
+    topology_histogram_bins,
 )
+from CPET.utils.octree import Octree
+from CPET.utils.multipole import build_far_field
+from CPET.utils.lattice import FieldLattice
 from CPET.utils.io import (
-    parse_pdb,
-    parse_pqr,
+    parse_structure,
     filter_radius,
     filter_radius_whole_residue,
+    residue_groups,
     filter_residue,
     filter_in_box,
     calculate_center,
@@ -31,40 +56,84 @@ from CPET.utils.io import (
     default_options_initializer
 )
 from CPET.utils.gpu import (
-    propagate_topo_matrix_gpu,
+    propagate_topo_matrix_steps_gpu,
     compute_curv_and_dist_mat_gpu,
+    compute_curv_and_dist_central_gpu,
     batched_filter_gpu,
-    generate_path_filter_gpu,
+    calculate_field_gradient_torch_batch_gpu,
+    analytic_curvature_gpu,
 )
 
 
 class calculator:
-    def __init__(self, options, path_to_pdb=None):
+    def __init__(self, options, path_to_pdb=None, pool=None, frame=None, data=None):
         # self.efield_calc = calculator(math_loc=math_loc)
         self.options = default_options_initializer(options)
         
         self.profile = options["profile"]
         self.path_to_pdb = path_to_pdb
+        # TopoPool shared with other structures of a run, None makes a pool per computation
+        self.pool = pool
         self.step_size = options["step_size"]
         self.n_samples = options["n_samples"]
         self.dimensions = np.array(options["dimensions"])
         self.concur_slip = options["concur_slip"]
+        # processes, or threads driving the native kernels on the arrays of this process
+        self.concurrency = options["concurrency"] if "concurrency" in options.keys() else "processes"
+        if self.concurrency not in ("processes", "threads"):
+            raise ValueError("concurrency must be processes or threads")
+        # workers, OpenMP threads per worker and pinning, capped at the cores of this process
+        self.omp_threads = options["omp_threads"] if "omp_threads" in options.keys() else None
+        self.pin_workers = options["pin_workers"] if "pin_workers" in options.keys() else True
+        if self.pool is not None:
+            self.layout = self.pool.layout
+        else:
+            self.layout = parallel_layout(self.concur_slip, self.omp_threads, self.pin_workers)
+        # cost balanced chunks packed per pool worker by the streamline scheduler
+        self.chunks_per_worker = options["chunks_per_worker"] if "chunks_per_worker" in options.keys() else 8
         self.GPU_batch_freq = options["GPU_batch_freq"]
+        # the first two rows of every GPU batch repeat the last two of the previous one
+        if self.GPU_batch_freq < 3:
+            raise ValueError("GPU_batch_freq must be at least 3")
         self.dtype = options["dtype"]
         self.max_streamline_init = options["max_streamline_init"] if "max_streamline_init" in options.keys() else "true_rand"
+        self.field_method = options["field_method"]
+        # steps of rk4 and rk45 out of the box end on the wall with every engine, and their
+        # curvature comes from a central stencil of rk4 steps around both ends
+        self.integrator = options["integrator"]
+        self.integrator_tol = options["integrator_tol"]
+        if self.integrator not in ("euler", "rk4", "rk45"):
+            raise ValueError("integrator must be euler, rk4 or rk45")
+        self.analytic_curvature = options["analytic_curvature"]
+        # torch device of the path matrix engine (topo_GPU), cuda falls back to the cpu
+        self.device = options["device"] if "device" in options.keys() else "cuda"
+        if self.device == "cuda" and not torch.cuda.is_available():
+            print("CUDA is not available, using CPU instead")
+            self.device = "cpu"
+        # intra-op threads of torch on the cpu, None keeps the torch default
+        self.torch_threads = options["torch_threads"] if "torch_threads" in options.keys() else None
+        # rounds of the convergence-driven topology mode
+        self.convergence_tol = options["convergence_tol"] if "convergence_tol" in options.keys() else 1e-3
+        self.convergence_round_size = options["convergence_round_size"] if "convergence_round_size" in options.keys() else 10000
+        self.convergence_max_samples = options["convergence_max_samples"] if "convergence_max_samples" in options.keys() else 100000
 
         #Be very careful with the box_shift option. The box needs to be centered at the origin and therefore, the code will shift protein in the opposite direction of the provided box vector 
         self.box_shift = options["box_shift"] if "box_shift" in options.keys() else [0,0,0]
         
-        if ".pqr" in self.path_to_pdb:
-            (
-                self.x,
-                self.Q,
-                self.atom_number,
-                self.resids,
-                self.residue_number,
-                self.atom_type
-            ) = parse_pqr(self.path_to_pdb)
+        # parsed arrays kept in a sidecar .cpet.npz next to the structure, for runs over the same ensemble
+        self.parse_cache = options["parse_cache"] if "parse_cache" in options.keys() else False
+        # frame of a Trajectory, (trajectory, coordinates), in place of a structure file.
+        # Masks and selections of the atom information are computed once per trajectory.
+        # data holds the contents of the structure file, like a member of an archive, parsed in place of reading path_to_pdb
+        self.trajectory = None
+        if frame is not None:
+            self.trajectory, self.x = frame
+            self.path_to_pdb = self.trajectory.path
+            self.Q = self.trajectory.Q
+            self.atom_number = self.trajectory.atom_number
+            self.resids = self.trajectory.residue_name
+            self.residue_number = self.trajectory.residue_number
+            self.atom_type = self.trajectory.atom_type
         else:
             (
                 self.x,
@@ -73,7 +142,7 @@ class calculator:
                 self.resids,
                 self.residue_number,
                 self.atom_type,
-            ) = parse_pdb(self.path_to_pdb, get_charges=True)
+            ) = parse_structure(self.path_to_pdb, cache=self.parse_cache, data=data)
 
         ##################### define center axis
 
@@ -82,16 +151,7 @@ class calculator:
 
         elif type(options["center"]) == dict:
             method = options["center"]["method"]
-            centering_atoms = [
-                (element, options["center"]["atoms"][element])
-                for element in options["center"]["atoms"]
-            ]
-            pos_considered = [
-                pos
-                for atom_res in centering_atoms
-                for idx, pos in enumerate(self.x)
-                if (self.atom_type[idx], self.residue_number[idx]) == atom_res
-            ]
+            pos_considered = self.x[self.select_atoms(options["center"]["atoms"])]
             self.center = calculate_center(pos_considered, method=method)
         else:
             raise ValueError("center must be a list or dict")
@@ -103,16 +163,7 @@ class calculator:
 
         elif type(options["x"]) == dict:
             method = options["x"]["method"]
-            centering_atoms = [
-                (element, options["x"]["atoms"][element])
-                for element in options["x"]["atoms"]
-            ]
-            pos_considered = [
-                pos
-                for atom_res in centering_atoms
-                for idx, pos in enumerate(self.x)
-                if (self.atom_type[idx], self.residue_number[idx]) == atom_res
-            ]
+            pos_considered = self.x[self.select_atoms(options["x"]["atoms"])]
             self.x_vec_pt = calculate_center(pos_considered, method=method)
 
         else:
@@ -125,52 +176,29 @@ class calculator:
 
         elif type(options["y"]) == dict:
             method = options["y"]["method"]
-            centering_atoms = [
-                (element, options["y"]["atoms"][element])
-                for element in options["y"]["atoms"]
-            ]
-            pos_considered = [
-                pos
-                for atom_res in centering_atoms
-                for idx, pos in enumerate(self.x)
-                if (self.atom_type[idx], self.residue_number[idx]) == atom_res
-            ]
+            pos_considered = self.x[self.select_atoms(options["y"]["atoms"])]
             self.y_vec_pt = calculate_center(pos_considered, method=method)
 
         else:
             raise ValueError("y must be a list or dict")
 
         
-        if "filter_resids" in options.keys():
-            # print("filtering residues: {}".format(options["filter_resids"]))
-            self.x, self.Q, self.residue_number, self.resids = filter_residue(
-                self.x, 
-                self.Q,
-                self.residue_number, 
-                self.resids, 
-                filter_list=options["filter_resids"]
+        if self.trajectory is not None:
+            key = (
+                "filter_topology",
+                repr([options.get(name) for name in ("filter_resids", "filter_resnum", "filter_resnum_andname")]),
             )
-
-        if "filter_resnum" in options.keys():
-            # print("filtering residues: {}".format(options["filter_resids"]))
-            self.x, self.Q, self.residue_number, self.resids = filter_resnum(
-                self.x,
-                self.Q,
-                self.residue_number,
-                self.resids,
-                filter_list=options["filter_resnum"],
+            keep, self.Q, self.residue_number, self.resids, self.atom_number, self.atom_type = self.trajectory.cached(
+                key, lambda: self.filter_topology(np.arange(len(self.Q)), options)
             )
-
-        if "filter_resnum_andname" in options.keys():
-            # print("filtering residues: {}".format(options["filter_resids"]))
-            self.x, self.Q, self.residue_number, self.resids, self.atom_number, self.atom_type = filter_resnum_andname(
-                self.x,
-                self.Q,
-                self.residue_number,
-                self.resids,
-                self.atom_number,
-                self.atom_type,
-                filter_list=options["filter_resnum_andname"],
+            self.x = self.x[keep]
+            groups = self.trajectory.cached(
+                ("residue_groups",) + key[1:], lambda: residue_groups(self.resids, self.residue_number)
+            )
+        else:
+            groups = None
+            self.x, self.Q, self.residue_number, self.resids, self.atom_number, self.atom_type = self.filter_topology(
+                self.x, options
             )
 
         if "filter_radius" in options.keys():
@@ -187,6 +215,7 @@ class calculator:
                 resnums=self.residue_number,
                 center=self.center,
                 radius=float(options["filter_radius"]),
+                groups=groups,
             )
 
             # print("center {}".format(self.center))
@@ -285,25 +314,233 @@ class calculator:
             self.center = self.center.astype(np.float32)
             self.dimensions = self.dimensions.astype(np.float32)
 
+        if self.field_method == "octree":
+            theta = options["octree_theta"] if "octree_theta" in options.keys() else 0.3
+            leaf_size = options["octree_leaf_size"] if "octree_leaf_size" in options.keys() else 16
+            start_time = time.time()
+            self.octree = Octree(self.x, self.Q, theta=theta, leaf_size=leaf_size)
+            print(f"Built octree with {len(self.octree.radii)} nodes in {time.time() - start_time:.2f} seconds")
+            self.field_error_report()
+        elif self.field_method == "multipole":
+            tol = options["multipole_tol"] if "multipole_tol" in options.keys() else 1e-3
+            order = options["multipole_order"] if "multipole_order" in options.keys() else 6
+            # the expansion has to cover the steps streamlines take past the box walls
+            half_widths = np.asarray(self.dimensions, dtype=np.float64) + 3 * self.step_size
+            start_time = time.time()
+            near_mask, self.far_field, report = build_far_field(
+                self.x, self.Q, half_widths, tol=tol, order=order
+            )
+            self.x_near = np.ascontiguousarray(self.x[near_mask])
+            self.Q_near = np.ascontiguousarray(self.Q[near_mask])
+            print(f"Built far-field expansion in {time.time() - start_time:.2f} seconds: {report}")
+            self.field_error_report()
+        elif self.field_method != "exact":
+            raise ValueError("field_method must be exact, octree or multipole")
+
+        # opt-in cached lattice over the chosen field backend for streamline propagation
+        self.lattice = None
+        if "field_lattice" in options.keys() and options["field_lattice"]:
+            lattice_options = (
+                options["field_lattice"] if isinstance(options["field_lattice"], dict) else {}
+            )
+            self.lattice = FieldLattice(
+                self.field_batch,
+                np.asarray(self.dimensions, dtype=np.float64) + 3 * self.step_size,
+                spacing=lattice_options["spacing"] if "spacing" in lattice_options.keys() else 0.1,
+                tol=lattice_options["tol"] if "tol" in lattice_options.keys() else 1e-3,
+                max_level=lattice_options["max_level"] if "max_level" in lattice_options.keys() else 3,
+            )
+
         print("... > Initialized Calculator!")
 
+    def select_atoms(self, atoms):
+        """
+        Indices of the atoms matching each (atom name, residue number) pair, in the
+        order of the pairs, as used to place the box center and axes
+        Takes
+            atoms(dict) - atom name to residue number
+        Returns
+            indices(array) - indices into the parsed structure
+        """
+
+        def select():
+            return np.concatenate(
+                [
+                    np.flatnonzero(
+                        (np.asarray(self.atom_type) == name)
+                        & (np.asarray(self.residue_number) == resnum)
+                    )
+                    for name, resnum in atoms.items()
+                ]
+                + [np.zeros(0, dtype=int)]
+            )
+
+        if self.trajectory is not None:
+            return self.trajectory.cached(("select_atoms", repr(atoms)), select)
+        return select()
+
+    def filter_topology(self, x, options):
+        """
+        Applies the filters of the options that only depend on the atom information,
+        filter_resids, filter_resnum and filter_resnum_andname
+        Takes
+            x(array) - coordinates of charges of shape (N,3), or atom indices
+            options(dict) - options of the calculator
+        Returns
+            x, Q, residue_number, resids, atom_number, atom_type (arrays) - kept atoms
+        """
+        Q = self.Q
+        residue_number = self.residue_number
+        resids = self.resids
+        atom_number = self.atom_number
+        atom_type = self.atom_type
+
+        if "filter_resids" in options.keys():
+            # print("filtering residues: {}".format(options["filter_resids"]))
+            x, Q, residue_number, resids = filter_residue(
+                x, 
+                Q,
+                residue_number, 
+                resids, 
+                filter_list=options["filter_resids"]
+            )
+
+        if "filter_resnum" in options.keys():
+            # print("filtering residues: {}".format(options["filter_resids"]))
+            x, Q, residue_number, resids = filter_resnum(
+                x,
+                Q,
+                residue_number,
+                resids,
+                filter_list=options["filter_resnum"],
+            )
+
+        if "filter_resnum_andname" in options.keys():
+            # print("filtering residues: {}".format(options["filter_resids"]))
+            x, Q, residue_number, resids, atom_number, atom_type = filter_resnum_andname(
+                x,
+                Q,
+                residue_number,
+                resids,
+                atom_number,
+                atom_type,
+                filter_list=options["filter_resnum_andname"],
+            )
+
+        return x, Q, residue_number, resids, atom_number, atom_type
+
+    def field_batch(self, points):
+        """
+        Computes the electric field at a set of points in the box frame with the
+        backend chosen by the field_method option
+        Takes
+            points(array) - positions to compute field at of shape (L,3)
+        Returns
+            E(array) - electric field at the points of shape (L,3)
+        """
+        if self.field_method == "octree":
+            return self.octree.field(points)
+        if self.field_method == "multipole":
+            E = calculate_electric_field_points(points, self.x_near, self.Q_near)
+            if self.far_field is not None:
+                E += self.far_field.field(points)
+            return E
+        return calculate_electric_field_points(points, self.x, self.Q)
+
+    def field_gradient(self, points):
+        """
+        Computes the electric field and its gradient at a set of points in the box
+        frame with the exact sum, used for analytic curvature
+        Takes
+            points(array) - positions to compute field at of shape (L,3)
+        Returns
+            E(array) - electric field at the points of shape (L,3)
+            J(array) - field gradient at the points of shape (L,3,3)
+        """
+        return calculate_field_gradient_points(points, self.x, self.Q)
+
+    def esp_batch(self, points):
+        """
+        Computes the electrostatic potential at a set of points in the box frame with
+        the backend chosen by the field_method option
+        Takes
+            points(array) - positions to compute potential at of shape (L,3)
+        Returns
+            ESP(array) - electrostatic potential at the points of shape (L,1)
+        """
+        if self.field_method == "octree":
+            return self.octree.esp(points)
+        if self.field_method == "multipole":
+            ESP = calculate_esp_points(points, self.x_near, self.Q_near)
+            if self.far_field is not None:
+                ESP += self.far_field.esp(points)
+            return ESP
+        return calculate_esp_points(points, self.x, self.Q)
+
+    def field_error_report(self, n_points=32):
+        """
+        Prints the error of the approximate field backend against the exact sum at the
+        box center, the box corners and a subset of the starting points
+        """
+        corners = np.array(
+            [[i, j, k] for i in (-1, 1) for j in (-1, 1) for k in (-1, 1)]
+        ) * np.asarray(self.dimensions, dtype=np.float64)
+        points = [np.zeros((1, 3)), corners]
+        if hasattr(self, "random_start_points"):
+            points.append(np.asarray(self.random_start_points).reshape(-1, 3)[:n_points])
+        elif hasattr(self, "mesh"):
+            points.append(np.asarray(self.mesh).reshape(-1, 3)[::max(1, self.mesh.size // (3 * n_points))])
+        points = np.concatenate(points)
+        report = {"field_method": self.field_method}
+        report.update(
+            compare_fields(
+                self.field_batch(points),
+                calculate_electric_field_points(points, self.x, self.Q),
+            )
+        )
+        print("Field error report against exact sum: {}".format(report))
+        return report
+
+    def nbytes(self):
+        """
+        Bytes held by the arrays of the calculator
+        """
+        return sum(value.nbytes for value in vars(self).values() if isinstance(value, np.ndarray))
+
+    def map_streamlines(self, chunk_fn):
+        """
+        Runs the streamlines of the structure on the worker pool in cost balanced chunks
+        Takes
+            chunk_fn(callable) - picklable task of a chunk on the charges set up by
+                init_topo_worker, called as chunk_fn(x_0, n_iter)
+        Returns
+            results(list) - result of every streamline in input order
+        """
+        args = (
+            chunk_fn,
+            self.x,
+            self.Q,
+            self.random_start_points,
+            self.random_max_samples,
+            self.step_size,
+            self.dimensions,
+            self.integrator,
+            self.integrator_tol,
+            self.analytic_curvature,
+            self.chunks_per_worker,
+        )
+        if self.pool is not None:
+            return self.pool.map_streamlines(*args)
+        with TopoPool(self.concur_slip, self.omp_threads, self.pin_workers) as pool:
+            return pool.map_streamlines(*args)
+
     def compute_topo_base(self):
         print("... > Computing Topo!")
         print(f"Number of samples: {self.n_samples}")
         print(f"Number of charges: {len(self.Q)}")
         print(f"Step size: {self.step_size}")
         start_time = time.time()
-        # print("starting pooling")
-        with Pool(self.concur_slip) as pool:
-            args = [
-                (i, n_iter, self.x, self.Q, self.step_size, self.dimensions)
-                for i, n_iter in zip(self.random_start_points, self.random_max_samples)
-            ]
-            result = pool.starmap(task_base, args)
-            # print(raw)
-            hist = []
-            for result in result.get():
-                hist.append(result)
+        hist = self.map_streamlines(partial(streamline_chunk, task_base_shared))
         end_time = time.time()
         self.hist = hist
 
@@ -318,22 +555,15 @@ class calculator:
         print(f"Number of charges: {len(self.Q)}")
         print(f"Step size: {self.step_size}")
         start_time = time.time()
-        # print("starting pooling")
-        with Pool(self.concur_slip) as pool:
-            args = [
-                (i, n_iter, self.x, self.Q, self.step_size, self.dimensions)
-                for i, n_iter in zip(self.random_start_points, self.random_max_samples)
-            ]
-            # raw = pool.starmap(task, args)
-
-            result = pool.starmap_async(task, args)
-            dist = []
-            curve = []
-            for result in result.get():
-                dist.append(result[0])
-                curve.append(result[1])
-
-            hist = np.column_stack((dist, curve))
+        # cost balanced chunks, longest first, so long streamlines do not end up last
+        result = self.map_streamlines(partial(streamline_chunk, task_shared))
+        dist = []
+        curve = []
+        for r in result:
+            dist.append(r[0])
+            curve.append(r[1])
+
+        hist = np.column_stack((dist, curve))
         end_time = time.time()
         self.hist = hist
 
@@ -352,7 +582,7 @@ class calculator:
         endtype_list = []
         for i, n_iter in zip(self.random_start_points, self.random_max_samples):
             
-            dist, curve, init_points, final_points, endtype = task_base(i, n_iter, self.x, self.Q, self.step_size, self.dimensions)
+            dist, curve, init_points, final_points, endtype = task_base(i, n_iter, self.x, self.Q, self.step_size, self.dimensions, self.integrator, self.integrator_tol, self.analytic_curvature)
             dist_list.append(dist)
             curve_list.append(curve)
             init_points_list.append(init_points)
@@ -399,25 +629,91 @@ class calculator:
         print(f"Step size: {self.step_size}")
         print(f"Start point shape: {self.random_start_points.shape}")
         start_time = time.time()
-        # print("starting pooling")
         #print("random start points")
         #print(self.random_max_samples)
-        with Pool(self.concur_slip) as pool:
-            args = [
-                (i, n_iter, self.x, self.Q, self.step_size, self.dimensions)
-                for i, n_iter in zip(self.random_start_points, self.random_max_samples)
-            ]
-            # raw = pool.starmap(task, args)
-
-            result = pool.starmap_async(task_complete_thread, args)
-            dist = []
-            curve = []
-            for result in result.get():
-                dist.append(result[0])
-                curve.append(result[1])
-
-            hist = np.column_stack((dist, curve))
+        # cost balanced chunks, longest first, so long streamlines do not end up last
+        if self.concurrency == "threads":
+            result = run_chunks_threaded(
+                partial(
+                    streamline_chunk,
+                    partial(
+                        task_complete_thread,
+                        x=self.x,
+                        Q=self.Q,
+                        step_size=self.step_size,
+                        dimensions=self.dimensions,
+                        integrator=self.integrator,
+                        tol=self.integrator_tol,
+                        analytic_curvature=self.analytic_curvature,
+                    ),
+                ),
+                self.random_start_points,
+                self.random_max_samples,
+                self.layout["workers"],
+                self.chunks_per_worker,
+                self.layout,
+            )
+        else:
+            result = self.map_streamlines(partial(streamline_chunk, task_complete_thread_shared))
+        dist = []
+        curve = []
+        for r in result:
+            dist.append(r[0])
+            curve.append(r[1])
+
+        hist = np.column_stack((dist, curve))
+
+        end_time = time.time()
+        self.hist = hist
+
+        print(
+            f"Time taken for {self.n_samples} calculations with N_charges = {len(self.Q)}: {end_time - start_time:.2f} seconds"
+        )
+        return hist
+
+    def compute_topo_complete_c_batch(self):
+        print("... > Computing Topo in a single native call!")
+        print(f"Number of samples: {self.n_samples}")
+        print(f"Number of charges: {len(self.Q)}")
+        print(f"Step size: {self.step_size}")
+        print(f"Start point shape: {self.random_start_points.shape}")
+        start_time = time.time()
+        hist = calculate_thread_batch_c_shared(
+            x_0=self.random_start_points,
+            n_iter=self.random_max_samples,
+            x=self.x,
+            Q=self.Q,
+            step_size=self.step_size,
+            dimensions=self.dimensions,
+            integrator=self.integrator,
+            tol=self.integrator_tol,
+            analytic_curvature=self.analytic_curvature,
+        )
+        end_time = time.time()
+        self.hist = hist
 
+        print(
+            f"Time taken for {self.n_samples} calculations with N_charges = {len(self.Q)}: {end_time - start_time:.2f} seconds"
+        )
+        return hist
+
+    def compute_topo_numba(self):
+        print("... > Computing Topo with the numba engine!")
+        print(f"Number of samples: {self.n_samples}")
+        print(f"Number of charges: {len(self.Q)}")
+        print(f"Step size: {self.step_size}")
+        start_time = time.time()
+        hist = calculate_thread_batch_numba(
+            x_0=self.random_start_points,
+            n_iter=self.random_max_samples,
+            x=self.x,
+            Q=self.Q,
+            step_size=self.step_size,
+            dimensions=self.dimensions,
+            integrator=self.integrator,
+            tol=self.integrator_tol,
+            analytic_curvature=self.analytic_curvature,
+        )
         end_time = time.time()
         self.hist = hist
 
@@ -426,34 +722,131 @@ class calculator:
         )
         return hist
 
+    def compute_topo_vectorized(self):
+        print("... > Computing Topo with all streamlines advanced together!")
+        print(f"Field method: {self.field_method}")
+        print(f"Field lattice: {self.lattice is not None}")
+        print(f"Number of samples: {self.n_samples}")
+        print(f"Number of charges: {len(self.Q)}")
+        print(f"Step size: {self.step_size}")
+        start_time = time.time()
+        hist = compute_topo_field_batch(
+            x_0=self.random_start_points,
+            n_iter=self.random_max_samples,
+            field_fn=self.lattice.field if self.lattice is not None else self.field_batch,
+            step_size=self.step_size,
+            dimensions=self.dimensions,
+            integrator=self.integrator,
+            tol=self.integrator_tol,
+            field_gradient_fn=self.field_gradient if self.analytic_curvature else None,
+        )
+        end_time = time.time()
+        self.hist = hist
+        if self.lattice is not None:
+            print(
+                f"Field lattice used {self.lattice.n_field_evaluations} field evaluations"
+            )
+
+        print(
+            f"Time taken for {self.n_samples} calculations with N_charges = {len(self.Q)}: {end_time - start_time:.2f} seconds"
+        )
+        return hist
+
+    def compute_topo_round(self, x_0, n_iter):
+        """
+        Topology of one set of streamlines with the batched engine matching the
+        field options, the vectorized one for approximate fields and the native
+        kernel for the exact sum
+        Takes
+            x_0(array) - starting points of the streamlines of shape (L,3)
+            n_iter(array) - maximum number of steps of each streamline of shape (L,)
+        Returns
+            hist(array) - distance and mean curvature of each streamline of shape (L,2)
+        """
+        if self.field_method != "exact" or self.lattice is not None:
+            return compute_topo_field_batch(
+                x_0=x_0,
+                n_iter=n_iter,
+                field_fn=self.lattice.field if self.lattice is not None else self.field_batch,
+                step_size=self.step_size,
+                dimensions=self.dimensions,
+                integrator=self.integrator,
+                tol=self.integrator_tol,
+                field_gradient_fn=self.field_gradient if self.analytic_curvature else None,
+            )
+        return calculate_thread_batch_c_shared(
+            x_0=x_0,
+            n_iter=n_iter,
+            x=self.x,
+            Q=self.Q,
+            step_size=self.step_size,
+            dimensions=self.dimensions,
+            integrator=self.integrator,
+            tol=self.integrator_tol,
+            analytic_curvature=self.analytic_curvature,
+        )
+
+    def compute_topo_converged(self):
+        """
+        Computes streamlines in rounds of convergence_round_size random samples until
+        the chi-square distance (distance_numpy) between the histograms of all samples
+        before and after a round drops below convergence_tol, or
+        convergence_max_samples is reached. The bins are fixed by the first round
+        """
+        print("... > Computing Topo until the histogram converges!")
+        print(f"Round size: {self.convergence_round_size}")
+        print(f"Tolerance: {self.convergence_tol}")
+        print(f"Number of charges: {len(self.Q)}")
+        print(f"Step size: {self.step_size}")
+        start_time = time.time()
+        rounds = []
+        self.convergence = []
+        hist_prev = None
+        n_done = 0
+        while n_done < self.convergence_max_samples:
+            n_round = min(self.convergence_round_size, self.convergence_max_samples - n_done)
+            x_0, n_iter, _, _ = initialize_box_points_random(
+                self.center,
+                self.x_vec_pt,
+                self.y_vec_pt,
+                self.dimensions,
+                n_round,
+                dtype=self.dtype,
+                max_steps=self.max_steps,
+            )
+            rounds.append(self.compute_topo_round(x_0, n_iter))
+            n_done += n_round
+            if hist_prev is None:
+                bins, hist_range = topology_histogram_bins(rounds[0])
+                hist_prev = topology_histogram(rounds[0], bins, hist_range)
+                continue
+            hist_new = topology_histogram(np.concatenate(rounds), bins, hist_range)
+            distance = distance_numpy(hist_new, hist_prev)
+            self.convergence.append((n_done, distance))
+            print(f"Samples: {n_done}, distance to previous round: {distance:.3e}")
+            hist_prev = hist_new
+            if distance < self.convergence_tol:
+                break
+        hist = np.concatenate(rounds)
+        end_time = time.time()
+        self.hist = hist
+        self.n_samples = len(hist)
+
+        print(
+            f"Time taken for {self.n_samples} calculations with N_charges = {len(self.Q)}: {end_time - start_time:.2f} seconds"
+        )
+        return hist
+
     def compute_topo_batched(self):
         print("... > Computing Topo in Batches!")
         print(f"Number of samples: {self.n_samples}")
         print(f"Number of charges: {len(self.Q)}")
         print(f"Step size: {self.step_size}")
         start_time = time.time()
-        print("num batches: {}".format(len(self.random_start_points_batched)))
-        # print(self.random_start_points_batched)
-        # print(self.random_max_samples_batched)
-        with Pool(self.concur_slip) as pool:
-            args = [
-                (i, n_iter, self.x, self.Q, self.step_size, self.dimensions)
-                for i, n_iter in zip(
-                    self.random_start_points_batched, self.random_max_samples_batched
-                )
-            ]
-            raw = pool.starmap(task_batch, args)
-            raw_flat = [item for sublist in raw for item in sublist]
-            dist = []
-            curve = []
-            for result in raw_flat:
-                dist.append(result[0])
-                curve.append(result[1])
-            hist = np.column_stack((dist, curve)) 
-            
-
+        # every cost balanced chunk is advanced as one active set
+        hist = np.array(self.map_streamlines(task_batch_shared), dtype=np.float64).reshape(-1, 2)
         end_time = time.time()
-        # self.hist = hist
+        self.hist = hist
 
         print(
             f"Time taken for {self.n_samples} calculations with N_charges = {len(self.Q)}: {end_time - start_time:.2f} seconds"
@@ -467,7 +860,20 @@ class calculator:
         print("x shape: {}".format(self.x.shape))
         print("Q shape: {}".format(self.Q.shape))
         print("First few lines of x: {}".format(self.x[:5]))
-        field_box = compute_field_on_grid(self.mesh, self.x, self.Q)
+        if self.field_method != "exact":
+            points = self.mesh.reshape(-1, 3)
+            field_box = np.concatenate((points, self.field_batch(points)), axis=1).astype(np.half)
+        elif self.concurrency == "threads":
+            points = self.mesh.reshape(-1, 3)
+            E = map_points_threaded(
+                lambda chunk: calculate_electric_field_native_points(chunk, self.x, self.Q),
+                points,
+                self.layout["workers"],
+                layout=self.layout,
+            )
+            field_box = np.concatenate((points, E), axis=1).astype(np.half)
+        else:
+            field_box = compute_field_on_grid(self.mesh, self.x, self.Q)
         return field_box, self.mesh.shape
 
     def compute_box_ESP(self):
@@ -478,7 +884,20 @@ class calculator:
         print("Q shape: {}".format(self.Q.shape))
         print("Transformation matrix: {}".format(self.transformation_matrix))
         print("Center: {}".format(self.center))
-        field_box = compute_ESP_on_grid(self.mesh, self.x, self.Q)
+        if self.field_method != "exact":
+            points = self.mesh.reshape(-1, 3)
+            field_box = np.concatenate((points, self.esp_batch(points)), axis=1).astype(np.half)
+        elif self.concurrency == "threads":
+            points = self.mesh.reshape(-1, 3)
+            ESP = map_points_threaded(
+                lambda chunk: calculate_esp_points(chunk, self.x, self.Q),
+                points,
+                self.layout["workers"],
+                layout=self.layout,
+            )
+            field_box = np.concatenate((points, ESP), axis=1).astype(np.half)
+        else:
+            field_box = compute_ESP_on_grid(self.mesh, self.x, self.Q)
         return field_box
 
     def compute_point_mag(self):
@@ -489,9 +908,12 @@ class calculator:
         print("Q shape: {}".format(self.Q.shape))
         start_time = time.time()
         #Since x and Q are already rotated and translated, need to supply 0 vector as center
-        point_mag = np.norm(
-            calculate_electric_field_dev_c_shared(np.array([0,0,0]), self.x, self.Q)
-        )
+        if self.field_method != "exact":
+            point_mag = np.linalg.norm(self.field_batch(np.zeros((1, 3)))[0])
+        else:
+            point_mag = np.linalg.norm(
+                calculate_electric_field_dev_c_shared(np.array([0,0,0]), self.x, self.Q)
+            )
         end_time = time.time()
         print(f"{end_time - start_time:.2f}")
         return point_mag
@@ -505,7 +927,10 @@ class calculator:
         print("First few lines of x: {}".format(self.x[:5]))
         start_time = time.time()
         #Since x and Q are already rotated and translated, need to supply 0 vector as center
-        point_field = calculate_electric_field_dev_c_shared(np.array([0,0,0]), self.x, self.Q)
+        if self.field_method != "exact":
+            point_field = self.field_batch(np.zeros((1, 3)))[0]
+        else:
+            point_field = calculate_electric_field_dev_c_shared(np.array([0,0,0]), self.x, self.Q)
         end_time = time.time()
         print(f"{end_time - start_time}")
         return point_field
@@ -515,123 +940,71 @@ class calculator:
         print(f"Number of samples: {self.n_samples}")
         print(f"Number of charges: {len(self.Q)}")
         print(f"Step size: {self.step_size}")
+        print(f"Device: {self.device}")
+        if self.integrator == "rk45":
+            raise ValueError("GPU streamlines support the euler and rk4 integrators")
+        if self.torch_threads is not None:
+            torch.set_num_threads(self.torch_threads)
 
-        Q_gpu = torch.tensor(self.Q, dtype=torch.float32).cuda()
+        Q_gpu = torch.tensor(self.Q, dtype=torch.float32).to(self.device)
         Q_gpu = Q_gpu.unsqueeze(0)
-        x_gpu = torch.tensor(self.x, dtype=torch.float32).cuda()
-        dim_gpu = torch.tensor(self.dimensions, dtype=torch.float32).cuda()
-        step_size_gpu = torch.tensor([self.step_size], dtype=torch.float32).cuda()
-        random_max_samples = torch.tensor(self.random_max_samples).cuda()
-
-        M = self.max_steps
-        max_num_batch = int(
-            (M + 2 - self.GPU_batch_freq)/(self.GPU_batch_freq - 2)
-        ) + 1
-        remainder = (M + 2 - self.GPU_batch_freq) % (self.GPU_batch_freq - 2) #Number of remaining propagations
-        path_matrix_torch = torch.tensor(np.zeros((self.GPU_batch_freq, self.n_samples, 3)), dtype=torch.float32).cuda()
-        path_matrix_torch[0] = torch.tensor(self.random_start_points)
-        path_matrix_torch = propagate_topo_matrix_gpu(
-            path_matrix_torch,
-            torch.tensor([0]).cuda(),
-            x_gpu,
-            Q_gpu,
-            step_size_gpu,
-        )
-        #Using random_max_samples-1 to convert from max samples to indices
-        path_filter = generate_path_filter_gpu(
-        random_max_samples, torch.tensor([M + 2], dtype=torch.int64).cuda()
-        )
-
-        #Need to augment random_max_samples for smaller streamlines than the batching frequency
-        if M+2 < self.GPU_batch_freq:
-            path_filter_temp = torch.ones((self.GPU_batch_freq, self.n_samples,1), dtype=torch.bool).cuda()
-            path_filter_temp[0:M+2] = path_filter
-            path_filter = path_filter_temp
+        x_gpu = torch.tensor(self.x, dtype=torch.float32).to(self.device)
+        dim_gpu = torch.tensor(self.dimensions, dtype=torch.float32).to(self.device)
 
-        path_filter = torch.tensor(path_filter, dtype=torch.bool).cuda()
-        print(path_matrix_torch.shape)
-        print(path_filter.shape)
-        print(M+2)
+        n_iter = torch.tensor(self.random_max_samples, dtype=torch.int64).to(self.device)
+        # streamlines still being propagated, by their position in the input
+        ids = torch.arange(self.n_samples).to(self.device)
+        # first three and last three points of every streamline, in input order
+        dumped_values = torch.zeros((6, self.n_samples, 3), dtype=torch.float32).to(self.device)
+        done = torch.zeros(self.n_samples, dtype=torch.bool).to(self.device)
 
-        dumped_values = torch.tensor(
-            np.empty((6, 0, 3)), dtype=torch.float32
-        ).cuda()
+        path_matrix_torch = torch.zeros((self.GPU_batch_freq, self.n_samples, 3), dtype=torch.float32).to(self.device)
+        path_matrix_torch[0] = torch.tensor(self.random_start_points)
 
-        j = 0
         start_time = time.time()
-        for i in range(max_num_batch):
-            
-            for j in range(self.GPU_batch_freq - 2):
-                path_matrix_torch = propagate_topo_matrix_gpu(
-                    path_matrix_torch,
-                    torch.tensor([j + 1]).cuda(),
-                    x_gpu,
-                    Q_gpu,
-                    step_size_gpu,
-                )
-                if i == 0 and j == 0:
-                    init_points = path_matrix_torch[0:3, ...]
-            
-            #print("filtering!")
+        # every batch takes GPU_batch_freq - 2 steps, its first two rows are the last two of the previous one
+        step_offset = 0
+        i = 0
+        # row at which each streamline left the box, found from the start points by the first batch
+        exits = None
+        while not bool(done.all()):
+            # the first batch starts from the start points alone, later ones from two carried rows
+            first_row = 0 if i == 0 else 1
+            path_matrix_torch, exits = propagate_topo_matrix_steps_gpu(
+                path_matrix_torch,
+                first_row,
+                self.GPU_batch_freq - 1 - first_row,
+                x_gpu,
+                Q_gpu,
+                float(self.step_size),
+                dim_gpu,
+                n_iter - step_offset,
+                self.integrator,
+                exits=exits,
+            )
+            if i == 0:
+                init_points = path_matrix_torch[0:3].clone()
+
             (
                 path_matrix_torch,
-                dumped_values,
-                path_filter,
+                ids,
+                n_iter,
                 init_points,
+                exits,
             ) = batched_filter_gpu(
                 path_matrix=path_matrix_torch,
                 dumped_values=dumped_values,
-                i=i,
-                dimensions=dim_gpu,
-                path_filter=path_filter,
+                done=done,
+                ids=ids,
+                n_iter=n_iter,
                 init_points=init_points,
-                GPU_batch_freq=self.GPU_batch_freq,
-                dtype_str=self.dtype,
-            )
-            print(dumped_values.shape[1])
-            if dumped_values.shape[1] >= self.n_samples:
-                print("Finished streamlines early, breaking!")
-                break
-        print(f"Checking dumped values ({dumped_values.shape[1]}) vs number of samples ({self.n_samples})")
-        if (
-            dumped_values.shape[1] < self.n_samples
-        ):  # Still some samples remaining in the remainder
-            print("Streamlines remaining")
-            print(remainder)
-            print(path_matrix_torch.shape)
-            path_matrix_torch_new = torch.zeros(
-                (remainder + 2, path_matrix_torch.shape[1], 3),
-                dtype=torch.float32,
-            ).cuda()
-            path_matrix_torch_new[0:2, ...] = path_matrix_torch[-2:, ...]
-            del path_matrix_torch
-            # For remainder
-            for i in range(remainder - 1):
-                path_matrix_torch_new = propagate_topo_matrix_gpu(
-                    path_matrix_torch_new,
-                    torch.tensor([i + 2]).cuda(),
-                    x_gpu,
-                    Q_gpu,
-                    step_size_gpu,
-                )
-            (
-                path_matrix_torch_new,
-                dumped_values,
-                path_filter,
-                init_points,
-            ) = batched_filter_gpu(
-                path_matrix=path_matrix_torch_new,
-                dumped_values=dumped_values,
-                i=i,
+                step_offset=step_offset,
                 dimensions=dim_gpu,
-                path_filter=path_filter,
-                init_points=init_points,
-                GPU_batch_freq=remainder,
-                dtype_str=self.dtype,
+                exits=exits,
             )
-            # print(path_matrix_torch_new, dumped_values, path_filter)
-        else:
-            del path_matrix_torch
+            step_offset += self.GPU_batch_freq - 2
+            i += 1
+        del path_matrix_torch
 
         print(dumped_values.shape)
         np.savetxt(
@@ -652,14 +1025,29 @@ class calculator:
             .reshape(dumped_values.shape[1], -1),
             fmt="%.6f",
         )
-        distances, curvatures = compute_curv_and_dist_mat_gpu(
-            dumped_values[0, :, :],
-            dumped_values[1, :, :],
-            dumped_values[2, :, :],
-            dumped_values[3, :, :],
-            dumped_values[4, :, :],
-            dumped_values[5, :, :],
-        )
+        if self.integrator == "rk4" and not self.analytic_curvature:
+            # central stencil with rk4 steps around both ends, as the cpu engines
+            distances, curvatures = compute_curv_and_dist_central_gpu(
+                dumped_values[0], dumped_values[3], x_gpu, Q_gpu, float(self.step_size)
+            )
+        else:
+            distances, curvatures = compute_curv_and_dist_mat_gpu(
+                dumped_values[0, :, :],
+                dumped_values[1, :, :],
+                dumped_values[2, :, :],
+                dumped_values[3, :, :],
+                dumped_values[4, :, :],
+                dumped_values[5, :, :],
+            )
+        if self.analytic_curvature:
+            # curvature at both ends from the field gradient instead of the stencil
+            n_dumped = dumped_values.shape[1]
+            curvatures = analytic_curvature_gpu(
+                *calculate_field_gradient_torch_batch_gpu(
+                    torch.cat((dumped_values[0], dumped_values[3]), dim=0), x_gpu, Q_gpu
+                )
+            )
+            curvatures = (curvatures[:n_dumped] + curvatures[n_dumped:]) / 2
         end_time = time.time()
         print(
             f"Time taken for {self.n_samples} calculations with N~{self.Q.shape}: {end_time - start_time:.2f} seconds"
@@ -3,6 +3,9 @@ from subprocess import Popen, PIPE
 import ctypes
 import numpy.ctypeslib as npct
 
+# integrator codes understood by the streamline kernels in math_module.c
+INTEGRATORS = {"euler": 0, "rk4": 1, "rk45": 2}
+
 
 class Math_ops:
     def __init__(self, shared_loc=None):
@@ -92,6 +95,25 @@ class Math_ops:
             self.array_2d_float,
             self.array_1d_float,
             self.array_1d_float,
+            ctypes.c_int,
+            ctypes.c_float,
+            ctypes.c_int,
+        ]
+
+        self.math.thread_operation_batch.restype = ctypes.c_int
+        self.math.thread_operation_batch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_float,
+            self.array_2d_float,
+            self.array_1d_int,
+            self.array_1d_float,
+            self.array_2d_float,
+            self.array_1d_float,
+            self.array_2d_float,
+            ctypes.c_int,
+            ctypes.c_float,
+            ctypes.c_int,
         ]
 
         self.math.calc_field.restype = None
@@ -112,6 +134,47 @@ class Math_ops:
             self.array_1d_float,
         ]
 
+        self.math.calc_field_soa_batch.restype = None
+        self.math.calc_field_soa_batch.argtypes = [
+            ctypes.c_int,
+            self.array_2d_float,
+            self.array_2d_float,
+            ctypes.c_int,
+            self.array_1d_float,
+            self.array_1d_float,
+            self.array_1d_float,
+            self.array_1d_float,
+        ]
+
+        self.math.set_native_threads.restype = None
+        self.math.set_native_threads.argtypes = [ctypes.c_int]
+        self.math.get_native_threads.restype = ctypes.c_int
+        self.math.get_native_threads.argtypes = []
+        self.math.get_native_threads_setting.restype = ctypes.c_int
+        self.math.get_native_threads_setting.argtypes = []
+
+
+    def set_native_threads(self, n_threads):
+        """
+        Sets the OpenMP team size of the field and streamline kernels of this process
+        Takes:
+            n_threads(int) - threads per parallel region, 0 leaves it to OpenMP
+        """
+        self.math.set_native_threads(int(n_threads))
+
+    def get_native_threads(self):
+        """
+        Returns:
+            n_threads(int) - threads per parallel region of the native kernels
+        """
+        return self.math.get_native_threads()
+
+    def get_native_threads_setting(self):
+        """
+        Returns:
+            n_threads(int) - team size as passed to set_native_threads, 0 if left to OpenMP
+        """
+        return self.math.get_native_threads_setting()
 
     def sparse_dot(self, A, B):
         # b is just a single vector, not a sparse matrix
@@ -203,7 +266,9 @@ class Math_ops:
         return res
 
 
-    def thread_operation(self, x_0, n_iter, x, Q, step_size, dimensions):
+    def thread_operation(
+        self, x_0, n_iter, x, Q, step_size, dimensions, integrator="euler", tol=1e-4, analytic_curvature=False
+    ):
         """
         Takes:
             x_0(array) - (3, 1) array of box position
@@ -212,6 +277,9 @@ class Math_ops:
             Q(np array) - charge values
             step_size(float) - step size of each step
             dimensions(array) - box limits
+            integrator(str) - euler, rk4 or rk45
+            tol(float) - local error tolerance of the rk45 integrator
+            analytic_curvature(bool) - curvature from the field gradient instead of extra steps
         Returns:
             res(array) - (2, ) array of curvature and distance
         """
@@ -220,13 +288,52 @@ class Math_ops:
         self.math.thread_operation.restype = None
         Q = Q.reshape(-1)
         self.math.thread_operation(
-            n_charges, n_iter, step_size, x_0, dimensions, x, Q, res
+            n_charges, n_iter, step_size, x_0, dimensions, x, Q, res, INTEGRATORS[integrator], tol, int(analytic_curvature)
         )
         # print(res)
 
         return res
 
 
+    def thread_operation_batch(
+        self, x_0, n_iter, x, Q, step_size, dimensions, integrator="euler", tol=1e-4, analytic_curvature=False
+    ):
+        """
+        Takes:
+            x_0(array) - (n_samples, 3) array of streamline starting points
+            n_iter(array) - (n_samples,) array of maximum iterations per streamline
+            x(np array) - positions of charges
+            Q(np array) - charge values
+            step_size(float) - step size of each step
+            dimensions(array) - box limits
+            integrator(str) - euler, rk4 or rk45
+            tol(float) - local error tolerance of the rk45 integrator
+            analytic_curvature(bool) - curvature from the field gradient instead of extra steps
+        Returns:
+            res(array) - (n_samples, 2) array of distance and curvature
+        """
+        x_0 = np.ascontiguousarray(x_0, dtype=np.float32).reshape(-1, 3)
+        n_iter = np.ascontiguousarray(n_iter, dtype=np.int32).reshape(-1)
+        res = np.zeros((len(x_0), 2), dtype="float32")
+        status = self.math.thread_operation_batch(
+            len(Q),
+            len(x_0),
+            step_size,
+            x_0,
+            n_iter,
+            np.ascontiguousarray(dimensions, dtype=np.float32),
+            np.ascontiguousarray(x, dtype=np.float32),
+            np.ascontiguousarray(Q, dtype=np.float32).reshape(-1),
+            res,
+            INTEGRATORS[integrator],
+            tol,
+            int(analytic_curvature),
+        )
+        if status != 0:
+            raise MemoryError("could not allocate the charges of {} atoms".format(len(Q)))
+        return res
+
+
     def calc_field_base(self, x_0, x, Q):
         """
         Takes:
@@ -274,4 +381,29 @@ class Math_ops:
             Q.reshape(len(Q))
         )
         
-        return res
\ No newline at end of file
+        return res
+
+
+    def calc_field_soa_batch(self, points, x_soa, Q_soa):
+        """
+        Takes:
+            points(array) - (L, 3) array of box positions
+            x_soa(array) - (3, N) array of charge positions, one row per coordinate
+            Q_soa(array) - (N,) array of charge values
+        Returns:
+            res(array) - (L, 3) array of electric field
+        """
+        points = np.ascontiguousarray(points, dtype=np.float32).reshape(-1, 3)
+        x_soa = np.ascontiguousarray(x_soa, dtype=np.float32)
+        res = np.zeros((len(points), 3), dtype="float32")
+        self.math.calc_field_soa_batch(
+            len(points),
+            res,
+            points,
+            len(Q_soa),
+            x_soa[0],
+            x_soa[1],
+            x_soa[2],
+            np.ascontiguousarray(Q_soa, dtype=np.float32).reshape(-1),
+        )
+        return res
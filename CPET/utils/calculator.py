@@ -22,13 +22,104 @@ package = pkg_resources.get_distribution(package_name)
 package_path = package.location
 # import cupy as cp
 
-from CPET.utils.fastmath import nb_subtract, power, nb_norm, nb_cross
-from CPET.utils.c_ops import Math_ops
+from CPET.utils.fastmath import nb_subtract, power, nb_norm, nb_cross, nb_topo_batch
+from CPET.utils.c_ops import Math_ops, INTEGRATORS
+from CPET.utils.io import is_volume, read_volume
+
+# the native kernels are optional, the numba engine (topo_numba) runs without them
+try:
+    Math = Math_ops(shared_loc=package_path + "/CPET/utils/math_module.so")
+except (OSError, AttributeError) as error:
+    warnings.warn(
+        f"Native math_module.so could not be loaded ({error}), only the numba and numpy engines are available"
+    )
+    Math = None
+
+# Cash-Karp embedded 5(4) pair used by the rk45 integrator
+CASH_KARP_A = (
+    (),
+    (1 / 5,),
+    (3 / 40, 9 / 40),
+    (3 / 10, -9 / 10, 6 / 5),
+    (-11 / 54, 5 / 2, -70 / 27, 35 / 27),
+    (1631 / 55296, 175 / 512, 575 / 13824, 44275 / 110592, 253 / 4096),
+)
+CASH_KARP_B5 = (37 / 378, 0.0, 250 / 621, 125 / 594, 0.0, 512 / 1771)
+CASH_KARP_B4 = (2825 / 27648, 0.0, 18575 / 48384, 13525 / 55296, 277 / 14336, 1 / 4)
+
+
+def field_direction(x_0, field_fn):
+    """
+    Unit vector along the field at a point or a set of points of shape (...,3)
+    """
+    E = field_fn(x_0)
+    return E / np.linalg.norm(E, axis=-1, keepdims=True)
 
-Math = Math_ops(shared_loc=package_path + "/CPET/utils/math_module.so")
 
+def rk4_step(x_0, field_fn, step_size):
+    """
+    One classical Runge-Kutta step along the normalized field
+    Takes
+        x_0(array) - position or positions to propagate of shape (...,3)
+        field_fn(callable) - returns the electric field at positions of the shape of x_0
+        step_size(float or array) - size of the step, an array of shape (L,1) sets one per position
+    Returns
+        x_0 - new positions on the streamlines
+    """
+    k_1 = field_direction(x_0, field_fn)
+    k_2 = field_direction(x_0 + 0.5 * step_size * k_1, field_fn)
+    k_3 = field_direction(x_0 + 0.5 * step_size * k_2, field_fn)
+    k_4 = field_direction(x_0 + step_size * k_3, field_fn)
+    return x_0 + step_size / 6 * (k_1 + 2 * k_2 + 2 * k_3 + k_4)
 
-def propagate_topo(x_0, x, Q, step_size, debug=False):
+
+def rk45_step(x_0, field_fn, step_size):
+    """
+    One Cash-Karp step along the normalized field with an embedded error estimate
+    Takes
+        x_0(array) - position or positions to propagate of shape (...,3)
+        field_fn(callable) - returns the electric field at positions of the shape of x_0
+        step_size(float or array) - size of the step, an array of shape (L,1) sets one per position
+    Returns
+        x_0 - fifth order positions on the streamlines
+        err(array) - norm of the difference to the fourth order positions of shape (...)
+    """
+    k = []
+    for a in CASH_KARP_A:
+        stage = x_0 + sum(step_size * a_m * k_m for a_m, k_m in zip(a, k))
+        k.append(field_direction(stage, field_fn))
+    x_5 = x_0 + sum(step_size * b * k_j for b, k_j in zip(CASH_KARP_B5, k))
+    err = sum(step_size * (b_5 - b_4) * k_j for b_5, b_4, k_j in zip(CASH_KARP_B5, CASH_KARP_B4, k))
+    return x_5, np.linalg.norm(err, axis=-1)
+
+
+def adaptive_step_control(err, tol, h_try, step_size, inside):
+    """
+    Decides which adaptive steps are kept and the size of the next ones. Steps
+    leaving the box are only kept once no longer than step_size, so the overshoot
+    past the walls is bounded as for the fixed step integrators
+    Takes
+        err(array) - error estimates of the steps of shape (L,)
+        tol(float) - tolerated local error of a step
+        h_try(array) - sizes of the steps of shape (L,)
+        step_size(float) - fixed step size the arc length is measured in
+        inside(array) - whether each new position is inside the box of shape (L,)
+    Returns
+        accept(array) - whether each step is kept of shape (L,)
+        h_next(array) - size of the next step of shape (L,)
+    """
+    h_min = 1e-3 * step_size
+    with np.errstate(divide="ignore"):
+        factor = np.where(err > 0, 0.9 * (tol / err) ** 0.2, 5.0)
+    factor = np.clip(factor, 0.2, 5.0)
+    h_next = np.maximum(h_try * factor, h_min)
+    accurate = (err <= tol) | (h_try <= h_min)
+    exit_too_long = accurate & ~inside & (h_try > step_size)
+    h_next = np.where(exit_too_long, np.maximum(0.5 * h_try, step_size), h_next)
+    return accurate & ~exit_too_long, h_next
+
+
+def propagate_topo(x_0, x, Q, step_size, debug=False, integrator="euler"):
     """
     Propagates position based on normalized electric field at a given point
     Takes
@@ -36,9 +127,12 @@ def propagate_topo(x_0, x, Q, step_size, debug=False):
         x(array) - positions of charges of shape (N,3)
         Q(array) - magnitude and sign of charges of shape (N,1)
         step_size(float) - size of streamline step to take when propagating, real and positive
+        integrator(str) - euler or rk4
     Returns
         x_0 - new position on streamline after propagation via electric field
     """
+    if integrator == "rk4":
+        return rk4_step(x_0, lambda p: calculate_electric_field_base(p, x, Q), step_size)
     # Compute field
     E = calculate_electric_field_base(x_0, x, Q)
     # if np.linalg.norm(E) > epsilon:
@@ -47,7 +141,7 @@ def propagate_topo(x_0, x, Q, step_size, debug=False):
     return x_0
 
 
-def propagate_topo_dev(x_0, x, Q, step_size, debug=False):
+def propagate_topo_dev(x_0, x, Q, step_size, debug=False, integrator="euler"):
     """
     Propagates position based on normalized electric field at a given point
     Takes
@@ -55,9 +149,14 @@ def propagate_topo_dev(x_0, x, Q, step_size, debug=False):
         x(array) - positions of charges of shape (N,3)
         Q(array) - magnitude and sign of charges of shape (N,1)
         step_size(float) - size of streamline step to take when propagating, real and positive
+        integrator(str) - euler or rk4
     Returns
         x_0 - new position on streamline after propagation via electric field
     """
+    if integrator == "rk4":
+        return rk4_step(
+            x_0, lambda p: calculate_electric_field_dev_c_shared(p, x, Q), step_size
+        )
     # Compute field
     E = calculate_electric_field_dev_c_shared(x_0, x, Q)
     # if np.linalg.norm(E) > epsilon:
@@ -68,47 +167,27 @@ def propagate_topo_dev(x_0, x, Q, step_size, debug=False):
 
 def propagate_topo_dev_batch(x_0_list, x, Q, step_size, mask_list=None):
     """
-    Propagates position based on normalized electric field at a given point
+    Propagates a set of positions based on the normalized electric field at each of them
     Takes
-        x_0_list(array) - position to propagate based on field at that point of shape (1,3)
+        x_0_list(array) - positions to propagate based on field at those points of shape (B,3)
         x(array) - positions of charges of shape (N,3)
         Q(array) - magnitude and sign of charges of shape (N,1)
         step_size(float) - size of streamline step to take when propagating, real and positive
-        mask_list(list) - list of bools to mask the points that are outside the box
+        mask_list(array) - bools of shape (B,) masking points that are not propagated
     Returns
-        x_0 - new position on streamline after propagation via electric field
+        x_0 - new positions on the streamlines of shape (B,3), masked points unchanged
     """
-
-    if mask_list is None:
-        E_full = calculate_electric_field_dev_c_shared_batch(x_0_list, x, Q)
-        # print("passed first iter")
-    else:
-        # if theres a mask, only calculate the field for the points that are inside the box
-        # filter x_0_list on the mask
-
-        x_0_list_filtered = [x_0 for x_0, mask in zip(x_0_list, mask_list) if not mask]
-        E = calculate_electric_field_dev_c_shared_batch(x_0_list_filtered, x, Q)
-        # expand E to the original size E is 0 for masked points
-        # print("mask list: {}".format(mask_list))
-        # print("E: {}".format(E))
-        E_full = []
-        # print("E: {}".format(E))
-        # print("type {}".format(type(E[0])))
-        ind_filtered = 0
-        for ind, x in enumerate(x_0_list):
-            if mask_list[ind] == False:
-                E_full.append(E[ind_filtered])
-                ind_filtered += 1
-            else:
-                E_full.append([0.0, 0.0, 0.0])
-
-    assert len(E_full) == len(x_0_list), "efull len is funky"
-
-    # print("efull: {}".format(E_full))
-    E_list = [e / (np.linalg.norm(e)) for e in E_full]
-    x_0_list = [x_0 + step_size * e for x_0, e in zip(x_0_list, E_list)]
-    # print(x_0_list)
-    return x_0_list
+    x_0 = np.array(x_0_list, dtype=np.float64).reshape(-1, 3)
+    active = (
+        np.ones(len(x_0), dtype=bool)
+        if mask_list is None
+        else ~np.asarray(mask_list, dtype=bool).reshape(-1)
+    )
+    # the field is only calculated for the points that are propagated
+    x_0[active] += step_size * field_direction(
+        x_0[active], lambda points: calculate_electric_field_points(points, x, Q)
+    )
+    return x_0
 
 
 def initialize_box_points_random(
@@ -345,13 +424,162 @@ def calculate_electric_field_c_shared_full_alt(x_0, x, Q):
     return E
 
 
-def calculate_thread_c_shared(x_0, n_iter, x, Q, step_size, dimensions):
+def morton_order(x, bits=10):
+    """
+    Order of a set of points along a Morton (Z-order) curve over their bounding box,
+    so that points close in space end up close in memory
+    Takes
+        x(array) - positions of shape (N,3)
+        bits(int) - bits of resolution per coordinate, at most 21
+    Returns
+        order(array) - indices sorting the points along the curve of shape (N,)
+    """
+    x = np.asarray(x, dtype=np.float64).reshape(-1, 3)
+    if len(x) == 0:
+        return np.zeros(0, dtype=np.int64)
+    low = x.min(axis=0)
+    span = np.maximum(x.max(axis=0) - low, 1e-12)
+    cells = np.minimum(((x - low) / span * (1 << bits)).astype(np.int64), (1 << bits) - 1)
+    code = np.zeros(len(x), dtype=np.int64)
+    for b in range(bits):
+        for k in range(3):
+            code |= ((cells[:, k] >> b) & 1) << (3 * b + 2 - k)
+    return np.argsort(code, kind="stable")
+
+
+def charges_to_soa(x, Q, sort=True):
+    """
+    Lays charges out as structure-of-arrays for the vectorized native field kernel
+    Takes
+        x(array) - positions of charges of shape (N,3)
+        Q(array) - magnitude and sign of charges of shape (N,1)
+        sort(bool) - whether to put the charges in Morton order
+    Returns
+        x_soa(array) - float32 positions of charges of shape (3,N)
+        Q_soa(array) - float32 charges of shape (N,)
+    """
+    x = np.asarray(x).reshape(-1, 3)
+    Q = np.asarray(Q).reshape(-1)
+    if sort:
+        order = morton_order(x)
+        x, Q = x[order], Q[order]
+    return np.ascontiguousarray(x.T, dtype=np.float32), np.ascontiguousarray(Q, dtype=np.float32)
+
+
+def calculate_electric_field_soa(points, x_soa, Q_soa):
+    """
+    Computes electric field at a set of points with the vectorized native kernel
+    Takes
+        points(array) - positions to compute field at of shape (L,3)
+        x_soa(array) - positions of charges from charges_to_soa of shape (3,N)
+        Q_soa(array) - charges from charges_to_soa of shape (N,)
+    Returns
+        E(array) - electric field at the points of shape (L,3)
+    """
+    return Math.calc_field_soa_batch(points, x_soa, Q_soa)
+
+
+def calculate_electric_field_native_points(points, x, Q):
+    """
+    Computes electric field at a set of points with one native call per point. The
+    GIL is released during every call, so threads can split the points between them
+    Takes
+        points(array) - positions to compute field at of shape (L,3)
+        x(array) - positions of charges of shape (N,3)
+        Q(array) - magnitude and sign of charges of shape (N,1)
+    Returns
+        E(array) - electric field at the points of shape (L,3)
+    """
+    points = np.ascontiguousarray(points, dtype=np.float32).reshape(-1, 3)
+    x = np.ascontiguousarray(x, dtype=np.float32).reshape(-1, 3)
+    Q = np.ascontiguousarray(Q, dtype=np.float32).reshape(-1)
+    E = np.zeros(points.shape, dtype=np.float32)
+    for i, point in enumerate(points):
+        E[i] = Math.calc_field(point, x, Q)
+    return E
+
+
+def calculate_thread_c_shared(
+    x_0, n_iter, x, Q, step_size, dimensions, integrator="euler", tol=1e-4, analytic_curvature=False
+):
     result = Math.thread_operation(
-        x_0=x_0, n_iter=n_iter, x=x, Q=Q, step_size=step_size, dimensions=dimensions
+        x_0=x_0,
+        n_iter=n_iter,
+        x=x,
+        Q=Q,
+        step_size=step_size,
+        dimensions=dimensions,
+        integrator=integrator,
+        tol=tol,
+        analytic_curvature=analytic_curvature,
     )
     return result
 
 
+def calculate_thread_batch_c_shared(
+    x_0, n_iter, x, Q, step_size, dimensions, integrator="euler", tol=1e-4, analytic_curvature=False
+):
+    """
+    Computes the topology of a whole set of streamlines in a single native call
+    Takes
+        x_0(array) - starting points of the streamlines of shape (n_samples,3)
+        n_iter(array) - maximum number of steps of each streamline of shape (n_samples,)
+        x(array) - positions of charges of shape (N,3)
+        Q(array) - magnitude and sign of charges of shape (N,1)
+        step_size(float) - size of streamline step to take when propagating, real and positive
+        dimensions(array) - L, W, H of box of shape (1,3)
+        integrator(str) - euler, rk4 or rk45
+        tol(float) - local error tolerance of the rk45 integrator
+        analytic_curvature(bool) - curvature from the field gradient instead of extra steps
+    Returns
+        result(array) - distance and mean curvature of each streamline of shape (n_samples,2)
+    """
+    result = Math.thread_operation_batch(
+        x_0=x_0,
+        n_iter=n_iter,
+        x=x,
+        Q=Q,
+        step_size=step_size,
+        dimensions=dimensions,
+        integrator=integrator,
+        tol=tol,
+        analytic_curvature=analytic_curvature,
+    )
+    return result
+
+
+def calculate_thread_batch_numba(
+    x_0, n_iter, x, Q, step_size, dimensions, integrator="euler", tol=1e-4, analytic_curvature=False
+):
+    """
+    Computes the topology of a whole set of streamlines with the numba engine, the
+    same streamlines as calculate_thread_batch_c_shared without the native library
+    Takes
+        x_0(array) - starting points of the streamlines of shape (n_samples,3)
+        n_iter(array) - maximum number of steps of each streamline of shape (n_samples,)
+        x(array) - positions of charges of shape (N,3)
+        Q(array) - magnitude and sign of charges of shape (N,1)
+        step_size(float) - size of streamline step to take when propagating, real and positive
+        dimensions(array) - L, W, H of box of shape (1,3)
+        integrator(str) - euler, rk4 or rk45
+        tol(float) - local error tolerance of the rk45 integrator
+        analytic_curvature(bool) - curvature from the field gradient instead of extra steps
+    Returns
+        result(array) - distance and mean curvature of each streamline of shape (n_samples,2)
+    """
+    return nb_topo_batch(
+        np.ascontiguousarray(x_0, dtype=np.float64).reshape(-1, 3),
+        np.ascontiguousarray(n_iter, dtype=np.int64).reshape(-1),
+        np.ascontiguousarray(x, dtype=np.float64).reshape(-1, 3),
+        np.ascontiguousarray(Q, dtype=np.float64).reshape(-1),
+        float(step_size),
+        np.ascontiguousarray(dimensions, dtype=np.float64).reshape(-1),
+        INTEGRATORS[integrator],
+        float(tol),
+        bool(analytic_curvature),
+    )
+
+
 def calculate_electric_field_dev_c_shared_batch(x_0_list, x, Q):
     """
     Computes electric field at a point given positions of charges
@@ -384,6 +612,122 @@ def calculate_electric_field_dev_c_shared_batch(x_0_list, x, Q):
     return E_list
 
 
+def calculate_electric_field_points(points, x, Q, chunk_elements=2**22):
+    """
+    Computes electric field at a set of points given positions of charges, exact sum
+    Takes
+        points(array) - positions to compute field at of shape (L,3)
+        x(array) - positions of charges of shape (N,3)
+        Q(array) - magnitude and sign of charges of shape (N,1)
+        chunk_elements(int) - maximum number of point-charge pairs held in memory at once
+    Returns
+        E(array) - electric field at the points of shape (L,3)
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    x = np.asarray(x, dtype=np.float64).reshape(-1, 3)
+    Q = np.asarray(Q, dtype=np.float64).reshape(1, -1, 1)
+    E = np.zeros_like(points)
+    chunk = max(1, chunk_elements // max(1, len(x)))
+    for start in range(0, len(points), chunk):
+        R = points[start : start + chunk, np.newaxis, :] - x[np.newaxis, :, :]
+        r_mag_cube = np.sum(R**2, axis=-1, keepdims=True) ** 1.5
+        E[start : start + chunk] = np.sum(R * Q / r_mag_cube, axis=1) * 14.3996451
+    return E
+
+
+def calculate_field_gradient_points(points, x, Q, chunk_elements=2**21):
+    """
+    Computes electric field and its Jacobian at a set of points given positions of charges, exact sum
+    Takes
+        points(array) - positions to compute field at of shape (L,3)
+        x(array) - positions of charges of shape (N,3)
+        Q(array) - magnitude and sign of charges of shape (N,1)
+        chunk_elements(int) - maximum number of point-charge pairs held in memory at once
+    Returns
+        E(array) - electric field at the points of shape (L,3)
+        J(array) - field gradient J[l, a, b] = dE_a/dx_b at the points of shape (L,3,3)
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    x = np.asarray(x, dtype=np.float64).reshape(-1, 3)
+    Q = np.asarray(Q, dtype=np.float64).reshape(1, -1)
+    E = np.zeros_like(points)
+    J = np.zeros((len(points), 3, 3))
+    chunk = max(1, chunk_elements // max(1, len(x)))
+    for start in range(0, len(points), chunk):
+        R = points[start : start + chunk, np.newaxis, :] - x[np.newaxis, :, :]
+        r_inv_sq = 1 / np.sum(R**2, axis=-1)
+        q_r_inv_3 = Q * r_inv_sq**1.5
+        E[start : start + chunk] = np.einsum("ln,lnk->lk", q_r_inv_3, R) * 14.3996451
+        J[start : start + chunk] = (
+            np.sum(q_r_inv_3, axis=1)[:, np.newaxis, np.newaxis] * np.eye(3)
+            - 3 * np.einsum("ln,lna,lnb->lab", q_r_inv_3 * r_inv_sq, R, R)
+        ) * 14.3996451
+    return E, J
+
+
+def analytic_curvature_batch(E, J):
+    """
+    Curvature of the field lines through a set of points, |(I - t t^T) J t| / |E| with t = E / |E|
+    Takes
+        E(array) - electric field at the points of shape (L,3)
+        J(array) - field gradient at the points of shape (L,3,3)
+    Returns
+        curvature(array) - curvature at each point of shape (L,)
+    """
+    E_norm = np.linalg.norm(E, axis=-1)
+    t = E / E_norm[:, np.newaxis]
+    J_t = np.einsum("lab,lb->la", J, t)
+    perp = J_t - np.sum(J_t * t, axis=-1, keepdims=True) * t
+    return np.linalg.norm(perp, axis=-1) / E_norm
+
+
+def calculate_esp_points(points, x, Q, chunk_elements=2**22):
+    """
+    Computes electrostatic potential at a set of points given positions of charges, exact sum
+    Takes
+        points(array) - positions to compute potential at of shape (L,3)
+        x(array) - positions of charges of shape (N,3)
+        Q(array) - magnitude and sign of charges of shape (N,1)
+        chunk_elements(int) - maximum number of point-charge pairs held in memory at once
+    Returns
+        ESP(array) - electrostatic potential at the points of shape (L,1)
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    x = np.asarray(x, dtype=np.float64).reshape(-1, 3)
+    Q = np.asarray(Q, dtype=np.float64).reshape(1, -1)
+    ESP = np.zeros((len(points), 1))
+    chunk = max(1, chunk_elements // max(1, len(x)))
+    for start in range(0, len(points), chunk):
+        R = points[start : start + chunk, np.newaxis, :] - x[np.newaxis, :, :]
+        r_mag = np.sqrt(np.sum(R**2, axis=-1))
+        ESP[start : start + chunk, 0] = np.sum(Q / r_mag, axis=1) * 14.3996451
+    return ESP
+
+
+def compare_fields(E_test, E_reference, scale=None):
+    """
+    Reports the error of an approximate field against a reference field
+    Takes
+        E_test(array) - approximate field at a set of points of shape (L,3)
+        E_reference(array) - reference field at the same points of shape (L,3)
+        scale(float) - magnitude the errors are relative to, defaults to the reference magnitude at each point
+    Returns
+        report(dict) - maximum and mean absolute and relative errors
+    """
+    abs_error = np.linalg.norm(np.asarray(E_test) - np.asarray(E_reference), axis=1)
+    if scale is None:
+        rel_error = abs_error / np.linalg.norm(E_reference, axis=1)
+    else:
+        rel_error = abs_error / scale
+    return {
+        "n_points": len(abs_error),
+        "max_abs_error": float(np.max(abs_error)),
+        "mean_abs_error": float(np.mean(abs_error)),
+        "max_rel_error": float(np.max(rel_error)),
+        "mean_rel_error": float(np.mean(rel_error)),
+    }
+
+
 def calculate_electric_field_gpu_for_test(x_0, x, Q, device="cuda"):
     """
     Computes electric field at a point given positions of charges
@@ -561,6 +905,246 @@ def compute_curv_and_dist(
     return [dist, curv_mean]
 
 
+def compute_curv_and_dist_batch(
+    x_init, x_init_plus, x_init_plus_plus, x_0, x_0_plus, x_0_plus_plus
+):
+    """
+    Vectorized compute_curv_and_dist for a set of streamlines
+    Takes
+        x_init, x_init_plus, x_init_plus_plus(array) - first point of every streamline and its
+            one and two step propagations, each of shape (L,3)
+        x_0, x_0_plus, x_0_plus_plus(array) - last point of every streamline and its
+            one and two step propagations, each of shape (L,3)
+    Returns
+        dist(array) - Euclidian distance between beginning and end of each streamline of shape (L,)
+        curv_mean(array) - mean curvature between beginning and end of each streamline of shape (L,)
+    """
+
+    def curv_batch(v_prime, v_prime_prime, eps=10e-6):
+        denominator = np.linalg.norm(v_prime, axis=-1) ** 3
+        curvature = np.linalg.norm(np.cross(v_prime, v_prime_prime), axis=-1)
+        return curvature / np.where(denominator == 0, eps, denominator)
+
+    curv_init = curv_batch(
+        x_init_plus - x_init, x_init_plus_plus - 2 * x_init_plus + x_init
+    )
+    curv_final = curv_batch(x_0_plus - x_0, x_0_plus_plus - 2 * x_0_plus + x_0)
+    curv_mean = (curv_init + curv_final) / 2
+    dist = np.linalg.norm(x_init - x_0, axis=-1)
+    return dist, curv_mean
+
+
+def Inside_Box_batch(local_points, dimensions):
+    """
+    Checks which streamline points are inside a box
+    Takes
+        local_points(array) - current local points of shape (L,3)
+        dimensions(array) - L, W, H of box of shape (1,3)
+    Returns
+        is_inside(array) - whether each point is inside the box of shape (L,)
+    """
+    return np.all(np.abs(local_points) <= np.asarray(dimensions), axis=-1)
+
+
+def clip_to_box_batch(inside_points, outside_points, dimensions):
+    """
+    Moves points that stepped out of the box back to where their step crosses the wall
+    Takes
+        inside_points(array) - last points inside the box of shape (L,3)
+        outside_points(array) - points the steps ended on outside the box of shape (L,3)
+        dimensions(array) - L, W, H of box of shape (1,3)
+    Returns
+        points(array) - crossing points on the walls of shape (L,3)
+    """
+    dimensions = np.asarray(dimensions).reshape(-1)
+    delta = outside_points - inside_points
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_wall = np.where(
+            outside_points > dimensions,
+            (dimensions - inside_points) / delta,
+            np.where(outside_points < -dimensions, (-dimensions - inside_points) / delta, 1.0),
+        )
+    t = np.min(t_wall, axis=-1, keepdims=True)
+    return inside_points + t * delta
+
+
+def compute_curv_and_dist_central_batch(
+    x_init_minus, x_init, x_init_plus, x_0_minus, x_0, x_0_plus
+):
+    """
+    compute_curv_and_dist_batch with central differences, from one step back and
+    one step forward around the first and last point of every streamline
+    Takes
+        x_init_minus, x_init, x_init_plus(array) - first point of every streamline and a
+            step back and forward from it, each of shape (L,3)
+        x_0_minus, x_0, x_0_plus(array) - last point of every streamline and a step back
+            and forward from it, each of shape (L,3)
+    Returns
+        dist(array) - Euclidian distance between beginning and end of each streamline of shape (L,)
+        curv_mean(array) - mean curvature between beginning and end of each streamline of shape (L,)
+    """
+
+    def curv_central(minus, point, plus, eps=10e-6):
+        v_prime = 0.5 * (plus - minus)
+        v_prime_prime = plus - 2 * point + minus
+        denominator = np.linalg.norm(v_prime, axis=-1) ** 3
+        curvature = np.linalg.norm(np.cross(v_prime, v_prime_prime), axis=-1)
+        return curvature / np.where(denominator == 0, eps, denominator)
+
+    curv_mean = (
+        curv_central(x_init_minus, x_init, x_init_plus)
+        + curv_central(x_0_minus, x_0, x_0_plus)
+    ) / 2
+    dist = np.linalg.norm(x_init - x_0, axis=-1)
+    return dist, curv_mean
+
+
+def propagate_topo_field_batch(x_0, field_fn, step_size, integrator="euler"):
+    """
+    Propagates a set of positions based on the normalized electric field at each of them
+    Takes
+        x_0(array) - positions to propagate of shape (L,3)
+        field_fn(callable) - returns the electric field at a set of points of shape (L,3)
+        step_size(float) - size of streamline step to take when propagating, real and positive
+        integrator(str) - euler or rk4
+    Returns
+        x_0 - new positions on the streamlines of shape (L,3)
+    """
+    if integrator == "rk4":
+        return rk4_step(x_0, field_fn, step_size)
+    return x_0 + step_size * field_direction(x_0, field_fn)
+
+
+def integrate_streamlines_batch(
+    x_0, n_iter, field_fn, step_size, dimensions, integrator="euler", tol=1e-4
+):
+    """
+    Advances a set of streamlines together until they leave the box or reach
+    their length of n_iter steps
+    Takes
+        x_0(array) - starting points of the streamlines of shape (L,3)
+        n_iter(array) - maximum number of steps of each streamline of shape (L,)
+        field_fn(callable) - returns the electric field at a set of points of shape (L,3)
+        step_size(float) - size of streamline step to take when propagating, real and positive
+        dimensions(array) - L, W, H of box of shape (1,3)
+        integrator(str) - euler, rk4 or rk45, rk45 adapts its steps to cover the
+            same arc length of n_iter * step_size. The higher order integrators end
+            streamlines leaving the box on the wall rather than up to a step past it
+        tol(float) - local error tolerance of the rk45 integrator
+    Returns
+        x_final(array) - last point of every streamline of shape (L,3)
+    """
+    if integrator not in ("euler", "rk4", "rk45"):
+        raise ValueError("integrator must be euler, rk4 or rk45")
+    x_final = np.array(x_0, dtype=np.float64).reshape(-1, 3)
+    n_iter = np.asarray(n_iter).reshape(-1)
+    active = n_iter > 0
+
+    if integrator == "rk45":
+        length = n_iter * float(step_size)
+        travelled = np.zeros(len(x_final))
+        h = np.full(len(x_final), float(step_size))
+        while np.any(active):
+            active_indices = np.nonzero(active)[0]
+            h_try = np.minimum(h[active_indices], length[active_indices] - travelled[active_indices])
+            points, err = rk45_step(x_final[active_indices], field_fn, h_try.reshape(-1, 1))
+            inside = Inside_Box_batch(points, dimensions)
+            accept, h[active_indices] = adaptive_step_control(
+                err, tol, h_try, step_size, inside
+            )
+            # steps out of the box end on the wall
+            exited = accept & ~inside
+            points[exited] = clip_to_box_batch(
+                x_final[active_indices[exited]], points[exited], dimensions
+            )
+            kept = active_indices[accept]
+            x_final[kept] = points[accept]
+            travelled[kept] += h_try[accept]
+            active[kept] = inside[accept] & (
+                length[kept] - travelled[kept] > 1e-3 * step_size
+            )
+        return x_final
+
+    # running streamlines are kept in the first n_active rows of one buffer, with
+    # their input index in ids and their remaining steps in n_left; finished ones
+    # are written out and compacted away so each step only touches running rows
+    ids = np.nonzero(active)[0]
+    points = x_final[ids]
+    n_left = n_iter[ids].astype(np.int64)
+    n_active = len(ids)
+    while n_active:
+        current = points[:n_active]
+        stepped = propagate_topo_field_batch(current, field_fn, step_size, integrator)
+        inside = Inside_Box_batch(stepped, dimensions)
+        if integrator != "euler":
+            # steps out of the box end on the wall
+            stepped[~inside] = clip_to_box_batch(current[~inside], stepped[~inside], dimensions)
+        n_left[:n_active] -= 1
+        running = inside & (n_left[:n_active] > 0)
+        if running.all():
+            current[...] = stepped
+            continue
+        finished = ~running
+        x_final[ids[:n_active][finished]] = stepped[finished]
+        n_running = int(np.count_nonzero(running))
+        points[:n_running] = stepped[running]
+        ids[:n_running] = ids[:n_active][running]
+        n_left[:n_running] = n_left[:n_active][running]
+        n_active = n_running
+    return x_final
+
+
+def compute_topo_field_batch(
+    x_0, n_iter, field_fn, step_size, dimensions, integrator="euler", tol=1e-4, field_gradient_fn=None
+):
+    """
+    Computes the topology of a set of streamlines advanced together, with the field
+    supplied by any batched field evaluator (exact sum, octree, ...)
+    Takes
+        x_0(array) - starting points of the streamlines of shape (L,3)
+        n_iter(array) - maximum number of steps of each streamline of shape (L,)
+        field_fn(callable) - returns the electric field at a set of points of shape (L,3)
+        step_size(float) - size of streamline step to take when propagating, real and positive
+        dimensions(array) - L, W, H of box of shape (1,3)
+        integrator(str) - euler, rk4 or rk45
+        tol(float) - local error tolerance of the rk45 integrator
+        field_gradient_fn(callable) - returns the field and its gradient at a set of points,
+            shapes (L,3) and (L,3,3); when given the curvature is analytic instead of
+            taken from extra steps
+    Returns
+        hist(array) - distance and mean curvature of each streamline of shape (L,2)
+    """
+    x_init = np.asarray(x_0, dtype=np.float64).reshape(-1, 3)
+    x_final = integrate_streamlines_batch(
+        x_init, n_iter, field_fn, step_size, dimensions, integrator, tol
+    )
+    L = len(x_init)
+
+    if field_gradient_fn is not None:
+        curvature = analytic_curvature_batch(
+            *field_gradient_fn(np.concatenate((x_init, x_final), axis=0))
+        )
+        dist = np.linalg.norm(x_init - x_final, axis=-1)
+        return np.column_stack((dist, (curvature[:L] + curvature[L:]) / 2))
+
+    # the curvature stencil uses fixed steps, forward for euler and central with
+    # rk4 steps for the higher order integrators so it is second order too
+    ends = np.concatenate((x_init, x_final), axis=0)
+    if integrator == "euler":
+        ends_plus = propagate_topo_field_batch(ends, field_fn, step_size)
+        ends_plus_plus = propagate_topo_field_batch(ends_plus, field_fn, step_size)
+        dist, curv_mean = compute_curv_and_dist_batch(
+            ends[:L], ends_plus[:L], ends_plus_plus[:L], ends[L:], ends_plus[L:], ends_plus_plus[L:]
+        )
+    else:
+        ends_minus = propagate_topo_field_batch(ends, field_fn, -step_size, "rk4")
+        ends_plus = propagate_topo_field_batch(ends, field_fn, step_size, "rk4")
+        dist, curv_mean = compute_curv_and_dist_central_batch(
+            ends_minus[:L], ends[:L], ends_plus[:L], ends_minus[L:], ends[L:], ends_plus[L:]
+        )
+    return np.column_stack((dist, curv_mean))
+
+
 def Inside_Box(local_point, dimensions):
     """
     Checks if a streamline point is inside a box
@@ -785,16 +1369,20 @@ def make_histograms_mem(topo_files, output_dir, plot=False):
 
 
 def make_fields(field_files):
+    """
+    Field vectors of cpet field files, binary volume files are memory-mapped
+    Takes
+        field_files(list) - text or binary field files
+    Returns
+        fields(list of arrays) - field vectors of shape (N,3)
+    """
     fields = []
     for field_file in field_files:
-        field = []
-        with open(field_file) as field_data:
-            for line in field_data:
-                if line.startswith("#"):
-                    continue
-                line = line.split()
-                field.append([float(line[3]), float(line[4]), float(line[5])])
-        fields.append(np.array(field))
+        if is_volume(field_file):
+            # float16 fields are widened, the norms of the distance matrix overflow in float16
+            fields.append(read_volume(field_file)[1][:, 3:6].astype(np.float32, copy=False))
+        else:
+            fields.append(np.loadtxt(field_file, comments="#", usecols=(3, 4, 5), ndmin=2))
     return fields
 
 def distance_numpy(hist1, hist2):
@@ -803,6 +1391,44 @@ def distance_numpy(hist1, hist2):
     return np.sum(np.divide(a, b, out=np.zeros_like(a), where=b != 0)) / 2.0
 
 
+def topology_histogram_bins(topology):
+    """
+    Fixed binning for the histograms of a topology run, from a first set of samples
+    with the same bin width rule as make_histograms
+    Takes
+        topology(array) - distances and curvatures of shape (L,2)
+    Returns
+        bins(list) - number of distance and curvature bins
+        hist_range(list) - [[min, max] distance, [min, max] curvature]
+    """
+    bins, hist_range = [], []
+    for values in (topology[:, 0], topology[:, 1]):
+        binres = 2 * iqr(values) / (len(values) ** (1 / 3))
+        low, high = float(np.min(values)), float(np.max(values))
+        if high <= low:
+            high = low + 1.0
+        bins.append(max(1, int((high - low) / binres)) if binres > 0 else 1)
+        hist_range.append([low, high])
+    return bins, hist_range
+
+
+def topology_histogram(topology, bins, hist_range):
+    """
+    Normalized histogram of a topology on fixed bins, values beyond the range fall
+    in the edge bins
+    Takes
+        topology(array) - distances and curvatures of shape (L,2)
+        bins(list) - number of distance and curvature bins
+        hist_range(list) - [[min, max] distance, [min, max] curvature]
+    Returns
+        hist(array) - normalized histogram of shape (bins[0], bins[1])
+    """
+    distances = np.clip(topology[:, 0], hist_range[0][0], hist_range[0][1])
+    curvatures = np.clip(topology[:, 1], hist_range[1][0], hist_range[1][1])
+    hist, _, _ = np.histogram2d(distances, curvatures, bins=bins, range=hist_range)
+    return hist / np.sum(hist)
+
+
 def construct_distance_matrix_mem(hist_file_list):
     '''
     Memory-efficient implementation
@@ -6,6 +6,10 @@ import numba as nb
 Making basic math faster!!
 """
 
+# a process pool forked after the tbb layer has started its workers hangs at exit,
+# so the parallel kernels prefer the omp and workqueue layers
+nb.config.THREADING_LAYER_PRIORITY = ["omp", "workqueue", "tbb"]
+
 
 def power(a, b):
     """
@@ -69,3 +73,271 @@ def custom_norm_3d(data):
                 sum_sq += data[i, j, k] ** 2
             result[i, j, 0] = np.sqrt(sum_sq)
     return result
+
+
+"""
+Numba topology engine, the same streamlines as thread_operation in math_module.c
+without the native library. Every streamline is advanced by one prange iteration
+in double precision, so the kernels below work on scalars and return tuples
+instead of filling small arrays.
+"""
+
+# integrator codes, the same as c_ops.INTEGRATORS
+NB_EULER = 0
+NB_RK4 = 1
+NB_RK45 = 2
+
+
+@nb.njit(cache=True, fastmath=True)
+def nb_field_point(p_0, p_1, p_2, x, Q):
+    """
+    Electric field of all charges at a single point, returned component by component
+    """
+    E_0 = 0.0
+    E_1 = 0.0
+    E_2 = 0.0
+    for i in range(x.shape[0]):
+        R_0 = p_0 - x[i, 0]
+        R_1 = p_1 - x[i, 1]
+        R_2 = p_2 - x[i, 2]
+        r_inv = 1.0 / np.sqrt(R_0 * R_0 + R_1 * R_1 + R_2 * R_2)
+        weight = Q[i] * r_inv * r_inv * r_inv
+        E_0 += weight * R_0
+        E_1 += weight * R_1
+        E_2 += weight * R_2
+    return E_0 * 14.3996451, E_1 * 14.3996451, E_2 * 14.3996451
+
+
+@nb.njit(cache=True, fastmath=True)
+def nb_direction(p_0, p_1, p_2, x, Q):
+    """
+    Unit vector along the field at a single point
+    """
+    E_0, E_1, E_2 = nb_field_point(p_0, p_1, p_2, x, Q)
+    E_norm = np.sqrt(E_0 * E_0 + E_1 * E_1 + E_2 * E_2)
+    return E_0 / E_norm, E_1 / E_norm, E_2 / E_norm
+
+
+@nb.njit(cache=True, fastmath=True)
+def nb_propagate(p_0, p_1, p_2, x, Q, h, integrator):
+    """
+    One fixed step of size h, forward Euler or classical RK4
+    """
+    a_0, a_1, a_2 = nb_direction(p_0, p_1, p_2, x, Q)
+    if integrator == NB_EULER:
+        return p_0 + h * a_0, p_1 + h * a_1, p_2 + h * a_2
+    b_0, b_1, b_2 = nb_direction(
+        p_0 + 0.5 * h * a_0, p_1 + 0.5 * h * a_1, p_2 + 0.5 * h * a_2, x, Q
+    )
+    c_0, c_1, c_2 = nb_direction(
+        p_0 + 0.5 * h * b_0, p_1 + 0.5 * h * b_1, p_2 + 0.5 * h * b_2, x, Q
+    )
+    d_0, d_1, d_2 = nb_direction(p_0 + h * c_0, p_1 + h * c_1, p_2 + h * c_2, x, Q)
+    return (
+        p_0 + h / 6.0 * (a_0 + 2.0 * b_0 + 2.0 * c_0 + d_0),
+        p_1 + h / 6.0 * (a_1 + 2.0 * b_1 + 2.0 * c_1 + d_1),
+        p_2 + h / 6.0 * (a_2 + 2.0 * b_2 + 2.0 * c_2 + d_2),
+    )
+
+
+@nb.njit(cache=True, fastmath=True)
+def nb_rk45_step(p, x, Q, h, k, stage):
+    """
+    One Cash-Karp step of size h from p into stage[0], returns the norm of the
+    embedded error estimate; k is (6,3) scratch space for the stages
+    """
+    a = (
+        (0.0, 0.0, 0.0, 0.0, 0.0),
+        (1 / 5, 0.0, 0.0, 0.0, 0.0),
+        (3 / 40, 9 / 40, 0.0, 0.0, 0.0),
+        (3 / 10, -9 / 10, 6 / 5, 0.0, 0.0),
+        (-11 / 54, 5 / 2, -70 / 27, 35 / 27, 0.0),
+        (1631 / 55296, 175 / 512, 575 / 13824, 44275 / 110592, 253 / 4096),
+    )
+    b_5 = (37 / 378, 0.0, 250 / 621, 125 / 594, 0.0, 512 / 1771)
+    b_4 = (2825 / 27648, 0.0, 18575 / 48384, 13525 / 55296, 277 / 14336, 1 / 4)
+    for j in range(6):
+        for i in range(3):
+            stage[1, i] = p[i]
+            for m in range(j):
+                stage[1, i] += h * a[j][m] * k[m, i]
+        k[j, 0], k[j, 1], k[j, 2] = nb_direction(stage[1, 0], stage[1, 1], stage[1, 2], x, Q)
+    err_sq = 0.0
+    for i in range(3):
+        y_5 = p[i]
+        e = 0.0
+        for j in range(6):
+            y_5 += h * b_5[j] * k[j, i]
+            e += h * (b_5[j] - b_4[j]) * k[j, i]
+        stage[0, i] = y_5
+        err_sq += e * e
+    return np.sqrt(err_sq)
+
+
+@nb.njit(cache=True)
+def nb_adaptive_step_control(err, tol, h_try, step_size, inside):
+    """
+    Whether an adaptive step is kept and the size of the next one, steps leaving
+    the box are only kept once no longer than step_size
+    """
+    h_min = 1e-3 * step_size
+    factor = 0.9 * (tol / err) ** 0.2 if err > 0.0 else 5.0
+    factor = min(5.0, max(0.2, factor))
+    if err > tol and h_try > h_min:
+        return False, max(h_try * factor, h_min)
+    if not inside and h_try > step_size:
+        return False, max(0.5 * h_try, step_size)
+    return True, max(h_try * factor, h_min)
+
+
+@nb.njit(cache=True)
+def nb_inside(p, dimensions):
+    return (
+        -dimensions[0] <= p[0] <= dimensions[0]
+        and -dimensions[1] <= p[1] <= dimensions[1]
+        and -dimensions[2] <= p[2] <= dimensions[2]
+    )
+
+
+@nb.njit(cache=True)
+def nb_clip_to_wall(inside_point, outside_point, dimensions):
+    """
+    Moves outside_point back to where the step from inside_point crosses the wall
+    """
+    t = 1.0
+    for k in range(3):
+        delta = outside_point[k] - inside_point[k]
+        if outside_point[k] > dimensions[k]:
+            t = min(t, (dimensions[k] - inside_point[k]) / delta)
+        elif outside_point[k] < -dimensions[k]:
+            t = min(t, (-dimensions[k] - inside_point[k]) / delta)
+    for k in range(3):
+        outside_point[k] = inside_point[k] + t * (outside_point[k] - inside_point[k])
+
+
+@nb.njit(cache=True, fastmath=True)
+def nb_curve_stencil(m_0, m_1, m_2, p_0, p_1, p_2, q_0, q_1, q_2, central):
+    """
+    Curvature from three consecutive points of a streamline, the forward stencil
+    (point, plus, plus plus) or the central one (minus, point, plus)
+    """
+    if central:
+        v_0 = 0.5 * (q_0 - m_0)
+        v_1 = 0.5 * (q_1 - m_1)
+        v_2 = 0.5 * (q_2 - m_2)
+    else:
+        v_0 = p_0 - m_0
+        v_1 = p_1 - m_1
+        v_2 = p_2 - m_2
+    w_0 = q_0 - 2 * p_0 + m_0
+    w_1 = q_1 - 2 * p_1 + m_1
+    w_2 = q_2 - 2 * p_2 + m_2
+    c_0 = v_1 * w_2 - v_2 * w_1
+    c_1 = v_2 * w_0 - v_0 * w_2
+    c_2 = v_0 * w_1 - v_1 * w_0
+    v_norm = np.sqrt(v_0 * v_0 + v_1 * v_1 + v_2 * v_2)
+    return np.sqrt(c_0 * c_0 + c_1 * c_1 + c_2 * c_2) / v_norm**3
+
+
+@nb.njit(cache=True, fastmath=True)
+def nb_curve_analytic(p_0, p_1, p_2, x, Q):
+    """
+    Curvature of the field line through a point from the field gradient,
+    |(I - t t^T) J t| / |E| with t = E / |E|
+    """
+    # the Coulomb factor cancels in the ratio and is left out
+    E = np.zeros(3)
+    J = np.zeros((3, 3))
+    for i in range(x.shape[0]):
+        R = (p_0 - x[i, 0], p_1 - x[i, 1], p_2 - x[i, 2])
+        r_inv = 1.0 / np.sqrt(R[0] * R[0] + R[1] * R[1] + R[2] * R[2])
+        q_r_inv_3 = Q[i] * r_inv * r_inv * r_inv
+        q_r_inv_5 = 3.0 * q_r_inv_3 * r_inv * r_inv
+        for a in range(3):
+            E[a] += q_r_inv_3 * R[a]
+            J[a, a] += q_r_inv_3
+            for b in range(3):
+                J[a, b] -= q_r_inv_5 * R[a] * R[b]
+    E_norm = np.sqrt(E[0] * E[0] + E[1] * E[1] + E[2] * E[2])
+    t = E / E_norm
+    J_t = J @ t
+    perp = J_t - (J_t[0] * t[0] + J_t[1] * t[1] + J_t[2] * t[2]) * t
+    return np.sqrt(perp[0] ** 2 + perp[1] ** 2 + perp[2] ** 2) / E_norm
+
+
+@nb.njit(cache=True, fastmath=True)
+def nb_streamline_curvature(p, x, Q, step_size, integrator, analytic_curvature):
+    """
+    Curvature at one end of a streamline, analytic, from a forward Euler stencil
+    or from a central RK4 stencil for the higher order integrators
+    """
+    if analytic_curvature:
+        return nb_curve_analytic(p[0], p[1], p[2], x, Q)
+    if integrator == NB_EULER:
+        q_0, q_1, q_2 = nb_propagate(p[0], p[1], p[2], x, Q, step_size, NB_EULER)
+        s_0, s_1, s_2 = nb_propagate(q_0, q_1, q_2, x, Q, step_size, NB_EULER)
+        return nb_curve_stencil(p[0], p[1], p[2], q_0, q_1, q_2, s_0, s_1, s_2, False)
+    m_0, m_1, m_2 = nb_propagate(p[0], p[1], p[2], x, Q, -step_size, NB_RK4)
+    q_0, q_1, q_2 = nb_propagate(p[0], p[1], p[2], x, Q, step_size, NB_RK4)
+    return nb_curve_stencil(m_0, m_1, m_2, p[0], p[1], p[2], q_0, q_1, q_2, True)
+
+
+@nb.njit(parallel=True, cache=True, fastmath=True)
+def nb_topo_batch(x_0, n_iter, x, Q, step_size, dimensions, integrator, tol, analytic_curvature):
+    """
+    Distance and mean curvature of every streamline, one streamline per prange iteration
+    Takes
+        x_0(array) - starting points of the streamlines of shape (L,3)
+        n_iter(array) - maximum number of steps of each streamline of shape (L,)
+        x(array) - positions of charges of shape (N,3)
+        Q(array) - magnitude and sign of charges of shape (N,)
+        step_size(float) - step size of each step
+        dimensions(array) - box limits of shape (3,)
+        integrator(int) - NB_EULER, NB_RK4 or NB_RK45
+        tol(float) - local error tolerance of the rk45 integrator
+        analytic_curvature(bool) - curvature from the field gradient instead of extra steps
+    Returns
+        result(array) - distance and mean curvature of each streamline of shape (L,2)
+    """
+    result = np.zeros((x_0.shape[0], 2))
+    for s in nb.prange(x_0.shape[0]):
+        p = x_0[s].copy()
+        p_prev = np.empty(3)
+        if integrator == NB_RK45:
+            # adaptive steps along the same arc length as n_iter fixed steps
+            k = np.empty((6, 3))
+            stage = np.empty((2, 3))
+            length = n_iter[s] * step_size
+            travelled = 0.0
+            h = step_size
+            while length - travelled > 1e-3 * step_size:
+                h_try = min(h, length - travelled)
+                err = nb_rk45_step(p, x, Q, h_try, k, stage)
+                inside = nb_inside(stage[0], dimensions)
+                accept, h = nb_adaptive_step_control(err, tol, h_try, step_size, inside)
+                if not accept:
+                    continue
+                if not inside:
+                    nb_clip_to_wall(p, stage[0], dimensions)
+                p[:] = stage[0]
+                travelled += h_try
+                if not inside:
+                    break
+        else:
+            for _ in range(n_iter[s]):
+                p_prev[:] = p
+                p[0], p[1], p[2] = nb_propagate(p[0], p[1], p[2], x, Q, step_size, integrator)
+                if not nb_inside(p, dimensions):
+                    if integrator != NB_EULER:
+                        nb_clip_to_wall(p_prev, p, dimensions)
+                    break
+
+        curve_init = nb_streamline_curvature(
+            x_0[s], x, Q, step_size, integrator, analytic_curvature
+        )
+        curve_final = nb_streamline_curvature(p, x, Q, step_size, integrator, analytic_curvature)
+        result[s, 0] = np.sqrt(
+            (p[0] - x_0[s, 0]) ** 2 + (p[1] - x_0[s, 1]) ** 2 + (p[2] - x_0[s, 2]) ** 2
+        )
+        result[s, 1] = (curve_init + curve_final) / 2
+    return result
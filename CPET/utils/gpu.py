@@ -2,7 +2,7 @@ import numpy as np
 import time
 import torch
 import torch.jit as jit
-from typing import Tuple
+from typing import List, Optional, Tuple
 from CPET.utils.io import parse_pqr
 from torch.profiler import profile, record_function, ProfilerActivity
 
@@ -55,6 +55,58 @@ def calculate_electric_field_torch_batch_gpu(
     return E
 
 
+@torch.jit.script
+def calculate_field_gradient_torch_batch_gpu(
+    x_0: torch.Tensor,
+    x: torch.Tensor,
+    Q: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Computes field and its Jacobian at a set of points given the charges and their positions
+    Takes
+        x_0(array) - positions to compute field at of shape (L,3)
+        x(array) - positions of charges of shape (N,3)
+        Q(array) - magnitude and sign of charges of shape (N,1)
+    Returns
+        E - electric field at x_0 of shape (L,3)
+        J - field gradient J[l, a, b] = dE_a/dx_b at x_0 of shape (L,3,3)
+    """
+    N = x_0.size(0)
+    E = torch.zeros(N, 3, device=x_0.device, dtype=torch.float32)
+    J = torch.zeros(N, 3, 3, device=x_0.device, dtype=torch.float32)
+    eye = torch.eye(3, device=x_0.device, dtype=torch.float32)
+
+    for start in range(0, N, 100):
+        end = min(start + 100, N)
+        R = x_0[start:end].unsqueeze(1) - x.unsqueeze(0)
+        r_inv_sq = torch.sum(R * R, dim=-1, keepdim=True).pow(-1)
+        q_r_inv_3 = Q * r_inv_sq.pow(1.5)
+        E[start:end] = (R * q_r_inv_3).sum(dim=1) * 14.3996451
+        J[start:end] = (
+            q_r_inv_3.sum(dim=1).unsqueeze(-1) * eye
+            - 3 * torch.einsum("lna,lnb->lab", R * q_r_inv_3 * r_inv_sq, R)
+        ) * 14.3996451
+
+    return E, J
+
+
+@torch.jit.script
+def analytic_curvature_gpu(E: torch.Tensor, J: torch.Tensor) -> torch.Tensor:
+    """
+    Curvature of the field lines through a set of points, |(I - t t^T) J t| / |E|
+    Takes
+        E - electric field at the points of shape (L,3)
+        J - field gradient at the points of shape (L,3,3)
+    Returns
+        curvature - curvature at each point of shape (L,)
+    """
+    E_norm = torch.norm(E, dim=-1, keepdim=True)
+    t = E / E_norm
+    J_t = torch.einsum("lab,lb->la", J, t)
+    perp = J_t - torch.sum(J_t * t, dim=-1, keepdim=True) * t
+    return torch.norm(perp, dim=-1) / E_norm.squeeze(-1)
+
+
 #@torch.jit.script
 def propagate_topo_matrix_gpu(
     path_matrix: torch.Tensor,
@@ -62,6 +114,7 @@ def propagate_topo_matrix_gpu(
     x: torch.Tensor,
     Q: torch.Tensor,
     step_size: torch.Tensor,
+    integrator: str = "euler",
     #dtype_str: str
 ) -> torch.Tensor:
     """
@@ -72,6 +125,8 @@ def propagate_topo_matrix_gpu(
         x(array) - positions of charges of shape (N,3)
         Q(array) - magnitude and sign of charges of shape (N,1)
         step_size(float) - size of streamline step to take when propagating, real and positive
+        integrator(str) - euler or rk4, the path matrix holds one point per fixed step
+            so the adaptive rk45 integrator is not available here
     Returns
         x_0 - new position on streamline after propagation via electric field
     """
@@ -86,8 +141,21 @@ def propagate_topo_matrix_gpu(
     E = calculate_electric_field_torch_batch_gpu(path_matrix_prior, 
                                                  x, 
                                                  Q)
-    path_matrix[i + 1] = path_matrix_prior + step_size * E / torch.norm(
-        E, dim=-1, keepdim=True
+    k_1 = E / torch.norm(E, dim=-1, keepdim=True)
+    if integrator == "euler":
+        path_matrix[i + 1] = path_matrix_prior + step_size * k_1
+        return path_matrix
+    if integrator != "rk4":
+        raise ValueError("GPU streamlines support the euler and rk4 integrators")
+
+    E = calculate_electric_field_torch_batch_gpu(path_matrix_prior + 0.5 * step_size * k_1, x, Q)
+    k_2 = E / torch.norm(E, dim=-1, keepdim=True)
+    E = calculate_electric_field_torch_batch_gpu(path_matrix_prior + 0.5 * step_size * k_2, x, Q)
+    k_3 = E / torch.norm(E, dim=-1, keepdim=True)
+    E = calculate_electric_field_torch_batch_gpu(path_matrix_prior + step_size * k_3, x, Q)
+    k_4 = E / torch.norm(E, dim=-1, keepdim=True)
+    path_matrix[i + 1] = path_matrix_prior + step_size / 6 * (
+        k_1 + 2 * k_2 + 2 * k_3 + k_4
     )
     return path_matrix
 
@@ -162,6 +230,211 @@ def Inside_Box_gpu(local_points, dimensions):
     )
     return is_inside
 
+@torch.jit.script
+def calculate_electric_field_chunks_gpu(
+    points: torch.Tensor,
+    x_chunks: List[torch.Tensor],
+    Q_chunks: List[torch.Tensor],
+    point_chunk: int,
+) -> torch.Tensor:
+    """
+    Computes field at a set of points from charges already split into chunks
+    Takes
+        points(array) - positions to compute field at of shape (L,3)
+        x_chunks(list) - positions of charges, chunks of shape (C,3)
+        Q_chunks(list) - magnitude and sign of charges, chunks of shape (C,1)
+        point_chunk(int) - number of points held against a chunk of charges at once
+    Returns
+        E - electric field at the points of shape (L,3)
+    """
+    L = points.size(0)
+    E = torch.zeros(L, 3, device=points.device, dtype=points.dtype)
+    for start in range(0, L, point_chunk):
+        end = min(start + point_chunk, L)
+        p = points[start:end].unsqueeze(1)
+        for i in range(len(x_chunks)):
+            R = p - x_chunks[i].unsqueeze(0)
+            r_inv_cube = torch.sum(R * R, dim=-1, keepdim=True).pow(-1.5)
+            E[start:end] += (R * r_inv_cube * Q_chunks[i].unsqueeze(0)).sum(dim=1)
+    return E * 14.3996451
+
+
+@torch.jit.script
+def direction_chunks_gpu(
+    points: torch.Tensor,
+    x_chunks: List[torch.Tensor],
+    Q_chunks: List[torch.Tensor],
+    point_chunk: int,
+) -> torch.Tensor:
+    E = calculate_electric_field_chunks_gpu(points, x_chunks, Q_chunks, point_chunk)
+    return E / torch.norm(E, dim=-1, keepdim=True)
+
+
+@torch.jit.script
+def rk4_step_chunks_gpu(
+    points: torch.Tensor,
+    x_chunks: List[torch.Tensor],
+    Q_chunks: List[torch.Tensor],
+    step_size: float,
+    point_chunk: int,
+) -> torch.Tensor:
+    """
+    One classical Runge-Kutta step along the normalized field, as rk4_step
+    Takes
+        points(array) - positions to propagate of shape (L,3)
+        x_chunks(list) - positions of charges, chunks of shape (C,3)
+        Q_chunks(list) - magnitude and sign of charges, chunks of shape (C,1)
+        step_size(float) - size of the step, negative to step back along the field
+        point_chunk(int) - number of points held against a chunk of charges at once
+    Returns
+        points(array) - new positions on the streamlines of shape (L,3)
+    """
+    k_1 = direction_chunks_gpu(points, x_chunks, Q_chunks, point_chunk)
+    k_2 = direction_chunks_gpu(points + 0.5 * step_size * k_1, x_chunks, Q_chunks, point_chunk)
+    k_3 = direction_chunks_gpu(points + 0.5 * step_size * k_2, x_chunks, Q_chunks, point_chunk)
+    k_4 = direction_chunks_gpu(points + step_size * k_3, x_chunks, Q_chunks, point_chunk)
+    return points + step_size / 6 * (k_1 + 2 * k_2 + 2 * k_3 + k_4)
+
+
+@torch.jit.script
+def compute_curv_and_dist_central_gpu(
+    x_init: torch.Tensor,
+    x_0: torch.Tensor,
+    x: torch.Tensor,
+    Q: torch.Tensor,
+    step_size: float,
+    charge_chunk: int = 1024,
+    point_chunk: int = 1024,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Distance and mean curvature of streamlines with the central stencil of
+    compute_curv_and_dist_central_batch, from an rk4 step back and forward around
+    the first and last point of every streamline
+    Takes
+        x_init(array) - first point of every streamline of shape (L,3)
+        x_0(array) - last point of every streamline of shape (L,3)
+        x(array) - positions of charges of shape (N,3)
+        Q(array) - magnitude and sign of charges of shape (N,1) or (1,N,1)
+        step_size(float) - size of streamline step, real and positive
+        charge_chunk(int) - number of charges in each chunk
+        point_chunk(int) - number of points held against a chunk of charges at once
+    Returns
+        dist(array) - Euclidian distance between beginning and end of each streamline of shape (L,)
+        curv_mean(array) - mean curvature between beginning and end of each streamline of shape (L,)
+    """
+    x_chunks = list(torch.split(x, charge_chunk))
+    Q_chunks = list(torch.split(Q.reshape(-1, 1), charge_chunk))
+    L = x_init.size(0)
+    ends = torch.cat((x_init, x_0), dim=0)
+    minus = rk4_step_chunks_gpu(ends, x_chunks, Q_chunks, -step_size, point_chunk)
+    plus = rk4_step_chunks_gpu(ends, x_chunks, Q_chunks, step_size, point_chunk)
+    v_prime = 0.5 * (plus - minus)
+    v_prime_prime = plus - 2 * ends + minus
+    denominator = torch.norm(v_prime, dim=-1) ** 3
+    curvature = torch.norm(torch.cross(v_prime, v_prime_prime, dim=-1), dim=-1) / torch.where(
+        denominator == 0, torch.full_like(denominator, 10e-6), denominator
+    )
+    curv_mean = (curvature[:L] + curvature[L:]) / 2
+    dist = torch.norm(x_init - x_0, dim=-1)
+    return dist, curv_mean
+
+
+@torch.jit.script
+def clip_to_box_gpu(inside_points: torch.Tensor, outside_points: torch.Tensor, dimensions: torch.Tensor) -> torch.Tensor:
+    """
+    Moves points that stepped out of the box back to where their step crosses the
+    wall, as clip_to_box_batch
+    Takes
+        inside_points(array) - last points inside the box of shape (L,3)
+        outside_points(array) - points the steps ended on outside the box of shape (L,3)
+        dimensions(array) - L, W, H of box of shape (1,3)
+    Returns
+        points(array) - crossing points on the walls of shape (L,3)
+    """
+    dimensions = dimensions.reshape(-1)
+    delta = outside_points - inside_points
+    ones = torch.ones_like(delta)
+    t_wall = torch.where(
+        outside_points > dimensions,
+        (dimensions - inside_points) / delta,
+        torch.where(outside_points < -dimensions, (-dimensions - inside_points) / delta, ones),
+    )
+    t = t_wall.min(dim=-1, keepdim=True).values
+    return inside_points + t * delta
+
+
+@torch.jit.script
+def propagate_topo_matrix_steps_gpu(
+    path_matrix: torch.Tensor,
+    start: int,
+    n_steps: int,
+    x: torch.Tensor,
+    Q: torch.Tensor,
+    step_size: float,
+    dimensions: torch.Tensor,
+    rows_left: torch.Tensor,
+    integrator: str = "euler",
+    charge_chunk: int = 1024,
+    point_chunk: int = 1024,
+    exits: Optional[torch.Tensor] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Advances the path matrix n_steps rows from row start in a single call.
+    A streamline is only propagated until two rows past its last point (leaving
+    the box or reaching its number of steps), the two rows the curvature needs;
+    after that its rows are copied forward without computing the field. Like the
+    cpu engines, rk4 steps out of the box end on the wall; points on the wall are
+    inside the box, so the rows streamlines left the box at are tracked in exits
+    Takes
+        path_matrix(array) - positions of streamline of shape (M,L,3)
+        start(int) - most recently updated row of the path matrix
+        n_steps(int) - number of rows to fill after start
+        x(array) - positions of charges of shape (N,3)
+        Q(array) - magnitude and sign of charges of shape (N,1) or (1,N,1)
+        step_size(float) - size of streamline step to take when propagating, real and positive
+        dimensions(array) - L, W, H of box of shape (1,3)
+        rows_left(array) - row at which each streamline reaches its number of steps of shape (L,)
+        integrator(str) - euler or rk4
+        charge_chunk(int) - number of charges in each chunk, the chunks are split once per call
+        point_chunk(int) - number of points held against a chunk of charges at once
+        exits(array) - row at which each streamline left the box, M if it has not, of
+            shape (L,); found from rows 0 to start if None
+    Returns
+        path_matrix(array) - path matrix with rows start + 1 to start + n_steps filled
+        exits(array) - row at which each streamline left the box, M if it has not
+    """
+    if integrator != "euler" and integrator != "rk4":
+        raise ValueError("GPU streamlines support the euler and rk4 integrators")
+    x_chunks = list(torch.split(x, charge_chunk))
+    Q_chunks = list(torch.split(Q.reshape(-1, 1), charge_chunk))
+    M = path_matrix.size(0)
+    if exits is None:
+        rows = torch.arange(start + 1, device=path_matrix.device).unsqueeze(1)
+        outside = ~Inside_Box_gpu(path_matrix[: start + 1], dimensions)
+        exits = torch.where(outside, rows, M).min(dim=0).values
+    stop = torch.minimum(exits, rows_left)
+
+    for r in range(start, start + n_steps):
+        path_matrix[r + 1] = path_matrix[r]
+        active = (stop + 2 > r).nonzero()[:, 0]
+        if active.numel() > 0:
+            p = path_matrix[r, active]
+            if integrator == "euler":
+                k_1 = direction_chunks_gpu(p, x_chunks, Q_chunks, point_chunk)
+                path_matrix[r + 1, active] = p + step_size * k_1
+            else:
+                path_matrix[r + 1, active] = rk4_step_chunks_gpu(p, x_chunks, Q_chunks, step_size, point_chunk)
+        # the step onto the last row of a streamline may leave the box too
+        exited = ~Inside_Box_gpu(path_matrix[r + 1], dimensions) & (stop >= r + 1) & (exits > r + 1)
+        if integrator != "euler":
+            # masked instead of indexed, so the device is not synchronized every step
+            clipped = clip_to_box_gpu(path_matrix[r], path_matrix[r + 1], dimensions)
+            path_matrix[r + 1] = torch.where(exited.unsqueeze(-1), clipped, path_matrix[r + 1])
+        stop = torch.where(exited, r + 1, stop)
+        exits = torch.where(exited, r + 1, exits)
+    return path_matrix, exits
+
+
 # @torch.jit.script
 def generate_path_filter_gpu(arr, M):
     """
@@ -174,22 +447,10 @@ def generate_path_filter_gpu(arr, M):
         mat(array) - path filter of shape (M,L,1) that has 1's everywhere that you want to keep info
         (e.g. the streamline has not ended its path + 2 or the streamline has not hit the box edge + 2)
     """
-    # Initialize the matrix with zeros
-
-    mat = torch.zeros((len(arr), int(M)), dtype=torch.int64, device="cuda") #Shape (L,M)
-
-    # Iterate over the array
-    for i, value in enumerate(arr): #Enumerate is effectively shape (L,2)
-        # If a streamline end exists, set the row to 1 up to the end point +2 additional points to ensure first and second derivatives
-        # Since value is the index, you need to add 3 to make sure you get the point and 2 additional points
-        # For cases where value+2 is greater than the max number of streamline points, the entire streamline would be set to 1
-        if value != -1:
-            mat[i, : value] = 1
-        # If no streamline ends exist, set the entire row to 1 (meaning nothing to filter)
-        else:
-            mat[i] = 1
-    # return np.expand_dims(mat.T,axis=2)
-    return torch.unsqueeze(mat.permute(1, 0), dim=2)
+    # rows before the end point are kept, streamlines without an end (-1) keep every row
+    rows = torch.arange(int(M), device=arr.device).unsqueeze(1) #Shape (M,1)
+    mat = (rows < arr.unsqueeze(0)) | (arr.unsqueeze(0) == -1) #Shape (M,L)
+    return torch.unsqueeze(mat.to(torch.int64), dim=2)
 
 
 #@torch.jit.script
@@ -202,189 +463,107 @@ def first_false_index_gpu(arr: torch.Tensor):
     - numpy.ndarray: An array of shape (L,) containing, for each streamline (column), the first place (row) where it is outside of the box.
                      If no False value is found in a streamline (column), the value is set to -1 for that streamline (column).
     """
-
-    # Find where the tensor is False
-    false_tensor = torch.zeros_like(arr, dtype=torch.bool) #Shape (M,L)
-
-    false_indices = torch.nonzero(arr == false_tensor) #Shape (P_0,2), where P_0 is the number of False vals in the whole matrix
-    row_indices = false_indices[:, 0] #Shape (P_0,)
-    col_indices = false_indices[:, 1] #Shape (P_0,)
-
-    # Create a tensor of -1's to initialize the result
-    result = torch.full((arr.shape[1],), -1, dtype=torch.int64, device=arr.device) #Shape (L,)
-
-    # For each column index where we found a False value
-    unique_cols = torch.unique(col_indices) #Shape (P_1,), where P_1 is the number of streamlines that have at least one point outside the box
-    for col in unique_cols:
-        # Find the first place along the streamline where the point is outside the box
-        result[col] = torch.min(row_indices[col_indices == col])
-    return result
+    M = arr.shape[0]
+    rows = torch.arange(M, device=arr.device).unsqueeze(1) #Shape (M,1)
+    # rows inside the box are pushed past the end, so the minimum is the first row outside
+    first = torch.where(arr, M, rows).min(dim=0).values #Shape (L,)
+    return torch.where(first == M, -1, first)
 
 
 @torch.jit.script
 def t_delete(tensor, indices):
-    keep_mask = torch.ones(tensor.shape[1], dtype=torch.bool)
+    keep_mask = torch.ones(tensor.shape[1], dtype=torch.bool, device=tensor.device)
     keep_mask[indices] = False
     return tensor[:, keep_mask]
 
 
 def filter_and_dump_gpu(
-    GPU_batch_freq, 
-    stopping_points, 
-    stopping_indices,
-    init_points, 
-    path_matrix, 
+    GPU_batch_freq,
+    stopping_points,
+    path_matrix,
+    init_points,
+    ids,
     dumped_values,
+    done,
 ):
     """
-    Uses either box or path indices to dump values from path matrix or
-    identify indices to ignore
+    Dumps the first and last three points of every streamline that stopped within
+    the batch into the result buffer, at the position of the streamline in the input
     Takes
-        GPU_batch_freq(int) - frequency of GPU batch, typically kept at 100
-        stopping_points(array) - stopping points of streamline based on box or path
-        stopping_indices(array) - indices of stopping points
-        init_points(array) - initial points of all current streamlines of shape (3,L,3)
+        GPU_batch_freq(int) - number of rows of the path matrix
+        stopping_points(array) - row of the last point of each streamline of shape (L,), GPU_batch_freq if none
         path_matrix(array) - positions of streamline of shape (M,L,3)
-        dumped_values(array) - values to dump
+        init_points(array) - initial points of all current streamlines of shape (3,L,3)
+        ids(array) - input position of each current streamline of shape (L,)
+        dumped_values(array) - result buffer of shape (6,L_0,3) over all L_0 input streamlines
+        done(array) - whether each input streamline is in the result buffer of shape (L_0,)
     Returns
-        dumped_values(array) - updated dumped streamline values
-        ignore_indices(array) - indices to ignore
-    """
-    ignore_indices = []
-    for i in range(len(stopping_indices)):
-        idx = int(stopping_points[i])
-        if idx >= GPU_batch_freq - 2:
-            ignore_indices.append(stopping_indices[i])
-            continue
-        new_data = torch.concat(
-            (init_points[:, stopping_indices[i], :], path_matrix[idx : idx + 3, stopping_indices[i], :]), dim=0
-        )
-        dumped_values = torch.cat(
-            (dumped_values, new_data.unsqueeze(1)), dim=1
-        )
-        #print(f"Final {filtertype} point from dumped_values: {dumped_values[:, -1, :]}")
-    print(f"Now have {dumped_values.shape[1]} number of dumped streamlines after filtering.")
-    return dumped_values, ignore_indices
+        finished(array) - mask of the current streamlines that were dumped of shape (L,)
+    """
+    # the curvature needs the two points after the last one, so streamlines stopping
+    # in the last two rows are finished with the next batch
+    finished = stopping_points < GPU_batch_freq - 2 #Shape (L,)
+    columns = finished.nonzero()[:, 0] #Shape (F,)
+    rows = stopping_points[columns].unsqueeze(0) + torch.arange(
+        3, device=path_matrix.device
+    ).unsqueeze(1) #Shape (3,F)
+    dumped_values[0:3, ids[columns]] = init_points[:, columns]
+    dumped_values[3:6, ids[columns]] = path_matrix[rows, columns.unsqueeze(0)]
+    done[ids[columns]] = True
+    return finished
+
 
-# @torch.jit.script
 def batched_filter_gpu(
     path_matrix: torch.Tensor,
     dumped_values: torch.Tensor,
-    i: int,
+    done: torch.Tensor,
+    ids: torch.Tensor,
+    n_iter: torch.Tensor,
+    init_points: torch.Tensor,
+    step_offset: int,
     dimensions: torch.Tensor,
-    path_filter: torch.Tensor,
-    GPU_batch_freq,
-    init_points,
-    dtype_str: str = "float64",
-) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    exits=None,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
     """
-    Batch filtering of the path matrix, and dumping streamline values
-    that hit their limits, and reinitalizing path matrix and filters
+    Batch filtering of the path matrix, dumping streamlines that left the box or
+    reached their number of steps and compacting the rest into a new path matrix
     Takes
-        path_matrix(array) - positions of streamline of shape (GPU_batch_filter,L,3)
-        dumped_values(array) - previous streamline begin+end of shape (F0,6)
-        i(int) - current iteration
-        dimensions(array) - L, W, H of box of shape (1,3)
-        path_filter(array) - filter to apply to path matrix of shape (M,L,1)
-        GPU_batch_freq(int) - frequency of GPU batch, changes if remainder exists
+        path_matrix(array) - positions of streamline of shape (GPU_batch_freq,L,3)
+        dumped_values(array) - result buffer of shape (6,L_0,3) over all L_0 input streamlines
+        done(array) - whether each input streamline is in the result buffer of shape (L_0,)
+        ids(array) - input position of each current streamline of shape (L,)
+        n_iter(array) - maximum number of steps of each current streamline of shape (L,)
         init_points(array) - initial points of all current streamlines of shape (3,L,3)
-        dtype_str(str) - data type of path matrix
+        step_offset(int) - number of steps before the first row of the path matrix
+        dimensions(array) - L, W, H of box of shape (1,3)
+        exits(array) - row at which each streamline left the box from
+            propagate_topo_matrix_steps_gpu of shape (L,), found from the path matrix if None
     Returns
-        path_mat_new(array) - new path matrix of shape (M,L-F1,3) retaining last two values
-        dumped_values(array) - updated streamline begin+end of shape (F0+F1,6)
-        path_filt(array) - new path filter of shape of shape (L-F1)
-        init_points_new(array) - new initial points of shape (3,L-F1,3)
-    """
-    print("Filtering...")
-    inside_box_mat = Inside_Box_gpu(path_matrix, dimensions) #Shape (M,L)
-    first_false = first_false_index_gpu(inside_box_mat) #Shape (L,)
-    outside_box_filter = generate_path_filter_gpu(first_false, GPU_batch_freq) #Shape (M,L,1)
-    torch.cuda.empty_cache()
-    diff_matrix_box = path_matrix * outside_box_filter - path_matrix #Shape (M,L,3)
-    box_indices = torch.where(torch.any(torch.any(diff_matrix_box != 0, dim=0), dim=1))[
-        0
-    ] #Shape (F1,) --> which streamlines hit the box edge
-
-    box_stopping_points = torch.sum(outside_box_filter, dim=(0, 2)) #Shape (L,)
-
-    del diff_matrix_box
-
-    path_filter_temp = path_filter[
-        i * (GPU_batch_freq - 2) : GPU_batch_freq + i * (GPU_batch_freq - 2), ...
-    ] #Shape (GPU_batch_freq,L,1)
-    diff_matrix_path = (
-        path_matrix * path_filter_temp - path_matrix
-    ) #Shape (GPU_batch_freq,L,3)
-
-    path_indices = torch.any(diff_matrix_path != 0, dim=(0, 2)).nonzero()[:, 0]
-
-    del diff_matrix_path
-    path_stopping_points = torch.sum(path_filter_temp, dim=(0, 2))
-
-    filter_indices = torch.unique(torch.concatenate((path_indices, box_indices)))
-
-    stopping_points = []
-
-    for i, index in enumerate(filter_indices):
-        if index in path_indices and index in box_indices:
-            
-            stopping_points.append(
-                min(
-                    path_stopping_points[index],
-                    box_stopping_points[index],
-                )
-            )
-            
-            #Slower version for testing:
-            '''
-            print(f"Streamline detected to hit both path and box at index: {index}, checking now...")
-            if path_stopping_points[index] < box_stopping_points[index]:
-                stopping_points.append(path_stopping_points[index])
-                print("Streamline hit path limit first at index", index)
-            elif path_stopping_points[index] > box_stopping_points[index]:
-                stopping_points.append(box_stopping_points[index])
-                print("Streamline hit box first at index", index)
-            else:
-                stopping_points.append(path_stopping_points[index])
-                print("Path and box indices are equal")
-            '''
-            
-        elif index in path_indices:
-            stopping_points.append(path_stopping_points[index])
-        elif index in box_indices:
-            stopping_points.append(first_false[index])
-        else:
-            raise ValueError("Index not found in either path or box indices for some reason...")
-
-    dumped_values, ignore_indices = filter_and_dump_gpu(
-        GPU_batch_freq,
-        stopping_points,
-        filter_indices,
-        init_points,
-        path_matrix,
-        dumped_values,
+        path_mat_new(array) - new path matrix of shape (GPU_batch_freq,L-F,3) starting with the last two rows
+        ids_new(array) - input position of the remaining streamlines of shape (L-F,)
+        n_iter_new(array) - maximum number of steps of the remaining streamlines of shape (L-F,)
+        init_points_new(array) - initial points of the remaining streamlines of shape (3,L-F,3)
+        exits_new(array) - exits of the remaining streamlines in the rows of the new path matrix of shape (L-F,)
+    """
+    GPU_batch_freq = path_matrix.shape[0]
+    if exits is None:
+        first_false = first_false_index_gpu(Inside_Box_gpu(path_matrix, dimensions)) #Shape (L,)
+        exits = torch.where(first_false == -1, GPU_batch_freq, first_false)
+    box_stopping_points = exits
+    # the row after n_iter steps, beyond the matrix if the path limit is not in this batch
+    path_stopping_points = torch.clamp(n_iter - step_offset, 0, GPU_batch_freq)
+    stopping_points = torch.minimum(box_stopping_points, path_stopping_points)
+
+    finished = filter_and_dump_gpu(
+        GPU_batch_freq, stopping_points, path_matrix, init_points, ids, dumped_values, done
     )
-
-    torch.cuda.empty_cache()
-
-    mask = ~torch.isin(filter_indices, torch.tensor(ignore_indices).cuda())
-
-    # Apply the mask to get the new filtered indices
-    new_filter_indices = filter_indices[mask]
-
-    path_mat = t_delete(path_matrix, new_filter_indices)
-    path_filt = t_delete(path_filter, new_filter_indices)
-    init_points_new = t_delete(init_points, new_filter_indices)
-    # print("4.", path_mat.shape)
-    if dtype_str == "float32":
-        dtype = torch.float32
-    else:
-        dtype = torch.float64
+    keep = ~finished
     path_mat_new = torch.zeros(
-        GPU_batch_freq, path_mat.shape[1], 3, device=path_mat.device, dtype=dtype
+        GPU_batch_freq, int(keep.sum()), 3, device=path_matrix.device, dtype=path_matrix.dtype
     )
-    path_mat_new[0:2, ...] = path_mat[-2:, ...]
-    print(f"Number of streamlines filtered: {len(new_filter_indices)}")
-
-    # return torch.tensor(path_mat).cuda(), torch.tensor(dumped_values).cuda(), torch.tensor(path_filt).cuda()
-    return path_mat_new, dumped_values, path_filt, init_points_new
\ No newline at end of file
+    path_mat_new[0:2] = path_matrix[-2:, keep]
+    # the last two rows become the first two, exits in them move with them
+    exits_new = exits[keep]
+    exits_new = torch.where(exits_new < GPU_batch_freq, exits_new - (GPU_batch_freq - 2), GPU_batch_freq)
+    print(f"Number of streamlines filtered: {int(finished.sum())}")
+    return path_mat_new, ids[keep], n_iter[keep], init_points[:, keep], exits_new
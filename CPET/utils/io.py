@@ -1,3 +1,9 @@
+import os
+import gzip
+import mmap
+import tarfile
+import hashlib
+import warnings
 import numpy as np
 
 
@@ -22,6 +28,20 @@ def write_field_to_file(grid_points, field_points, filename):
         np.savetxt(f, data, fmt=format_str)
 
 
+def sample_density_line(num_steps, dimensions):
+    """
+    First line of a cpet field file, half the number of steps and the half lengths of the box
+    """
+    return "#Sample Density: {} {} {}; Volume: Box: {} {} {}\n".format(
+        int((num_steps[0] - 1 ) / 2), 
+        int((num_steps[1] - 1 ) / 2),
+        int((num_steps[2] - 1 ) / 2),
+        dimensions[0],
+        dimensions[1],
+        dimensions[2]
+    )
+
+
 def save_numpy_as_dat(meta_data, field, name):
     """
     Saves np array in original format from cpet output
@@ -36,14 +56,7 @@ def save_numpy_as_dat(meta_data, field, name):
     trans_mat = meta_data["transformation_matrix"].transpose()
     center = meta_data["center"]
 
-    first_line = "#Sample Density: {} {} {}; Volume: Box: {} {} {}\n".format(
-        int((step_size_list[0] - 1 ) / 2), 
-        int((step_size_list[1] - 1 ) / 2),
-        int((step_size_list[2] - 1 ) / 2),
-        dimensions[0],
-        dimensions[1],
-        dimensions[2]
-    )
+    first_line = sample_density_line(step_size_list, dimensions)
     second_line = "#Frame 0\n"
     third_line = "#Center: {} {} {}\n".format(
         center[0],
@@ -74,44 +87,144 @@ def save_numpy_as_dat(meta_data, field, name):
     """
 
 
-    # write as
-    np.savetxt(
-        name,
-        field,
-        fmt="%.3f",
+    # header first, then the field in the same pass
+    with open(name, "w") as f:
+        f.write("".join(lines_header))
+        np.savetxt(
+            f,
+            field,
+            fmt="%.3f",
+        )
+
+
+# binary volume files: magic, a fixed header, then the field as a contiguous (N,C) array
+VOLUME_MAGIC = b"CPET_VOL"
+VOLUME_OFFSET = 256
+VOLUME_HEADER = np.dtype(
+    [
+        ("magic", "S8"),
+        ("version", "<u4"),
+        ("itemsize", "<u4"),
+        ("n_points", "<u8"),
+        ("n_columns", "<u4"),
+        ("num_steps", "<u4", (3,)),
+        ("dimensions", "<f8", (3,)),
+        ("step_size", "<f8", (3,)),
+        ("center", "<f8", (3,)),
+        ("basis", "<f8", (3, 3)),
+    ]
+)
+
+
+def save_volume(meta_data, field, name):
+    """
+    Saves a field as a binary volume file, the header holds the same information as
+    the header of save_numpy_as_dat and the field is kept as float16 or float32
+    Takes:
+        meta_data: dictionary with meta data
+        field: np array of points and field values of shape (N,C)
+        name: name of file to save
+    """
+    dtype = field.dtype if field.dtype in (np.float16, np.float32) else np.dtype(np.float32)
+    field = np.ascontiguousarray(field, dtype=dtype.newbyteorder("<"))
+    step_size = meta_data["step_size"]
+    header = np.zeros((), dtype=VOLUME_HEADER)
+    header["magic"] = VOLUME_MAGIC
+    header["version"] = 1
+    header["itemsize"] = dtype.itemsize
+    header["n_points"], header["n_columns"] = field.shape
+    header["num_steps"] = meta_data["num_steps"][:3]
+    header["dimensions"] = meta_data["dimensions"]
+    header["step_size"] = step_size if np.ndim(step_size) else [step_size] * 3
+    header["center"] = meta_data["center"]
+    # same basis as the text header
+    header["basis"] = np.asarray(meta_data["transformation_matrix"]).transpose()
+    with open(name, "wb") as f:
+        f.write(header.tobytes().ljust(VOLUME_OFFSET, b"\x00"))
+        f.write(field.tobytes())
+
+
+def is_volume(path):
+    """
+    Whether a file is a binary volume file of save_volume
+    """
+    with open(path, "rb") as f:
+        return f.read(len(VOLUME_MAGIC)) == VOLUME_MAGIC
+
+
+def read_volume(path):
+    """
+    Memory-maps a binary volume file
+    Takes
+        path(str) - binary volume file
+    Returns
+        meta_data(dict) - num_steps, dimensions, step_size, center and basis
+        field(np.memmap) - points and field values of shape (N,C), in the dtype saved
+    """
+    header = np.fromfile(path, dtype=VOLUME_HEADER, count=1)[0]
+    if header["magic"] != VOLUME_MAGIC:
+        raise ValueError("{} is not a binary volume file".format(path))
+    if header["version"] != 1:
+        raise ValueError("{} has an unsupported volume version {}".format(path, header["version"]))
+    dtype = {2: "<f2", 4: "<f4"}[int(header["itemsize"])]
+    meta_data = {
+        "num_steps": header["num_steps"].astype(int),
+        "dimensions": header["dimensions"].copy(),
+        "step_size": header["step_size"].copy(),
+        "center": header["center"].copy(),
+        "basis": header["basis"].copy(),
+    }
+    field = np.memmap(
+        path,
+        dtype=dtype,
+        mode="r",
+        offset=VOLUME_OFFSET,
+        shape=(int(header["n_points"]), int(header["n_columns"])),
     )
+    return meta_data, field
 
-    # open file and write header
-    with open(name, "r") as f:
-        lines = f.readlines()
 
-    with open(name, "w") as f:
-        f.write("".join(lines_header))
-        f.write("".join(lines))
+def volume_to_dat(path, name):
+    """
+    Exports a binary volume file as a text field file of save_numpy_as_dat, as read by Chimera
+    Takes
+        path(str) - binary volume file
+        name(str) - name of the text file to save
+    """
+    meta_data, field = read_volume(path)
+    meta_data["transformation_matrix"] = meta_data["basis"].transpose()
+    save_numpy_as_dat(meta_data, field, name)
 
 
 def read_mat(file, meta_data=False, verbose=False):
     """
-    Pulls the matrix from a cpet file
+    Pulls the matrix from a cpet file, binary volume files are memory-mapped
     Takes
-        file: cpet file
+        file: cpet file, text or binary
         meta_data(Optionally): returns the meta data
     Returns
         mat: matrix of xyz coordinates
         meta_data(Optionally): dictionary of meta data
     """
-    with open(file) as f:
-        lines = f.readlines()
-
-    steps_x = 2 * int(lines[0].split()[2]) + 1
-    steps_y = 2 * int(lines[0].split()[3]) + 1
-    steps_z = 2 * int(lines[0].split()[4]) + 1
-    x_size = float(lines[0].split()[-3])
-    y_size = float(lines[0].split()[-2])
-    z_size = float(lines[0].split()[-1])
-    step_size_x = np.round(x_size / float(lines[0].split()[2]), 4)
-    step_size_y = np.round(y_size / float(lines[0].split()[3]), 4)
-    step_size_z = np.round(z_size / float(lines[0].split()[4]), 4)
+    field = None
+    if is_volume(file):
+        volume, field = read_volume(file)
+        lines = [sample_density_line(volume["num_steps"], volume["dimensions"])]
+    else:
+        with open(file) as f:
+            lines = f.readlines()
+
+    # save_numpy_as_dat ends the sample density with a semicolon
+    header = lines[0].replace(";", " ").split()
+    steps_x = 2 * int(header[2]) + 1
+    steps_y = 2 * int(header[3]) + 1
+    steps_z = 2 * int(header[4]) + 1
+    x_size = float(header[-3])
+    y_size = float(header[-2])
+    z_size = float(header[-1])
+    step_size_x = np.round(x_size / float(header[2]), 4)
+    step_size_y = np.round(y_size / float(header[3]), 4)
+    step_size_z = np.round(z_size / float(header[4]), 4)
 
     meta_dict = {
         "first_line": lines[0],
@@ -134,35 +247,13 @@ def read_mat(file, meta_data=False, verbose=False):
         return meta_dict
 
     else:
-        steps_x = 2 * int(lines[0].split()[2]) + 1
-        steps_y = 2 * int(lines[0].split()[3]) + 1
-        steps_z = 2 * int(lines[0].split()[4]) + 1
-        mat = np.zeros((steps_x, steps_y, steps_z, 3))
-        #print(mat.shape)
-        
-        for ind, i in enumerate(lines[7:]):
-            line_split = i.split()
-            # print(i)
-            mat[
-                int(ind / (steps_z * steps_y)),
-                int(ind / steps_z % steps_y),
-                ind % steps_z,
-                0,
-            ] = float(line_split[-3])
-            mat[
-                int(ind / (steps_z * steps_y)),
-                int(ind / steps_z % steps_y),
-                ind % steps_z,
-                1,
-            ] = float(line_split[-2])
-            mat[
-                int(ind / (steps_z * steps_y)),
-                int(ind / steps_z % steps_y),
-                ind % steps_z,
-                2,
-            ] = float(line_split[-1])
-
-        return mat
+        # points run over z fastest, then y, then x
+        if field is not None:
+            # a view of the memory map, float16 fields are widened for arithmetic
+            mat = field[:, -3:].astype(np.float32, copy=False)
+        else:
+            mat = np.loadtxt(lines[7:], ndmin=2)[:, -3:]
+        return mat.reshape(steps_x, steps_y, steps_z, 3)
 
 
 def default_options_initializer(options): 
@@ -192,6 +283,18 @@ def default_options_initializer(options):
     if "profile" not in options.keys():
         options["profile"] = False
 
+    if "field_method" not in options.keys():
+        options["field_method"] = "exact"
+
+    if "integrator" not in options.keys():
+        options["integrator"] = "euler"
+
+    if "integrator_tol" not in options.keys():
+        options["integrator_tol"] = 1e-4
+
+    if "analytic_curvature" not in options.keys():
+        options["analytic_curvature"] = False
+
     return options
 
 
@@ -254,7 +357,25 @@ def filter_radius(x, Q, center, radius=2.0):
     return x_filtered, Q_filtered
 
 
-def filter_radius_whole_residue(x, Q, resids, resnums, center, radius=2.0):
+def residue_groups(resids, resnums):
+    """
+    Numbers the residues of a structure, a new residue starts wherever the residue
+    name or number changes from the previous atom. Residues with the same number but
+    a different name are not adjacent and get their own group
+    Takes
+        resids(array) - residue ids/names of shape (N,)
+        resnums(array) - residue numbers of shape (N,)
+    Returns
+        groups(array) - residue group of every atom of shape (N,)
+    """
+    resids = np.asarray(resids)
+    resnums = np.asarray(resnums)
+    change = np.ones(len(resids), dtype=bool)
+    change[1:] = (resids[1:] != resids[:-1]) | (resnums[1:] != resnums[:-1])
+    return np.cumsum(change) - 1
+
+
+def filter_radius_whole_residue(x, Q, resids, resnums, center, radius=2.0, groups=None):
     """
     Filters out entire residues that have any points that fall outside of the radius
     Takes
@@ -264,43 +385,20 @@ def filter_radius_whole_residue(x, Q, resids, resnums, center, radius=2.0):
         resnums(array) - residue numbers of shape (N,)
         center(array) - center of box of shape (1,3)
         radius(float) - radius to filter
+        groups(array) - residue_groups of resids and resnums, computed if None
     """
     x_recentered = x - center
     is_in_radius = np.linalg.norm(x_recentered, axis=1) < radius
-    resid_current = None
-    resnum_current = None
-    true_res_dict = {}
     print(x_recentered.shape)
     print(Q.shape)
-    print(resids.shape)
-    print(resnums.shape)
-    j = 0
-    #Generate dictionary of indices. Accounts for residues that have the same resnum but different resid, as those aren't adjacent
-    for i in range(len(resids)):
-        if resids[i] == resid_current and resnums[i] == resnum_current:
-            current_entry = true_res_dict[j - 1]
-            current_entry["indices"].append(i)
-            if is_in_radius[i]:
-                current_entry["is_in_radius"] = True
-        else:
-            true_res_dict[j] = {
-                "resid": resids[i],
-                "resnum": resnums[i],
-                "indices": [i],
-                "is_in_radius": is_in_radius[i]
-            }
-            resid_current = resids[i]
-            resnum_current = resnums[i]
-            j += 1
-    #Compress true_res_dict into a list of indices to filter out
-    indices_to_filter_out = [
-        k
-        for key in true_res_dict
-        if not true_res_dict[key]["is_in_radius"]
-        for k in true_res_dict[key]["indices"]
-    ]
-    x_filtered = np.delete(x, indices_to_filter_out, axis=0)
-    Q_filtered = np.delete(Q, indices_to_filter_out, axis=0)
+    print(np.shape(resids))
+    print(np.shape(resnums))
+    if groups is None:
+        groups = residue_groups(resids, resnums)
+    # a residue is kept whole if any of its atoms is in the radius
+    keep = np.bincount(groups, weights=is_in_radius)[groups] > 0
+    x_filtered = x[keep]
+    Q_filtered = Q[keep]
     print("radius filter leaves: {}".format(len(Q_filtered)))
     # print(np.linalg.norm(x_filtered, axis=1))
     return x_filtered, Q_filtered
@@ -401,93 +499,174 @@ def filter_atom_num(x, Q, atom_num_list, filter_list):
     return x_filtered, Q_filtered
 
 
+# widest record decoded, columns past the end of a line read as blanks
+RECORD_WIDTH = 80
+
+
+def atom_records(data):
+    """
+    Fixed width view of the ATOM and HETATM records of a pdb or pqr file
+    Takes
+        data(bytes) - contents of the file
+    Returns
+        records(array) - uint8 array of shape (N, RECORD_WIDTH), one row per atom,
+            lines padded with blanks
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(buf == ord("\n"))
+    if len(buf) and buf[-1] != ord("\n"):
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate(([0], ends[:-1] + 1)).astype(np.int64)
+    padded = np.concatenate((buf, np.full(RECORD_WIDTH, ord(" "), dtype=np.uint8)))
+    head = padded[np.minimum(starts[:, None] + np.arange(6), len(buf))]
+    # a blank for bytes past the end of short lines
+    head[starts[:, None] + np.arange(6) >= ends[:, None]] = ord(" ")
+    keep = np.all(head[:, :4] == np.frombuffer(b"ATOM", dtype=np.uint8), axis=1)
+    keep |= np.all(head == np.frombuffer(b"HETATM", dtype=np.uint8), axis=1)
+    starts, ends = starts[keep], ends[keep]
+    # rows of a sliding window over the file, one copy of RECORD_WIDTH bytes per atom
+    records = np.lib.stride_tricks.sliding_window_view(padded, RECORD_WIDTH)[starts]
+    records[np.arange(RECORD_WIDTH) >= (ends - starts)[:, None]] = ord(" ")
+    records[records == ord("\r")] = ord(" ")
+    return records
+
+
+def decode_numbers(field):
+    """
+    Decodes a fixed width column of numbers, one per row, like float() would
+    Takes
+        field(array) - uint8 array of shape (N, W)
+    Returns
+        values(array) - float64 array of shape (N,)
+    """
+    field = np.ascontiguousarray(field)
+    return field.view("S{}".format(field.shape[1])).reshape(-1).astype(np.float64)
+
+
+def decode_strings(field):
+    """
+    Takes
+        field(array) - uint8 array of shape (N, W)
+    Returns
+        values(array) - str array of shape (N,) without surrounding blanks
+    """
+    field = np.ascontiguousarray(field)
+    return np.char.strip(field.view("S{}".format(field.shape[1])).reshape(-1).astype(str))
+
+
 def parse_pqr(path_to_pqr):
     """
     Parses pqr file to obtain charges and positions of charges (beta, removes charges that are 0)
     Takes
         path_to_pqr(str) - path to pqr file
-        ret_atom_names(bool) - whether to return atom names
-        ret_residue_names(bool) - whether to return residue names
     Returns
         np.array(x)(array) - coordinates of charges of shape (N,3)
         np.array(Q).reshape(-1,1) - magnitude and sign of charges of shape (N,1)
+        ret_atom_num(array) - atom numbers
+        res_name(array) - residue names
+        res_num(array) - residue numbers
+        atom_type(array) - atom names
     """
-    x = []
-    Q = []
-    ret_atom_num = []
-    res_name = []
-    res_num = []
-    atom_type = []
-
-    with open(path_to_pqr) as pqr_file:
-        lines = pqr_file.readlines()
-
-    for line in lines:
-        if line.startswith("ATOM") or line.startswith("HETATM"):
-            shift = 0
-            res_ind = 5  # index of residue number
-            split_tf = False
-            if len(line.split()[0]) > 6:
-                res_ind = 4
-                split_tf = True
-
-            if split_tf:
-                # remove HETATM from split 0
-                ret_atom_num.append(int(line.split()[0][6:]))
-                res_name.append(line.split()[2])
-                atom_type.append(line.split()[1])
-                
-            else:
-                ret_atom_num.append(int(line.split()[1]))
-                res_name.append(line.split()[3])
-                atom_type.append(line.split()[2])        
-
-            if len(line.split()[res_ind]) > 4:
-                res_val = int(line.split()[res_ind - 1][1:])
-            else:
-                res_val = int(line.split()[res_ind])
-
-            res_num.append(res_val)
+    with open(path_to_pqr, "rb") as pqr_file:
+        records = atom_records(pqr_file.read())
+    return parse_pqr_records(records)
 
-            if res_val > 999:
-                shift += int(np.log10(res_val) - 2)
 
-            coords = [
-                line[30 + shift : 38 + shift],
-                line[38 + shift : 46 + shift],
-                line[46 + shift : 54 + shift],
-            ]
+def pqr_dots(records):
+    """
+    Residue numbers above 999 push the coordinate columns of pqr files right, the
+    columns are located from the decimal point of x instead
+    Takes
+        records(array) - fixed width atom records from atom_records
+    Returns
+        dot(array) - column of the decimal point of x of every record
+    """
+    return 30 + np.argmax(records[:, 30:] == ord("."), axis=1)
 
-            if shift == -1:
-                print("----------------------")
-                print("coords: ", coords)
 
-            coords = [_.strip() for _ in coords]
-            charge = line[54 + shift : 61 + shift]
+def pqr_column(records, dot, offset, width):
+    """
+    Takes
+        records(array) - fixed width atom records from atom_records
+        dot(array) - pqr_dots of the records, or any column per record the offset is relative to
+        offset(int) - first column relative to dot
+        width(int) - width of the column
+    Returns
+        field(array) - uint8 array of shape (N, width)
+    """
+    index = np.minimum(dot[:, None] + offset + np.arange(width), RECORD_WIDTH - 1)
+    return records[np.arange(len(records))[:, None], index]
 
-            if shift == -1:
-                print("charge: ", [charge])
 
-            charge = charge.strip()
+def pqr_serials(records):
+    """
+    Serials of 100000 and above run into the record name of pqr files, or push the
+    rest of the record right. The serial is the first token after ATOM or HETATM
+    instead of columns 6 to 11
+    Takes
+        records(array) - fixed width atom records from atom_records
+    Returns
+        field(array) - uint8 array of shape (N, 16), the serial padded with blanks
+        shift(array) - columns the serial pushes the atom name and residue right by
+    """
+    field = records[:, 4:20].copy()
+    columns = np.arange(field.shape[1])
+    # ATOM ends at column 4, HETATM at column 6
+    start = np.where(records[:, 0] == ord("A"), 0, 2)
+    filled = (field != ord(" ")) & (columns >= start[:, None])
+    first = np.argmax(filled, axis=1)
+    blank = ~filled & (columns > first[:, None])
+    end = np.where(blank.any(axis=1), np.argmax(blank, axis=1), field.shape[1])
+    field[(columns < first[:, None]) | (columns >= end[:, None])] = ord(" ")
+    # serials end at column 11
+    shift = np.maximum(end + 4 - 11, 0)
+    return field, shift
+
+
+def pqr_coordinates(records, dot=None):
+    """
+    Takes
+        records(array) - fixed width atom records from atom_records
+        dot(array) - pqr_dots of the records, computed if None
+    Returns
+        x(array) - coordinates of shape (N,3)
+    """
+    if dot is None:
+        dot = pqr_dots(records)
+    return np.stack([decode_numbers(pqr_column(records, dot, -4 + 8 * i, 8)) for i in range(3)], axis=1)
 
-            try:
-                tempq = float(charge)
-                temp = [float(_) for _ in coords]
 
-            except:
-                print(
-                    f"Charge or coordinates is not a useable number. Check pqr file formatting for the following line: {line}"
-                )
+def pdb_coordinates(records, dtype="float32"):
+    """
+    Takes
+        records(array) - fixed width atom records from atom_records
+        dtype(str) - dtype of the coordinates
+    Returns
+        x(array) - coordinates of shape (N,3)
+    """
+    xyz = np.stack([decode_numbers(records[:, 30 + 8 * i : 38 + 8 * i]) for i in range(3)], axis=1)
+    return xyz.astype(dtype)
 
-            assert temp != [], "charge incorrectly parsed"
-            assert tempq != [], "coord incorrectly parsed"
-            x.append(temp)
-            Q.append(tempq)
-            # clear temp variables
-            temp = []
-            tempq = []
 
-    return np.array(x), np.array(Q).reshape(-1, 1), ret_atom_num, res_name, res_num, atom_type
+def parse_pqr_records(records):
+    """
+    Takes
+        records(array) - fixed width atom records from atom_records
+    Returns
+        the arrays of parse_pqr
+    """
+    dot = pqr_dots(records)
+    x = pqr_coordinates(records, dot)
+    Q = decode_numbers(pqr_column(records, dot, 20, 7)).reshape(-1, 1)
+    serial, shift = pqr_serials(records)
+    ret_atom_num = decode_numbers(serial).astype(int)
+    # residue number runs from column 22 up to the blanks before x
+    res_field = pqr_column(records, shift, 22, 9)
+    res_field[np.arange(9) >= (dot[:, None] - 8 - 22 - shift[:, None])] = ord(" ")
+    res_num = decode_numbers(res_field).astype(int)
+    atom_type = decode_strings(pqr_column(records, shift, 12, 4))
+    res_name = decode_strings(pqr_column(records, shift, 17, 3))
+    return x, Q, ret_atom_num, res_name, res_num, atom_type
 
 
 def parse_pdb(pdb_file_path, get_charges=False, float32=True):
@@ -499,57 +678,374 @@ def parse_pdb(pdb_file_path, get_charges=False, float32=True):
     Returns:
         atom_info(list of tuples) - containing information about each atom in the pdb file
     """
+    with open(pdb_file_path, "rb") as file:
+        records = atom_records(file.read())
+    return parse_pdb_records(records, get_charges, float32)
+
 
-    xyz = []
-    Q = []
-    atom_number = []
-    residue_name = []
-    residue_number = []
-    atom_type = []
+def parse_pdb_records(records, get_charges=False, float32=True):
+    """
+    Takes
+        records(array) - fixed width atom records from atom_records
+        get_charges(bool) - whether to parse/return charges
+        float32(bool) - single instead of double precision arrays
+    Returns
+        the arrays of parse_pdb
+    """
     if float32:
         dtype = "float32"
     else:
         dtype = "float64"
 
-    with open(pdb_file_path, "r") as file:
-        for line in file:
-            if line.startswith("ATOM") or line.startswith("HETATM"):
-                atom_number_line = int(line[6:11].strip())
-                atom_type_line = line[12:16].strip()
-                residue_name_line = line[17:20].strip()
-                residue_number_line = int(line[22:26].strip())
-                x = float(line[30:38].strip())
-                y = float(line[38:46].strip())
-                z = float(line[46:54].strip())
-                # atom_info.append((atom_number, atom_type, residue_name, residue_number, x, y, z))
-
-                xyz.append([x, y, z])
-                atom_number.append(atom_number_line)
-                residue_name.append(residue_name_line)
-                residue_number.append(residue_number_line)
-                atom_type.append(atom_type_line)
-
-                if get_charges:
-                    Q.append(float(line[55:64].strip()))
+    xyz = pdb_coordinates(records, dtype)
+    atom_number = decode_numbers(records[:, 6:11])
+    residue_name = decode_strings(records[:, 17:20])
+    residue_number = decode_numbers(records[:, 22:26]).astype(int)
+    atom_type = decode_strings(records[:, 12:16])
 
     if get_charges:
+        Q = decode_numbers(records[:, 55:64])
         return (
-            np.array(xyz, dtype=dtype),
-            np.array(Q, dtype=dtype).reshape(-1, 1),
-            np.array(atom_number, dtype=dtype),
-            np.array(residue_name),
-            np.array(residue_number),
-            np.array(atom_type),
+            xyz,
+            Q.astype(dtype).reshape(-1, 1),
+            atom_number.astype(dtype),
+            residue_name,
+            residue_number,
+            atom_type,
         )
     return (
-        np.array(xyz, dtype=dtype),
-        np.array(atom_number, dtype=dtype),
-        np.array(residue_name),
-        np.array(residue_number),
-        np.array(atom_type),
+        xyz,
+        atom_number.astype(dtype),
+        residue_name,
+        residue_number,
+        atom_type,
     )
 
 
+# structure files read directly, compressed or not, and archives of them
+STRUCTURE_SUFFIXES = (".pdb", ".pqr", ".pdb.gz", ".pqr.gz")
+ARCHIVE_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+
+def read_bytes(path):
+    """
+    Takes
+        path(str) - path to a file, gzip compressed if it ends with .gz
+    Returns
+        data(bytes) - contents of the file, decompressed
+    """
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            return f.read()
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def is_archive(path):
+    return path.endswith(ARCHIVE_SUFFIXES)
+
+
+def archive_members(path, keep=None):
+    """
+    Yields the name and contents of every pdb or pqr member of a tar archive in
+    archive order. The archive is read as a stream, nothing is extracted to disk and
+    members ending with .gz are decompressed
+    Takes
+        path(str) - path to a tar archive, compressed or not
+        keep(callable) - called with the name of every member, members it returns
+            False for are skipped without reading their contents
+    """
+    with tarfile.open(path, "r|*") as archive:
+        for member in archive:
+            if not member.isfile() or not member.name.endswith(STRUCTURE_SUFFIXES):
+                continue
+            if keep is not None and not keep(member.name):
+                continue
+            data = archive.extractfile(member).read()
+            if member.name.endswith(".gz"):
+                data = gzip.decompress(data)
+            yield member.name, data
+
+
+# bumped when the parsed arrays change, sidecars of other versions are parsed again
+PARSE_CACHE_VERSION = 2
+
+
+def parse_structure(path, cache=False, data=None):
+    """
+    Parses the charges, positions and atom information of a pdb or pqr file, as
+    used by the calculator. With cache, the arrays are kept in a sidecar file next to
+    the structure, path + ".cpet.npz", and read back while the file is unchanged:
+    same size and modification time, or same size and contents after a copy or touch
+    Takes
+        path(str) - path to pdb or pqr file, gzip compressed if it ends with .gz
+        cache(bool) - whether to read and write the sidecar cache
+        data(bytes) - contents of the file, like a member of an archive, parsed
+            instead of reading path and without the cache
+    Returns
+        x, Q, atom_number, residue_name, residue_number, atom_type (arrays)
+    """
+    if data is not None:
+        return parse_structure_data(path, data)
+    names = ("x", "Q", "atom_number", "residue_name", "residue_number", "atom_type")
+    sidecar = path + ".cpet.npz"
+    stat = os.stat(path)
+    digest = None
+    if cache and os.path.exists(sidecar):
+        try:
+            with np.load(sidecar) as cached:
+                key = cached["key"]
+                if int(cached["version"]) != PARSE_CACHE_VERSION:
+                    raise ValueError("parse cache of another version")
+                if key[0] == stat.st_size and key[1] == stat.st_mtime_ns:
+                    return tuple(cached[name] for name in names)
+                if key[0] == stat.st_size:
+                    data = read_bytes(path)
+                    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+                    if str(cached["digest"]) == digest:
+                        return tuple(cached[name] for name in names)
+        except (OSError, KeyError, ValueError):
+            # unreadable or older sidecar, parsed again and overwritten
+            pass
+
+    if data is None:
+        data = read_bytes(path)
+    parsed = parse_structure_data(path, data)
+
+    if cache:
+        if digest is None:
+            digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        try:
+            # written under a temporary name first, readers never see a partial sidecar
+            tmp = "{}.{}.tmp.npz".format(sidecar[: -len(".npz")], os.getpid())
+            np.savez(
+                tmp,
+                key=np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64),
+                digest=np.array(digest),
+                version=np.array(PARSE_CACHE_VERSION),
+                **dict(zip(names, parsed)),
+            )
+            os.replace(tmp, sidecar)
+        except OSError as error:
+            warnings.warn("could not write parse cache {}: {}".format(sidecar, error))
+    return parsed
+
+
+def parse_structure_data(path, data):
+    """
+    Takes
+        path(str) - name of the pdb or pqr file, tells the format
+        data(bytes) - contents of the file
+    Returns
+        x, Q, atom_number, residue_name, residue_number, atom_type (arrays)
+    """
+    records = atom_records(data)
+    if ".pqr" in path:
+        return parse_pqr_records(records)
+    return parse_pdb_records(records, get_charges=True)
+
+
+class Trajectory:
+    """
+    Multi-MODEL pdb or pqr file read one model at a time. The atom information is
+    parsed once from the first model, later models only decode their coordinates.
+    Values derived from the atom information alone, like filter masks and atom
+    selections, are kept with cached so the calculators of every frame share them. A
+    file without MODEL records is a trajectory of one frame
+    Takes
+        path(str) - path to pdb or pqr file, read whole if gzip compressed
+        data(bytes) - contents of the file, like a member of an archive, read
+            instead of path
+    """
+
+    def __init__(self, path, data=None):
+        self.path = path
+        self.pqr = ".pqr" in path
+        self.dtype = "float64" if self.pqr else "float32"
+        self.cache = {}
+        self.file = None
+        if data is None and path.endswith(".gz"):
+            data = read_bytes(path)
+        if data is not None:
+            # bytes have the find and slicing of the memory map
+            self.map = data
+        else:
+            self.file = open(path, "rb")
+            if os.fstat(self.file.fileno()).st_size == 0:
+                self.file.close()
+                raise ValueError("{} is empty".format(path))
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        records = next(self.models(), None)
+        if records is None:
+            self.close()
+            raise ValueError("no ATOM or HETATM records in {}".format(path))
+        if self.pqr:
+            parsed = parse_pqr_records(records)
+        else:
+            parsed = parse_pdb_records(records, get_charges=True)
+        (
+            self.x_first,
+            self.Q,
+            self.atom_number,
+            self.residue_name,
+            self.residue_number,
+            self.atom_type,
+        ) = parsed
+        self.n_atoms = len(self.Q)
+
+    def models(self):
+        """
+        Yields the fixed width atom records of every model in file order
+        """
+        pos = 0
+        while pos < len(self.map):
+            end = self.map.find(b"ENDMDL", pos)
+            stop = len(self.map) if end == -1 else end
+            records = atom_records(self.map[pos:stop])
+            pos = stop + len(b"ENDMDL")
+            if len(records):
+                yield records
+
+    def frames(self):
+        """
+        Yields the frame number, counted from 1 in file order, and the coordinates of
+        shape (N,3) of every model
+        """
+        for frame, records in enumerate(self.models(), start=1):
+            if frame == 1:
+                x = self.x_first
+            elif self.pqr:
+                x = pqr_coordinates(records)
+            else:
+                x = pdb_coordinates(records, self.dtype)
+            if len(x) != self.n_atoms:
+                raise ValueError(
+                    "model {} of {} has {} atoms, the first model has {}".format(
+                        frame, self.path, len(x), self.n_atoms
+                    )
+                )
+            yield frame, x
+
+    def cached(self, key, fn):
+        """
+        Value of fn() computed on the first call for key. Calculators of frames loaded
+        at once may both compute it, they get the same value
+        Takes
+            key(hashable) - name of the value, including the options it depends on
+            fn(callable) - computes the value from the atom information
+        """
+        if key not in self.cache:
+            self.cache[key] = fn()
+        return self.cache[key]
+
+    def close(self):
+        if self.file is not None:
+            self.map.close()
+            self.file.close()
+            self.file = None
+        self.map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DCDTrajectory(Trajectory):
+    """
+    DCD binary trajectory (CHARMM or NAMD) paired with a pqr or pdb file holding the
+    charges and atom information of its atoms. Frames are memory-mapped, only the
+    pages of the frame being read are loaded
+    Takes
+        path(str) - path to dcd file
+        topology(str) - path to pqr or pdb file with the same atoms in the same order
+    """
+
+    def __init__(self, path, topology):
+        self.path = path
+        self.topology = topology
+        self.cache = {}
+        self.map = None
+        (
+            _,
+            self.Q,
+            self.atom_number,
+            self.residue_name,
+            self.residue_number,
+            self.atom_type,
+        ) = parse_structure(topology)
+        self.n_atoms = len(self.Q)
+        self.dtype = "float64" if ".pqr" in topology else "float32"
+
+        with open(path, "rb") as f:
+            head = f.read(4)
+            # fortran records start with their length, 84 for the header
+            if np.frombuffer(head, dtype="<i4")[0] == 84:
+                endian = "<"
+            elif np.frombuffer(head, dtype=">i4")[0] == 84:
+                endian = ">"
+            else:
+                raise ValueError("{} is not a dcd file with 32 bit record markers".format(path))
+            header = f.read(84)
+            if header[:4] != b"CORD":
+                raise ValueError("{} is not a dcd coordinate file".format(path))
+            icntrl = np.frombuffer(header[4:84], dtype=endian + "i4")
+            f.read(4)
+            # title record, then the atom count
+            title_length = np.frombuffer(f.read(4), dtype=endian + "i4")[0]
+            f.seek(title_length + 4, os.SEEK_CUR)
+            f.read(4)
+            n_atoms = int(np.frombuffer(f.read(4), dtype=endian + "i4")[0])
+            f.read(4)
+            offset = f.tell()
+            size = os.fstat(f.fileno()).st_size
+
+        if icntrl[8] != 0:
+            raise ValueError("dcd files with fixed atoms are not supported")
+        if n_atoms != self.n_atoms:
+            raise ValueError(
+                "{} has {} atoms, {} has {}".format(path, n_atoms, topology, self.n_atoms)
+            )
+        # CHARMM files flag a unit cell record and a fourth dimension per frame
+        charmm = icntrl[19] != 0
+        records = []
+        if charmm and icntrl[10] != 0:
+            records.append(("cell", endian + "f8", 6))
+        records += [(axis, endian + "f4", n_atoms) for axis in "xyz"]
+        if charmm and icntrl[11] != 0:
+            records.append(("w", endian + "f4", n_atoms))
+        # every record is framed by its length in bytes
+        frame_dtype = np.dtype(
+            [
+                field
+                for name, value, count in records
+                for field in (
+                    (name + "_start", endian + "i4"),
+                    (name, value, (count,)),
+                    (name + "_end", endian + "i4"),
+                )
+            ]
+        )
+        # frames of a file cut short by a crash are left out
+        n_frames = (size - offset) // frame_dtype.itemsize
+        self.frames_map = np.memmap(path, dtype=frame_dtype, mode="r", offset=offset, shape=(n_frames,))
+        self.n_frames = n_frames
+
+    def frames(self):
+        """
+        Yields the frame number, counted from 1, and the coordinates of shape (N,3)
+        of every frame
+        """
+        for frame in range(self.n_frames):
+            record = self.frames_map[frame]
+            x = np.stack((record["x"], record["y"], record["z"]), axis=1)
+            yield frame + 1, x.astype(self.dtype)
+
+    def close(self):
+        self.frames_map = None
+
+
 def calculate_center(coordinates, method):
     """
     Helper to calculate the center of a list of atoms
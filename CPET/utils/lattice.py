@@ -0,0 +1,167 @@
+import numpy as np
+
+"""
+Cached field lattice for streamline propagation
+
+The field is sampled on a lattice over the box, filled lazily: the 4x4x4 node
+stencil of a cell is only evaluated the first time a streamline enters that
+cell, and kept afterwards. Inside a cell the field is interpolated tricubically
+(cubic Lagrange in each direction). When a cell is first visited the
+interpolant is checked against the field at the cell center; if the relative
+error exceeds the tolerance, the points in that cell are sent to a lattice
+with half the spacing, up to max_level refinements.
+"""
+
+
+class _Store:
+    """
+    Lazily filled values indexed by flat lattice index, dense for small lattices
+    and kept as sorted keys otherwise
+    """
+
+    def __init__(self, size, n_components, dense_limit=2**21):
+        self.dense = size <= dense_limit
+        self.n_components = n_components
+        if self.dense:
+            self.present = np.zeros(size, dtype=bool)
+            self.values = np.zeros((size, n_components))
+        else:
+            self.keys = np.zeros(0, dtype=np.int64)
+            self.values = np.zeros((0, n_components))
+
+    def _find(self, keys):
+        idx = np.searchsorted(self.keys, keys)
+        idx_clipped = np.minimum(idx, len(self.keys) - 1)
+        found = (idx < len(self.keys)) & (self.keys[idx_clipped] == keys)
+        return found, idx_clipped
+
+    def contains(self, keys):
+        if self.dense:
+            return self.present[keys]
+        if len(self.keys) == 0:
+            return np.zeros(keys.shape, dtype=bool)
+        return self._find(keys)[0]
+
+    def insert(self, keys, values):
+        if self.dense:
+            self.present[keys] = True
+            self.values[keys] = values
+            return
+        keys = np.concatenate((self.keys, keys))
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.values = np.concatenate((self.values, values))[order]
+
+    def get(self, keys):
+        if self.dense:
+            return self.values[keys]
+        return self.values[self._find(keys)[1]]
+
+
+class FieldLattice:
+    def __init__(self, field_fn, half_widths, spacing=0.1, tol=1e-3, max_level=3):
+        """
+        Takes
+            field_fn(callable) - returns the electric field at a set of points of shape (L,3)
+            half_widths(array) - half widths of the region streamlines are integrated in of shape (3,)
+            spacing(float) - lattice spacing of the coarsest level
+            tol(float) - tolerated relative interpolation error at a cell center
+            max_level(int) - maximum number of times a cell is refined
+        """
+        self.field_fn = field_fn
+        self.tol = tol
+        self.max_level = max_level
+        half_widths = np.asarray(half_widths, dtype=np.float64)
+        # one ghost cell on each side keeps the cubic stencil inside the lattice
+        n_cells = np.ceil(2 * half_widths / spacing).astype(np.int64) + 2
+        self.origin = -half_widths - spacing
+        self.spacing = [spacing / 2**level for level in range(max_level + 1)]
+        self.n_nodes = [n_cells * 2**level + 1 for level in range(max_level + 1)]
+        self.nodes = [_Store(int(np.prod(n)), 3) for n in self.n_nodes]
+        # cells are keyed by their lowest corner node
+        self.cells = [_Store(int(np.prod(n)), 1) for n in self.n_nodes]
+        self.n_field_evaluations = 0
+
+    def _evaluate(self, points):
+        self.n_field_evaluations += len(points)
+        return self.field_fn(points)
+
+    def _flat(self, level, idx):
+        n = self.n_nodes[level]
+        return (idx[..., 0] * n[1] + idx[..., 1]) * n[2] + idx[..., 2]
+
+    def _stencil(self, level, cell_idx):
+        offsets = np.stack(
+            np.meshgrid(*[np.arange(-1, 3)] * 3, indexing="ij"), axis=-1
+        ).reshape(-1, 3)
+        return self._flat(level, cell_idx[:, np.newaxis, :] + offsets)
+
+    def _interpolate(self, level, points, cell_idx):
+        t = (points - self.origin) / self.spacing[level] - cell_idx
+        # cubic Lagrange weights on the nodes at -1, 0, 1, 2
+        w = np.stack(
+            (
+                -t * (t - 1) * (t - 2) / 6,
+                (t + 1) * (t - 1) * (t - 2) / 2,
+                -(t + 1) * t * (t - 2) / 2,
+                (t + 1) * t * (t - 1) / 6,
+            ),
+            axis=-1,
+        )
+        values = self.nodes[level].get(self._stencil(level, cell_idx)).reshape(
+            len(points), 4, 4, 4, 3
+        )
+        return np.einsum("la,lb,lc,labcm->lm", w[:, 0], w[:, 1], w[:, 2], values)
+
+    def _check_cells(self, level, cell_idx):
+        """
+        Fills the stencils of newly visited cells and flags the ones whose
+        interpolation error is above the tolerance
+        """
+        cell_keys, first = np.unique(
+            self._flat(level, cell_idx), return_index=True
+        )
+        cell_idx = cell_idx[first]
+        node_keys = np.unique(self._stencil(level, cell_idx))
+        node_keys = node_keys[~self.nodes[level].contains(node_keys)]
+        if len(node_keys):
+            n = self.n_nodes[level]
+            node_idx = np.stack(np.unravel_index(node_keys, tuple(n)), axis=-1)
+            self.nodes[level].insert(
+                node_keys, self._evaluate(self.origin + node_idx * self.spacing[level])
+            )
+        centers = self.origin + (cell_idx + 0.5) * self.spacing[level]
+        E_exact = self._evaluate(centers)
+        E_interp = self._interpolate(level, centers, cell_idx)
+        error = np.linalg.norm(E_interp - E_exact, axis=1) / np.linalg.norm(E_exact, axis=1)
+        refine = (error > self.tol) & (level < self.max_level)
+        self.cells[level].insert(cell_keys, refine.astype(np.float64).reshape(-1, 1))
+
+    def field(self, points):
+        """
+        Interpolated electric field at a set of points
+        Takes
+            points(array) - positions to compute field at of shape (L,3)
+        Returns
+            E(array) - electric field at the points of shape (L,3)
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        E = np.zeros_like(points)
+        todo = np.arange(len(points))
+        for level in range(self.max_level + 1):
+            if len(todo) == 0:
+                break
+            cell_idx = np.floor((points[todo] - self.origin) / self.spacing[level]).astype(
+                np.int64
+            )
+            # points that stray past the lattice are extrapolated from the edge cells
+            cell_idx = np.clip(cell_idx, 1, self.n_nodes[level] - 3)
+            cell_keys = self._flat(level, cell_idx)
+            unseen = ~self.cells[level].contains(cell_keys)
+            if np.any(unseen):
+                self._check_cells(level, cell_idx[unseen])
+            refine = self.cells[level].get(cell_keys)[:, 0] > 0
+            done = ~refine
+            E[todo[done]] = self._interpolate(level, points[todo[done]], cell_idx[done])
+            todo = todo[refine]
+        return E
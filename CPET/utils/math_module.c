@@ -251,105 +251,363 @@ void einsum_ij_i(int rows, int cols, float A[rows][cols], float ret[rows]){
 }
 
 
-void calc_field(float E[3], float x_init[3], int n_charges, float x[n_charges][3], float Q[n_charges]){
-    // calculate the field
+// team size of the parallel regions of the field and streamline kernels, 0 leaves it
+// to OpenMP. Set once per process by the pool layout, so pool workers do not each
+// start a team of every core, and a team of 1 opens no parallel region at all
+static int native_threads = 0;
 
-    // subtract x_init from x
-    float R[n_charges][3];
-    float r_mag[n_charges];
-    float E_array[3];
-    float r_sq[n_charges][3];
-    float r_mag_sq[n_charges];
-    
-    // make R a 2D array
-    for (int j = 0; j < 3; j++)
+
+void set_native_threads(int n_threads){
+    native_threads = n_threads > 0 ? n_threads : 0;
+}
+
+
+int get_native_threads(void){
+    return native_threads > 0 ? native_threads : omp_get_max_threads();
+}
+
+
+int get_native_threads_setting(void){
+    // team size as set, 0 when it is left to OpenMP
+    return native_threads;
+}
+
+
+// the field of a point is summed in blocks of FIELD_BLOCK charges, each block by a
+// single thread into its own partial sum, and the partial sums are added in block
+// order, so the result does not depend on the number of threads
+# define FIELD_BLOCK 4096
+// partial sums are kept on the stack up to this many blocks and on the heap beyond
+# define FIELD_STACK_BLOCKS 64
+
+
+static inline void field_block_sum(double sum[3], int b, float x_init[3], int n_charges, float x[n_charges][3], float Q[n_charges]){
+    // field of the charges of block b at x_init, without the Coulomb factor
+    int c_start = b * FIELD_BLOCK;
+    int c_end = c_start + FIELD_BLOCK < n_charges ? c_start + FIELD_BLOCK : n_charges;
+    float p_0 = x_init[0];
+    float p_1 = x_init[1];
+    float p_2 = x_init[2];
+    float E_0 = 0.0f;
+    float E_1 = 0.0f;
+    float E_2 = 0.0f;
+
+    # pragma omp simd reduction(+:E_0, E_1, E_2)
+    for (int i = c_start; i < c_end; i++)
     {
-        float x_init_single = x_init[j];
-        //# pragma omp parallel for
-        for (int i = 0; i < n_charges; i++)
+        float R_0 = p_0 - x[i][0];
+        float R_1 = p_1 - x[i][1];
+        float R_2 = p_2 - x[i][2];
+        float r_inv = 1.0f / sqrtf(R_0 * R_0 + R_1 * R_1 + R_2 * R_2);
+        float weight = Q[i] * r_inv * r_inv * r_inv;
+        E_0 += weight * R_0;
+        E_1 += weight * R_1;
+        E_2 += weight * R_2;
+    }
+    sum[0] = E_0;
+    sum[1] = E_1;
+    sum[2] = E_2;
+}
+
+
+void calc_field_reduce(float E[3], float x_init[3], int n_charges, float x[n_charges][3], float Q[n_charges]){
+    // adds the field of all charges at x_init to E
+    float factor = 14.3996451;
+    int n_blocks = (n_charges + FIELD_BLOCK - 1) / FIELD_BLOCK;
+    double stack_sums[FIELD_STACK_BLOCKS][3];
+    double (*sums)[3] = n_blocks <= FIELD_STACK_BLOCKS ? stack_sums : malloc((size_t)n_blocks * sizeof(*sums));
+    double total[3] = {0.0, 0.0, 0.0};
+    int team = get_native_threads();
+
+    if (sums == NULL)
+    {
+        // no room for the partial sums, the blocks are summed serially in the same order
+        for (int b = 0; b < n_blocks; b++)
         {
-            R[i][j] = x_init_single - x[i][j];
-            r_sq[i][j] = pow(R[i][j], 2);
+            double sum[3];
+            field_block_sum(sum, b, x_init, n_charges, x, Q);
+            total[0] += sum[0];
+            total[1] += sum[1];
+            total[2] += sum[2];
         }
     }
-    
-    einsum_ij_i(n_charges, 3, r_sq, r_mag_sq); // r_mag_sq might be wrong shape here
-    
-    //# pragma omp parallel for
-    for (int i = 0; i < n_charges; i++)
+    else
     {
-        // elementwise raise to -3/2
-        r_mag[i] = pow(r_mag_sq[i], -1.5); // if this is zero then we have a problem
+        # pragma omp parallel for schedule(static) num_threads(team) if (n_blocks > 1 && team > 1)
+        for (int b = 0; b < n_blocks; b++)
+        {
+            field_block_sum(sums[b], b, x_init, n_charges, x, Q);
+        }
+
+        for (int b = 0; b < n_blocks; b++)
+        {
+            total[0] += sums[b][0];
+            total[1] += sums[b][1];
+            total[2] += sums[b][2];
+        }
+        if (sums != stack_sums)
+        {
+            free(sums);
+        }
     }
-    
-    // compute einsum operation
-    einsum_operation(n_charges, r_mag, Q, R, E_array); //
+    E[0] += factor * total[0];
+    E[1] += factor * total[1];
+    E[2] += factor * total[2];
+}
 
-    E[0] = E_array[0] ;
-    E[1] = E_array[1] ;
-    E[2] = E_array[2] ;
 
+void calc_field(float E[3], float x_init[3], int n_charges, float x[n_charges][3], float Q[n_charges]){
+    // calculate the field
+    E[0] = 0.0;
+    E[1] = 0.0;
+    E[2] = 0.0;
+    calc_field_reduce(E, x_init, n_charges, x, Q);
 }
 
 
 void calc_field_base(float E[3], float x_init[3], int n_charges, float x[n_charges][3], float Q[n_charges]){
-    // calculate the field
+    // calculate the field, added to E
+    calc_field_reduce(E, x_init, n_charges, x, Q);
+}
 
-    // subtract x_init from x
-    float R[3];
-    float r_mag[n_charges];
-    //float r_sq[n_charges][3];
-    //float r_mag_sq[n_charges];
-    float r_mag_cube;
-    float factor = 14.3996451;
-    float r_norm;
-    float E_temp[n_charges][3];
 
-    //# pragma omp parallel for shared(E, x_init, n_charges, x, Q) private(r_mag_cube, r_norm, R)
-    # pragma omp parallel for
-    for (int i = 0; i < n_charges; i++)
+// integrators selectable in the streamline kernels
+# define INTEGRATOR_EULER 0
+# define INTEGRATOR_RK4 1
+# define INTEGRATOR_RK45 2
+
+// Cash-Karp embedded 5(4) pair used by INTEGRATOR_RK45
+static const float CK_A[6][5] = {
+    {0.0f, 0.0f, 0.0f, 0.0f, 0.0f},
+    {1.0f / 5.0f, 0.0f, 0.0f, 0.0f, 0.0f},
+    {3.0f / 40.0f, 9.0f / 40.0f, 0.0f, 0.0f, 0.0f},
+    {3.0f / 10.0f, -9.0f / 10.0f, 6.0f / 5.0f, 0.0f, 0.0f},
+    {-11.0f / 54.0f, 5.0f / 2.0f, -70.0f / 27.0f, 35.0f / 27.0f, 0.0f},
+    {1631.0f / 55296.0f, 175.0f / 512.0f, 575.0f / 13824.0f, 44275.0f / 110592.0f, 253.0f / 4096.0f}
+};
+static const float CK_B5[6] = {37.0f / 378.0f, 0.0f, 250.0f / 621.0f, 125.0f / 594.0f, 0.0f, 512.0f / 1771.0f};
+static const float CK_B4[6] = {2825.0f / 27648.0f, 0.0f, 18575.0f / 48384.0f, 13525.0f / 55296.0f, 277.0f / 14336.0f, 1.0f / 4.0f};
+
+
+void direction_base(float D[3], float point[3], int n_charges, float x[n_charges][3], float Q[n_charges]){
+    // unit vector along the field at a point
+    float E_norm;
+
+    // calc_field_base accumulates into its output
+    D[0] = 0.0;
+    D[1] = 0.0;
+    D[2] = 0.0;
+    calc_field_base(D, point, n_charges, x, Q);
+    norm(D, &E_norm);
+    for (int i = 0; i < 3; i++)
     {
-        //get difference of x and x_init
-        R[0] = x_init[0] - x[i][0];
-        R[1] = x_init[1] - x[i][1];
-        R[2] = x_init[2] - x[i][2]; 
+        D[i] = D[i] / E_norm;
+    }
+}
+
 
-        r_norm = sqrt(pow(R[0], 2) + pow(R[1], 2) + pow(R[2], 2));
-        r_mag_cube = pow(r_norm, -3);
-        //r_mag[i] = pow(r_norm, -3);
+void propagate_topo(float result[3], float x_init[3], int n_charges, float x[n_charges][3], float Q[n_charges], float step_size, int integrator){
+    // propagate the topology one fixed step, forward Euler or classical RK4
+    float k_1[3];
+    float k_2[3];
+    float k_3[3];
+    float k_4[3];
+    float stage[3];
 
-        E_temp[i][0] = factor * r_mag_cube * Q[i] * R[0];
-        E_temp[i][1] = factor * r_mag_cube * Q[i] * R[1];
-        E_temp[i][2] = factor * r_mag_cube * Q[i] * R[2];
+    direction_base(k_1, x_init, n_charges, x, Q);
+    if (integrator == INTEGRATOR_EULER)
+    {
+        for (int i = 0; i < 3; i++)
+        {
+            result[i] = x_init[i] + step_size * k_1[i];
+        }
+        return;
+    }
+
+    for (int i = 0; i < 3; i++) stage[i] = x_init[i] + 0.5f * step_size * k_1[i];
+    direction_base(k_2, stage, n_charges, x, Q);
+    for (int i = 0; i < 3; i++) stage[i] = x_init[i] + 0.5f * step_size * k_2[i];
+    direction_base(k_3, stage, n_charges, x, Q);
+    for (int i = 0; i < 3; i++) stage[i] = x_init[i] + step_size * k_3[i];
+    direction_base(k_4, stage, n_charges, x, Q);
+    for (int i = 0; i < 3; i++)
+    {
+        result[i] = x_init[i] + step_size / 6.0f * (k_1[i] + 2.0f * k_2[i] + 2.0f * k_3[i] + k_4[i]);
     }
+}
+
+
+float rk45_step(float result[3], float x_init[3], int n_charges, float x[n_charges][3], float Q[n_charges], float h){
+    // one Cash-Karp step of size h, returns the norm of the embedded error estimate
+    float k[6][3];
+    float stage[3];
+    float err_sq = 0.0f;
+
+    for (int j = 0; j < 6; j++)
+    {
+        for (int i = 0; i < 3; i++)
+        {
+            stage[i] = x_init[i];
+            for (int m = 0; m < j; m++)
+            {
+                stage[i] += h * CK_A[j][m] * k[m][i];
+            }
+        }
+        direction_base(k[j], stage, n_charges, x, Q);
+    }
+    for (int i = 0; i < 3; i++)
+    {
+        float y_5 = x_init[i];
+        float e = 0.0f;
+        for (int j = 0; j < 6; j++)
+        {
+            y_5 += h * CK_B5[j] * k[j][i];
+            e += h * (CK_B5[j] - CK_B4[j]) * k[j][i];
+        }
+        result[i] = y_5;
+        err_sq += e * e;
+    }
+    return sqrtf(err_sq);
+}
+
+
+bool adaptive_step_control(float err, float tol, float h_try, float step_size, bool inside, float *h_next){
+    // decides whether an adaptive step is kept and sets the size of the next one;
+    // steps leaving the box are only kept once no longer than step_size, so the
+    // overshoot past the walls is bounded as for the fixed step integrators
+    float h_min = 1e-3f * step_size;
+    float factor = err > 0.0f ? 0.9f * powf(tol / err, 0.2f) : 5.0f;
+    factor = fminf(5.0f, fmaxf(0.2f, factor));
+
+    if (err > tol && h_try > h_min)
+    {
+        *h_next = fmaxf(h_try * factor, h_min);
+        return false;
+    }
+    if (!inside && h_try > step_size)
+    {
+        *h_next = fmaxf(0.5f * h_try, step_size);
+        return false;
+    }
+    *h_next = fmaxf(h_try * factor, h_min);
+    return true;
+}
+
+
+void calc_field_gradient(float E[3], float J[3][3], float point[3], int n_charges, float x[n_charges][3], float Q[n_charges]){
+    // field and its Jacobian J[a][b] = dE_a/dx_b at a point
+    float factor = 14.3996451;
+    float E_0 = 0.0, E_1 = 0.0, E_2 = 0.0;
+    float J_00 = 0.0, J_11 = 0.0, J_22 = 0.0, J_01 = 0.0, J_02 = 0.0, J_12 = 0.0;
 
     for (int i = 0; i < n_charges; i++)
     {
-        E[0] += E_temp[i][0];
-        E[1] += E_temp[i][1];
-        E[2] += E_temp[i][2];
+        float R_0 = point[0] - x[i][0];
+        float R_1 = point[1] - x[i][1];
+        float R_2 = point[2] - x[i][2];
+        float r_inv = 1.0f / sqrtf(R_0 * R_0 + R_1 * R_1 + R_2 * R_2);
+        float q_r_inv_3 = Q[i] * r_inv * r_inv * r_inv;
+        float q_r_inv_5 = 3.0f * q_r_inv_3 * r_inv * r_inv;
+
+        E_0 += q_r_inv_3 * R_0;
+        E_1 += q_r_inv_3 * R_1;
+        E_2 += q_r_inv_3 * R_2;
+        J_00 += q_r_inv_3 - q_r_inv_5 * R_0 * R_0;
+        J_11 += q_r_inv_3 - q_r_inv_5 * R_1 * R_1;
+        J_22 += q_r_inv_3 - q_r_inv_5 * R_2 * R_2;
+        J_01 -= q_r_inv_5 * R_0 * R_1;
+        J_02 -= q_r_inv_5 * R_0 * R_2;
+        J_12 -= q_r_inv_5 * R_1 * R_2;
     }
+
+    E[0] = factor * E_0;
+    E[1] = factor * E_1;
+    E[2] = factor * E_2;
+    // the field of point charges is curl free, so J is symmetric
+    J[0][0] = factor * J_00;
+    J[1][1] = factor * J_11;
+    J[2][2] = factor * J_22;
+    J[0][1] = J[1][0] = factor * J_01;
+    J[0][2] = J[2][0] = factor * J_02;
+    J[1][2] = J[2][1] = factor * J_12;
 }
 
 
-void propagate_topo(float result[3], float x_init[3], int n_charges, float x[n_charges][3], float Q[n_charges], float step_size){
-    // propagate the topology
-    float E[3] = {0.0, 0.0, 0.0};
+float curve_analytic(float point[3], int n_charges, float x[n_charges][3], float Q[n_charges]){
+    // curvature of the field line through a point, |(I - t t^T) J t| / |E| with t = E / |E|
+    float E[3];
+    float J[3][3];
+    float t[3];
+    float J_t[3];
     float E_norm;
-    //printf("propagating!!");
+    float curvature_sq = 0.0f;
 
-    //calc_field(E, x_init, n_charges, x, Q);
-    calc_field_base(E, x_init, n_charges, x, Q);
-    
+    calc_field_gradient(E, J, point, n_charges, x, Q);
     norm(E, &E_norm);
-    for (int i = 0; i < 3; i++)
+    for (int a = 0; a < 3; a++)
+    {
+        t[a] = E[a] / E_norm;
+    }
+    for (int a = 0; a < 3; a++)
+    {
+        J_t[a] = J[a][0] * t[0] + J[a][1] * t[1] + J[a][2] * t[2];
+    }
+    float along = J_t[0] * t[0] + J_t[1] * t[1] + J_t[2] * t[2];
+    for (int a = 0; a < 3; a++)
     {
-        result[i] = x_init[i] + step_size * E[i] / (E_norm);
+        float perp = J_t[a] - along * t[a];
+        curvature_sq += perp * perp;
     }
+    return sqrtf(curvature_sq) / E_norm;
 }
 
 
-void thread_operation(int n_charges, int n_iter, float step_size, float x_0[3], float dimensions[3], float x[n_charges][3], float Q[n_charges], float ret[2]){
+void clip_to_wall(float inside_point[3], float outside_point[3], float dimensions[3]){
+    // moves a point that stepped out of the box back to where the step crosses the wall
+    float t = 1.0f;
+    for (int k = 0; k < 3; k++)
+    {
+        float delta = outside_point[k] - inside_point[k];
+        if (outside_point[k] > dimensions[k])
+        {
+            t = fminf(t, (dimensions[k] - inside_point[k]) / delta);
+        }
+        else if (outside_point[k] < -dimensions[k])
+        {
+            t = fminf(t, (-dimensions[k] - inside_point[k]) / delta);
+        }
+    }
+    for (int k = 0; k < 3; k++)
+    {
+        outside_point[k] = inside_point[k] + t * (outside_point[k] - inside_point[k]);
+    }
+}
+
+
+float curve_stencil(float minus[3], float point[3], float plus[3], bool central){
+    // curvature from a point and its neighbours along the streamline, either the
+    // forward stencil (point, plus, plus plus) or the central one (minus, point, plus)
+    float v_prime[3];
+    float v_prime_prime[3];
+
+    for (int k = 0; k < 3; k++)
+    {
+        if (central)
+        {
+            v_prime[k] = 0.5f * (plus[k] - minus[k]);
+            v_prime_prime[k] = plus[k] - 2 * point[k] + minus[k];
+        }
+        else
+        {
+            v_prime[k] = point[k] - minus[k];
+            v_prime_prime[k] = plus[k] - 2 * point[k] + minus[k];
+        }
+    }
+    return curve(v_prime, v_prime_prime);
+}
+
+
+void thread_operation(int n_charges, int n_iter, float step_size, float x_0[3], float dimensions[3], float x[n_charges][3], float Q[n_charges], float ret[2], int integrator, float tol, int analytic_curvature){
     bool bool_inside = true;
     float x_init[3] = {x_0[0], x_0[1], x_0[2]};
     float x_overwrite[3] = {x_0[0], x_0[1], x_0[2]};
@@ -360,56 +618,116 @@ void thread_operation(int n_charges, int n_iter, float step_size, float x_0[3],
     float half_width = dimensions[1];
     float half_height = dimensions[2];
     
-    for (i = 0; i < n_iter; i++) {
-
-        propagate_topo(x_overwrite, x_overwrite, n_charges, x, Q, step_size);
-        // overwrite x_init with x_overwrite
-
-        if (
-            x_overwrite[0] < -half_length || 
-            x_overwrite[0] > half_length || 
-            x_overwrite[1] < -half_width || 
-            x_overwrite[1] > half_width || 
-            x_overwrite[2] < -half_height || 
-            x_overwrite[2] > half_height){
-            bool_inside = false;
-        }
-
-        // printf("%f %f %f\n", x_overwrite[0], x_overwrite[1], x_overwrite[2]);
+    if (integrator == INTEGRATOR_RK45)
+    {
+        // adaptive steps along the same arc length as n_iter fixed steps
+        double length = (double)n_iter * step_size;
+        double travelled = 0.0;
+        float h = step_size;
+        float x_new[3];
 
-        if (!bool_inside){
-            // printf("Breaking out of loop at iteration: %i\n", i);
-            break;
+        while (length - travelled > 1e-3 * step_size)
+        {
+            float h_try = fminf(h, (float)(length - travelled));
+            float err = rk45_step(x_new, x_overwrite, n_charges, x, Q, h_try);
+            bool_inside = !(
+                x_new[0] < -half_length ||
+                x_new[0] > half_length ||
+                x_new[1] < -half_width ||
+                x_new[1] > half_width ||
+                x_new[2] < -half_height ||
+                x_new[2] > half_height);
+            if (!adaptive_step_control(err, tol, h_try, step_size, bool_inside, &h))
+            {
+                continue;
+            }
+            if (!bool_inside)
+            {
+                clip_to_wall(x_overwrite, x_new, dimensions);
+            }
+            for (int k = 0; k < 3; k++)
+            {
+                x_overwrite[k] = x_new[k];
+            }
+            travelled += h_try;
+            if (!bool_inside)
+            {
+                break;
+            }
         }
-        // printf("x_final @ iter %i out of %i %f %f %f\n", i, n_iter, x_overwrite[0], x_overwrite[1], x_overwrite[2]);
-        
     }
+    else
+    {
+        float x_prev[3];
+        for (i = 0; i < n_iter; i++) {
+
+            for (int k = 0; k < 3; k++) x_prev[k] = x_overwrite[k];
+            propagate_topo(x_overwrite, x_overwrite, n_charges, x, Q, step_size, integrator);
+            // overwrite x_init with x_overwrite
+
+            if (
+                x_overwrite[0] < -half_length || 
+                x_overwrite[0] > half_length || 
+                x_overwrite[1] < -half_width || 
+                x_overwrite[1] > half_width || 
+                x_overwrite[2] < -half_height || 
+                x_overwrite[2] > half_height){
+                bool_inside = false;
+            }
+
+            // printf("%f %f %f\n", x_overwrite[0], x_overwrite[1], x_overwrite[2]);
+
+            if (!bool_inside){
+                // printf("Breaking out of loop at iteration: %i\n", i);
+                if (integrator != INTEGRATOR_EULER)
+                {
+                    clip_to_wall(x_prev, x_overwrite, dimensions);
+                }
+                break;
+            }
+            // printf("x_final @ iter %i out of %i %f %f %f\n", i, n_iter, x_overwrite[0], x_overwrite[1], x_overwrite[2]);
         
-    
-    float x_init_plus[3];
-    float x_init_plus_plus[3];
-    float x_0_plus[3];
-    float x_0_plus_plus[3];    
-
-    propagate_topo(x_init_plus, x_init, n_charges, x, Q, step_size);
-    propagate_topo(x_init_plus_plus, x_init_plus, n_charges, x, Q, step_size);
-    propagate_topo(x_0_plus, x_overwrite, n_charges, x, Q, step_size);
-    propagate_topo(x_0_plus_plus, x_0_plus, n_charges, x, Q, step_size);
-
-    float curve_arg_1[3];
-    float curve_arg_2[3];
-    float curve_arg_3[3];
-    float curve_arg_4[3];
-    
-    for (int i = 0; i < 3; i++) {
-        curve_arg_1[i] = x_init_plus[i] - x_init[i];
-        curve_arg_2[i] = x_init_plus_plus[i] - 2* x_init_plus[i] + x_init[i];
-        curve_arg_3[i] = x_0_plus[i] - x_overwrite[i];
-        curve_arg_4[i] = x_0_plus_plus[i] - 2* x_0_plus[i] + x_overwrite[i];
+        }
     }
 
-    float curve_init = curve(curve_arg_1, curve_arg_2);
-    float curve_final = curve(curve_arg_3, curve_arg_4);
+    // the curvature stencil uses fixed steps: forward for Euler (as it always has),
+    // central and RK4 for the higher order integrators so it is second order too
+    float curve_init;
+    float curve_final;
+    if (analytic_curvature)
+    {
+        // no extra steps, the curvature comes from the field gradient at both ends
+        curve_init = curve_analytic(x_init, n_charges, x, Q);
+        curve_final = curve_analytic(x_overwrite, n_charges, x, Q);
+    }
+    else if (integrator == INTEGRATOR_EULER)
+    {
+        float x_init_plus[3];
+        float x_init_plus_plus[3];
+        float x_0_plus[3];
+        float x_0_plus_plus[3];
+
+        propagate_topo(x_init_plus, x_init, n_charges, x, Q, step_size, INTEGRATOR_EULER);
+        propagate_topo(x_init_plus_plus, x_init_plus, n_charges, x, Q, step_size, INTEGRATOR_EULER);
+        propagate_topo(x_0_plus, x_overwrite, n_charges, x, Q, step_size, INTEGRATOR_EULER);
+        propagate_topo(x_0_plus_plus, x_0_plus, n_charges, x, Q, step_size, INTEGRATOR_EULER);
+        curve_init = curve_stencil(x_init, x_init_plus, x_init_plus_plus, false);
+        curve_final = curve_stencil(x_overwrite, x_0_plus, x_0_plus_plus, false);
+    }
+    else
+    {
+        float x_init_minus[3];
+        float x_init_plus[3];
+        float x_0_minus[3];
+        float x_0_plus[3];
+
+        propagate_topo(x_init_minus, x_init, n_charges, x, Q, -step_size, INTEGRATOR_RK4);
+        propagate_topo(x_init_plus, x_init, n_charges, x, Q, step_size, INTEGRATOR_RK4);
+        propagate_topo(x_0_minus, x_overwrite, n_charges, x, Q, -step_size, INTEGRATOR_RK4);
+        propagate_topo(x_0_plus, x_overwrite, n_charges, x, Q, step_size, INTEGRATOR_RK4);
+        curve_init = curve_stencil(x_init_minus, x_init, x_init_plus, true);
+        curve_final = curve_stencil(x_0_minus, x_overwrite, x_0_plus, true);
+    }
     float curve_mean = (curve_init + curve_final) / 2;
     float dist = euclidean_dist(x_0, x_overwrite);
     
@@ -420,3 +738,405 @@ void thread_operation(int n_charges, int n_iter, float step_size, float x_0[3],
 }
 
 
+
+
+// number of streamlines advanced together by one thread in thread_operation_batch
+# define STREAM_BLOCK 16
+// number of charges kept hot in cache while they are applied to a block of streamlines
+# define CHARGE_BLOCK 1024
+
+
+// charges in structure-of-arrays layout, the charge loop of the field kernels
+// then reads four contiguous streams and vectorizes
+typedef struct {
+    int n;
+    float *x_0;
+    float *x_1;
+    float *x_2;
+    float *Q;
+} charges_soa;
+
+
+charges_soa charges_soa_from_aos(int n_charges, float x[n_charges][3], float Q[n_charges]){
+    // copies charges from the (n, 3) layout into a single heap block, x_0 is NULL
+    // if the block cannot be allocated
+    charges_soa charges;
+    // at least one charge, malloc(0) may return NULL
+    float *block = malloc(4 * (size_t)(n_charges > 0 ? n_charges : 1) * sizeof(float));
+
+    if (block == NULL)
+    {
+        charges.n = 0;
+        charges.x_0 = charges.x_1 = charges.x_2 = charges.Q = NULL;
+        return charges;
+    }
+    charges.n = n_charges;
+    charges.x_0 = block;
+    charges.x_1 = block + n_charges;
+    charges.x_2 = block + 2 * (size_t)n_charges;
+    charges.Q = block + 3 * (size_t)n_charges;
+    for (int i = 0; i < n_charges; i++)
+    {
+        charges.x_0[i] = x[i][0];
+        charges.x_1[i] = x[i][1];
+        charges.x_2[i] = x[i][2];
+        charges.Q[i] = Q[i];
+    }
+    return charges;
+}
+
+
+void charges_soa_free(charges_soa *charges){
+    free(charges->x_0);
+}
+
+
+void calc_field_soa_range(float E[3], float point[3], const charges_soa *charges, int c_start, int c_end){
+    // unscaled field of charges c_start to c_end at a point, added to E; with
+    // -ffast-math the reciprocal square root vectorizes to an estimate plus a Newton step
+    const float *restrict x_0 = charges->x_0;
+    const float *restrict x_1 = charges->x_1;
+    const float *restrict x_2 = charges->x_2;
+    const float *restrict Q = charges->Q;
+    float p_0 = point[0];
+    float p_1 = point[1];
+    float p_2 = point[2];
+    float E_0 = 0.0f;
+    float E_1 = 0.0f;
+    float E_2 = 0.0f;
+
+    # pragma omp simd reduction(+:E_0, E_1, E_2)
+    for (int i = c_start; i < c_end; i++)
+    {
+        float R_0 = p_0 - x_0[i];
+        float R_1 = p_1 - x_1[i];
+        float R_2 = p_2 - x_2[i];
+        float r_inv = 1.0f / sqrtf(R_0 * R_0 + R_1 * R_1 + R_2 * R_2);
+        float weight = Q[i] * r_inv * r_inv * r_inv;
+        E_0 += weight * R_0;
+        E_1 += weight * R_1;
+        E_2 += weight * R_2;
+    }
+    E[0] += E_0;
+    E[1] += E_1;
+    E[2] += E_2;
+}
+
+
+void calc_field_block(int n_points, float E[n_points][3], float points[n_points][3], const charges_soa *charges){
+    // field at a small block of points, tiled over the charges so each tile
+    // of charges is reused by every point of the block while it is in cache
+    float factor = 14.3996451;
+
+    for (int p = 0; p < n_points; p++)
+    {
+        E[p][0] = 0.0;
+        E[p][1] = 0.0;
+        E[p][2] = 0.0;
+    }
+
+    for (int c_start = 0; c_start < charges->n; c_start += CHARGE_BLOCK)
+    {
+        int c_end = c_start + CHARGE_BLOCK < charges->n ? c_start + CHARGE_BLOCK : charges->n;
+        for (int p = 0; p < n_points; p++)
+        {
+            calc_field_soa_range(E[p], points[p], charges, c_start, c_end);
+        }
+    }
+
+    for (int p = 0; p < n_points; p++)
+    {
+        E[p][0] *= factor;
+        E[p][1] *= factor;
+        E[p][2] *= factor;
+    }
+}
+
+
+void calc_field_soa_batch(int n_points, float E[n_points][3], float points[n_points][3], int n_charges, float x_0[n_charges], float x_1[n_charges], float x_2[n_charges], float Q[n_charges]){
+    // field at a set of points from charges already in structure-of-arrays layout
+    charges_soa charges = {n_charges, x_0, x_1, x_2, Q};
+    int n_blocks = (n_points + STREAM_BLOCK - 1) / STREAM_BLOCK;
+
+    # pragma omp parallel for schedule(static) num_threads(get_native_threads())
+    for (int b = 0; b < n_blocks; b++)
+    {
+        int b_start = b * STREAM_BLOCK;
+        int b_size = n_points - b_start < STREAM_BLOCK ? n_points - b_start : STREAM_BLOCK;
+        calc_field_block(b_size, &E[b_start], &points[b_start], &charges);
+    }
+}
+
+
+void direction_block(int n_points, float D[n_points][3], float points[n_points][3], const charges_soa *charges){
+    // unit vectors along the field at a block of points
+    float E_norm;
+
+    calc_field_block(n_points, D, points, charges);
+    for (int p = 0; p < n_points; p++)
+    {
+        norm(D[p], &E_norm);
+        for (int i = 0; i < 3; i++)
+        {
+            D[p][i] = D[p][i] / E_norm;
+        }
+    }
+}
+
+
+void propagate_topo_block(int n_points, float result[n_points][3], float points[n_points][3], const charges_soa *charges, float step_size, int integrator){
+    // propagate a block of points one fixed step along the normalized field
+    float k_1[STREAM_BLOCK][3];
+    float k_2[STREAM_BLOCK][3];
+    float k_3[STREAM_BLOCK][3];
+    float k_4[STREAM_BLOCK][3];
+    float stage[STREAM_BLOCK][3];
+
+    direction_block(n_points, k_1, points, charges);
+    if (integrator == INTEGRATOR_EULER)
+    {
+        for (int p = 0; p < n_points; p++)
+        {
+            for (int i = 0; i < 3; i++)
+            {
+                result[p][i] = points[p][i] + step_size * k_1[p][i];
+            }
+        }
+        return;
+    }
+
+    for (int p = 0; p < n_points; p++)
+        for (int i = 0; i < 3; i++) stage[p][i] = points[p][i] + 0.5f * step_size * k_1[p][i];
+    direction_block(n_points, k_2, stage, charges);
+    for (int p = 0; p < n_points; p++)
+        for (int i = 0; i < 3; i++) stage[p][i] = points[p][i] + 0.5f * step_size * k_2[p][i];
+    direction_block(n_points, k_3, stage, charges);
+    for (int p = 0; p < n_points; p++)
+        for (int i = 0; i < 3; i++) stage[p][i] = points[p][i] + step_size * k_3[p][i];
+    direction_block(n_points, k_4, stage, charges);
+    for (int p = 0; p < n_points; p++)
+    {
+        for (int i = 0; i < 3; i++)
+        {
+            result[p][i] = points[p][i] + step_size / 6.0f * (k_1[p][i] + 2.0f * k_2[p][i] + 2.0f * k_3[p][i] + k_4[p][i]);
+        }
+    }
+}
+
+
+void rk45_step_block(int n_points, float result[n_points][3], float points[n_points][3], const charges_soa *charges, float h[n_points], float err[n_points]){
+    // one Cash-Karp step for a block of points, each with its own step size
+    float k[6][STREAM_BLOCK][3];
+    float stage[STREAM_BLOCK][3];
+
+    for (int j = 0; j < 6; j++)
+    {
+        for (int p = 0; p < n_points; p++)
+        {
+            for (int i = 0; i < 3; i++)
+            {
+                stage[p][i] = points[p][i];
+                for (int m = 0; m < j; m++)
+                {
+                    stage[p][i] += h[p] * CK_A[j][m] * k[m][p][i];
+                }
+            }
+        }
+        direction_block(n_points, k[j], stage, charges);
+    }
+    for (int p = 0; p < n_points; p++)
+    {
+        float err_sq = 0.0f;
+        for (int i = 0; i < 3; i++)
+        {
+            float y_5 = points[p][i];
+            float e = 0.0f;
+            for (int j = 0; j < 6; j++)
+            {
+                y_5 += h[p] * CK_B5[j] * k[j][p][i];
+                e += h[p] * (CK_B5[j] - CK_B4[j]) * k[j][p][i];
+            }
+            result[p][i] = y_5;
+            err_sq += e * e;
+        }
+        err[p] = sqrtf(err_sq);
+    }
+}
+
+
+int thread_operation_batch(int n_charges, int n_samples, float step_size, float x_0[n_samples][3], int n_iter[n_samples], float dimensions[3], float x[n_charges][3], float Q[n_charges], float ret[n_samples][2], int integrator, float tol, int analytic_curvature){
+    // computes the full topology (distance, curvature) of every streamline in one call,
+    // each thread advancing blocks of STREAM_BLOCK streamlines in lockstep. Returns 0,
+    // or -1 if the charges cannot be copied
+    float half_length = dimensions[0];
+    float half_width = dimensions[1];
+    float half_height = dimensions[2];
+    int n_blocks = (n_samples + STREAM_BLOCK - 1) / STREAM_BLOCK;
+    charges_soa charges = charges_soa_from_aos(n_charges, x, Q);
+    if (charges.x_0 == NULL)
+    {
+        return -1;
+    }
+
+    # pragma omp parallel for schedule(dynamic, 1) num_threads(get_native_threads())
+    for (int b = 0; b < n_blocks; b++)
+    {
+        int b_start = b * STREAM_BLOCK;
+        int b_size = n_samples - b_start < STREAM_BLOCK ? n_samples - b_start : STREAM_BLOCK;
+        float x_final[STREAM_BLOCK][3];
+        float active_points[STREAM_BLOCK][3];
+        float new_points[STREAM_BLOCK][3];
+        float active_h[STREAM_BLOCK];
+        float active_err[STREAM_BLOCK];
+        int active_index[STREAM_BLOCK];
+        bool running[STREAM_BLOCK];
+        int steps[STREAM_BLOCK];
+        // arc length covered and next step size of the adaptive integrator
+        double travelled[STREAM_BLOCK];
+        float h[STREAM_BLOCK];
+
+        for (int s = 0; s < b_size; s++)
+        {
+            for (int k = 0; k < 3; k++)
+            {
+                x_final[s][k] = x_0[b_start + s][k];
+            }
+            running[s] = n_iter[b_start + s] > 0;
+            steps[s] = 0;
+            travelled[s] = 0.0;
+            h[s] = step_size;
+        }
+
+        while (true)
+        {
+            // gather streamlines still inside the box and short of their length
+            int n_active = 0;
+            for (int s = 0; s < b_size; s++)
+            {
+                if (running[s])
+                {
+                    active_index[n_active] = s;
+                    for (int k = 0; k < 3; k++)
+                    {
+                        active_points[n_active][k] = x_final[s][k];
+                    }
+                    active_h[n_active] = fminf(h[s], (float)((double)n_iter[b_start + s] * step_size - travelled[s]));
+                    n_active++;
+                }
+            }
+            if (n_active == 0)
+            {
+                break;
+            }
+
+            if (integrator == INTEGRATOR_RK45)
+            {
+                rk45_step_block(n_active, new_points, active_points, &charges, active_h, active_err);
+            }
+            else
+            {
+                propagate_topo_block(n_active, new_points, active_points, &charges, step_size, integrator);
+            }
+
+            for (int a = 0; a < n_active; a++)
+            {
+                int s = active_index[a];
+                bool inside = !(
+                    new_points[a][0] < -half_length ||
+                    new_points[a][0] > half_length ||
+                    new_points[a][1] < -half_width ||
+                    new_points[a][1] > half_width ||
+                    new_points[a][2] < -half_height ||
+                    new_points[a][2] > half_height);
+                if (integrator == INTEGRATOR_RK45)
+                {
+                    if (!adaptive_step_control(active_err[a], tol, active_h[a], step_size, inside, &h[s]))
+                    {
+                        continue;
+                    }
+                    travelled[s] += active_h[a];
+                }
+                else
+                {
+                    steps[s]++;
+                }
+                if (!inside && integrator != INTEGRATOR_EULER)
+                {
+                    clip_to_wall(active_points[a], new_points[a], dimensions);
+                }
+                for (int k = 0; k < 3; k++)
+                {
+                    x_final[s][k] = new_points[a][k];
+                }
+                if (
+                    !inside ||
+                    (integrator != INTEGRATOR_RK45 && steps[s] >= n_iter[b_start + s]) ||
+                    (integrator == INTEGRATOR_RK45 && (double)n_iter[b_start + s] * step_size - travelled[s] <= 1e-3 * step_size)){
+                    running[s] = false;
+                }
+            }
+        }
+
+        if (analytic_curvature)
+        {
+            // no extra steps, the curvature comes from the field gradient at both ends
+            for (int s = 0; s < b_size; s++)
+            {
+                ret[b_start + s][0] = euclidean_dist(x_0[b_start + s], x_final[s]);
+                ret[b_start + s][1] = (
+                    curve_analytic(x_0[b_start + s], n_charges, x, Q) +
+                    curve_analytic(x_final[s], n_charges, x, Q)) / 2;
+            }
+            continue;
+        }
+
+        // two extra steps from the first and last point of every streamline for the curvature,
+        // forward for Euler and central (one step back, one forward) for the higher order integrators
+        float ends[2 * STREAM_BLOCK][3];
+        float ends_a[2 * STREAM_BLOCK][3];
+        float ends_b[2 * STREAM_BLOCK][3];
+        for (int s = 0; s < b_size; s++)
+        {
+            for (int k = 0; k < 3; k++)
+            {
+                ends[s][k] = x_0[b_start + s][k];
+                ends[b_size + s][k] = x_final[s][k];
+            }
+        }
+        for (int half = 0; half < 2; half++)
+        {
+            if (integrator == INTEGRATOR_EULER)
+            {
+                propagate_topo_block(b_size, &ends_a[half * b_size], &ends[half * b_size], &charges, step_size, INTEGRATOR_EULER);
+                propagate_topo_block(b_size, &ends_b[half * b_size], &ends_a[half * b_size], &charges, step_size, INTEGRATOR_EULER);
+            }
+            else
+            {
+                propagate_topo_block(b_size, &ends_a[half * b_size], &ends[half * b_size], &charges, -step_size, INTEGRATOR_RK4);
+                propagate_topo_block(b_size, &ends_b[half * b_size], &ends[half * b_size], &charges, step_size, INTEGRATOR_RK4);
+            }
+        }
+
+        for (int s = 0; s < b_size; s++)
+        {
+            int f = b_size + s;
+            float curve_init;
+            float curve_final;
+
+            if (integrator == INTEGRATOR_EULER)
+            {
+                curve_init = curve_stencil(ends[s], ends_a[s], ends_b[s], false);
+                curve_final = curve_stencil(ends[f], ends_a[f], ends_b[f], false);
+            }
+            else
+            {
+                curve_init = curve_stencil(ends_a[s], ends[s], ends_b[s], true);
+                curve_final = curve_stencil(ends_a[f], ends[f], ends_b[f], true);
+            }
+            ret[b_start + s][0] = euclidean_dist(ends[s], ends[f]);
+            ret[b_start + s][1] = (curve_init + curve_final) / 2;
+        }
+    }
+    charges_soa_free(&charges);
+    return 0;
+}
@@ -0,0 +1,127 @@
+import numpy as np
+
+from CPET.utils.calculator import (
+    calculate_electric_field_points,
+    calculate_esp_points,
+    compare_fields,
+)
+
+"""
+Far-field expansion about the center of the sampling box
+
+Charges far outside the box produce a field that is smooth across it. Their
+field and potential are collapsed once into a tensor-product Chebyshev
+polynomial over the box (plus a margin for the steps taken past its walls), so
+evaluating them costs O(order**3) per point whatever their number. Charges
+closer than the split radius stay in an exact near set.
+"""
+
+
+class FarFieldExpansion:
+    def __init__(self, x, Q, half_widths, order=6):
+        """
+        Builds the expansion of a set of far charges
+        Takes
+            x(array) - positions of far charges of shape (N,3)
+            Q(array) - magnitude and sign of far charges of shape (N,1)
+            half_widths(array) - half widths of the region the expansion covers of shape (3,)
+            order(int) - polynomial order in each direction
+        """
+        self.half_widths = np.asarray(half_widths, dtype=np.float64)
+        self.order = int(order)
+        n = self.order + 1
+        nodes = np.cos(np.pi * (np.arange(n) + 0.5) / n)
+        grid = np.stack(
+            np.meshgrid(*[nodes * h for h in self.half_widths], indexing="ij"), axis=-1
+        ).reshape(-1, 3)
+        values = np.concatenate(
+            (
+                calculate_electric_field_points(grid, x, Q),
+                calculate_esp_points(grid, x, Q),
+            ),
+            axis=1,
+        ).reshape(n, n, n, 4)
+        # discrete Chebyshev transform on the first kind nodes
+        transform = 2 / n * np.cos(np.outer(np.arange(n), np.pi * (np.arange(n) + 0.5) / n))
+        transform[0] /= 2
+        self.coefficients = np.einsum(
+            "ai,bj,ck,ijkm->abcm", transform, transform, transform, values
+        )
+
+    def _evaluate(self, points):
+        u = np.asarray(points, dtype=np.float64).reshape(-1, 3) / self.half_widths
+        T = np.empty((3, len(u), self.order + 1))
+        T[:, :, 0] = 1.0
+        if self.order > 0:
+            T[:, :, 1] = u.T
+        for k in range(2, self.order + 1):
+            T[:, :, k] = 2 * u.T * T[:, :, k - 1] - T[:, :, k - 2]
+        return np.einsum("la,lb,lc,abcm->lm", T[0], T[1], T[2], self.coefficients)
+
+    def field(self, points):
+        """
+        Electric field of the far charges at a set of points of shape (L,3)
+        """
+        return self._evaluate(points)[:, 0:3]
+
+    def esp(self, points):
+        """
+        Electrostatic potential of the far charges at a set of points of shape (L,1)
+        """
+        return self._evaluate(points)[:, 3:4]
+
+
+def build_far_field(x, Q, half_widths, tol=1e-3, order=6, n_test=64, n_radii=16, seed=0):
+    """
+    Splits charges into an exact near set and a far set collapsed into a
+    FarFieldExpansion, picking the smallest split radius whose expansion error stays
+    below tol relative to the mean magnitude of the total field in the box
+    Takes
+        x(array) - positions of charges in the box frame of shape (N,3)
+        Q(array) - magnitude and sign of charges of shape (N,1)
+        half_widths(array) - half widths of the region the expansion covers of shape (3,)
+        tol(float) - tolerated relative error of the far field
+        order(int) - polynomial order of the expansion in each direction
+        n_test(int) - number of random points the error is measured at
+        n_radii(int) - number of split radii tried
+        seed(int) - seed of the test points
+    Returns
+        near_mask(array) - boolean mask of the near charges of shape (N,)
+        expansion(FarFieldExpansion or None) - expansion of the far charges, None if there are none
+        report(dict) - split radius, near and far counts and measured error
+    """
+    x = np.asarray(x, dtype=np.float64).reshape(-1, 3)
+    half_widths = np.asarray(half_widths, dtype=np.float64)
+    r = np.linalg.norm(x, axis=1)
+    rng = np.random.default_rng(seed)
+    test_points = rng.uniform(-1, 1, (n_test, 3)) * half_widths
+    E_scale = np.mean(
+        np.linalg.norm(calculate_electric_field_points(test_points, x, Q), axis=1)
+    )
+
+    report = {"split_radius": None, "n_near": len(r), "n_far": 0, "max_rel_error": 0.0}
+    near_mask = np.ones(len(r), dtype=bool)
+    expansion = None
+    inner_radius = 2 * np.linalg.norm(half_widths)
+    if len(r) == 0 or np.max(r) <= inner_radius:
+        return near_mask, expansion, report
+
+    for radius in np.geomspace(inner_radius, np.max(r), n_radii, endpoint=False):
+        far = r > radius
+        candidate = FarFieldExpansion(x[far], np.reshape(Q, (-1, 1))[far], half_widths, order)
+        errors = compare_fields(
+            candidate.field(test_points),
+            calculate_electric_field_points(test_points, x[far], np.reshape(Q, (-1, 1))[far]),
+            scale=E_scale,
+        )
+        if errors["max_rel_error"] <= tol:
+            near_mask = ~far
+            expansion = candidate
+            report = {
+                "split_radius": float(radius),
+                "n_near": int(np.sum(near_mask)),
+                "n_far": int(np.sum(far)),
+                "max_rel_error": errors["max_rel_error"],
+            }
+            break
+    return near_mask, expansion, report
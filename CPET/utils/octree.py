@@ -0,0 +1,239 @@
+import numpy as np
+import numba as nb
+
+from CPET.utils.calculator import calculate_electric_field_points, compare_fields
+
+"""
+Barnes-Hut octree for fields and potentials of large charge sets
+
+Charges are sorted so that every node of the tree covers a contiguous range of
+them. Each node stores its monopole, dipole and traceless quadrupole about the
+mean position of its charges and the radius of the sphere around that point holding all of them. A
+node is replaced by its expansion when radius < theta * distance to the
+evaluation point (theta is the opening angle), otherwise its children (or, for a
+leaf, its charges) are visited.
+"""
+
+
+class Octree:
+    def __init__(self, x, Q, theta=0.3, leaf_size=16, max_depth=32):
+        """
+        Builds the tree once for a structure
+        Takes
+            x(array) - positions of charges of shape (N,3)
+            Q(array) - magnitude and sign of charges of shape (N,1)
+            theta(float) - opening angle, 0 reproduces the exact sum
+            leaf_size(int) - maximum number of charges in a leaf
+            max_depth(int) - maximum depth of the tree, guards against coincident charges
+        """
+        self.theta = float(theta)
+        x = np.asarray(x, dtype=np.float64).reshape(-1, 3)
+        Q = np.asarray(Q, dtype=np.float64).reshape(-1)
+
+        perm = np.arange(len(Q))
+        centers, radii, q_sum, dipole, quadrupole = [], [], [], [], []
+        start, count, child_start, child_count = [], [], [], []
+
+        def add_node(node_start, node_count):
+            idx = perm[node_start : node_start + node_count]
+            pos = x[idx]
+            center = pos.mean(axis=0)
+            centers.append(center)
+            radii.append(np.sqrt(np.max(np.sum((pos - center) ** 2, axis=1))))
+            q_sum.append(np.sum(Q[idx]))
+            dipole.append(np.sum(Q[idx].reshape(-1, 1) * (pos - center), axis=0))
+            s = pos - center
+            s_sq = np.sum(s**2, axis=1)
+            quad = 3 * np.einsum("n,ni,nj->ij", Q[idx], s, s) - np.sum(Q[idx] * s_sq) * np.eye(3)
+            quadrupole.append(quad[[0, 1, 2, 0, 0, 1], [0, 1, 2, 1, 2, 2]])
+            start.append(node_start)
+            count.append(node_count)
+            child_start.append(0)
+            child_count.append(0)
+            return len(start) - 1
+
+        # breadth first, so the children of a node are stored next to each other
+        queue = [(add_node(0, len(Q)), 0)]
+        head = 0
+        while head < len(queue):
+            node, depth = queue[head]
+            head += 1
+            if count[node] <= leaf_size or depth >= max_depth:
+                continue
+            node_start = start[node]
+            idx = perm[node_start : node_start + count[node]]
+            pos = x[idx]
+            mid = (pos.min(axis=0) + pos.max(axis=0)) / 2
+            octant = (
+                (pos[:, 0] > mid[0]) * 4 + (pos[:, 1] > mid[1]) * 2 + (pos[:, 2] > mid[2])
+            )
+            order = np.argsort(octant, kind="stable")
+            perm[node_start : node_start + count[node]] = idx[order]
+            octant_counts = np.bincount(octant, minlength=8)
+            if np.max(octant_counts) == count[node]:
+                # all charges coincide, keep as a leaf
+                continue
+            child_start[node] = len(start)
+            offset = node_start
+            for n_octant in octant_counts:
+                if n_octant == 0:
+                    continue
+                queue.append((add_node(offset, n_octant), depth + 1))
+                offset += n_octant
+            child_count[node] = len(start) - child_start[node]
+
+        self.x = np.ascontiguousarray(x[perm])
+        self.Q = np.ascontiguousarray(Q[perm])
+        self.centers = np.array(centers, dtype=np.float64)
+        self.radii = np.array(radii, dtype=np.float64)
+        self.q_sum = np.array(q_sum, dtype=np.float64)
+        self.dipole = np.array(dipole, dtype=np.float64)
+        self.quadrupole = np.array(quadrupole, dtype=np.float64)
+        self.start = np.array(start, dtype=np.int64)
+        self.count = np.array(count, dtype=np.int64)
+        self.child_start = np.array(child_start, dtype=np.int64)
+        self.child_count = np.array(child_count, dtype=np.int64)
+        self.stack_size = 8 * (max_depth + 2)
+
+    def _tree(self):
+        return (
+            self.centers,
+            self.radii,
+            self.q_sum,
+            self.dipole,
+            self.quadrupole,
+            self.start,
+            self.count,
+            self.child_start,
+            self.child_count,
+            self.x,
+            self.Q,
+        )
+
+    def field(self, points):
+        """
+        Computes the electric field at a set of points
+        Takes
+            points(array) - positions to compute field at of shape (L,3)
+        Returns
+            E(array) - electric field at the points of shape (L,3)
+        """
+        points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 3)
+        return octree_evaluate(points, *self._tree(), self.theta, self.stack_size, False)
+
+    def esp(self, points):
+        """
+        Computes the electrostatic potential at a set of points
+        Takes
+            points(array) - positions to compute potential at of shape (L,3)
+        Returns
+            ESP(array) - electrostatic potential at the points of shape (L,1)
+        """
+        points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 3)
+        return octree_evaluate(points, *self._tree(), self.theta, self.stack_size, True)[
+            :, 0:1
+        ]
+
+    def error_report(self, points, x, Q):
+        """
+        Compares the tree field against the exact sum at a set of points
+        Takes
+            points(array) - positions to compare the field at of shape (L,3)
+            x(array) - positions of charges of shape (N,3)
+            Q(array) - magnitude and sign of charges of shape (N,1)
+        Returns
+            report(dict) - maximum and mean absolute and relative field errors
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        E_tree = self.field(points)
+        E_exact = calculate_electric_field_points(points, x, Q)
+        report = {"theta": self.theta}
+        report.update(compare_fields(E_tree, E_exact))
+        return report
+
+
+@nb.njit(parallel=True, cache=True)
+def octree_evaluate(
+    points,
+    centers,
+    radii,
+    q_sum,
+    dipole,
+    quadrupole,
+    start,
+    count,
+    child_start,
+    child_count,
+    x,
+    Q,
+    theta,
+    stack_size,
+    potential,
+):
+    """
+    Walks the tree for every point, returns the field of shape (L,3) or, with
+    potential=True, the potential in the first column
+    """
+    out = np.zeros((points.shape[0], 3))
+    for p in nb.prange(points.shape[0]):
+        stack = np.empty(stack_size, dtype=np.int64)
+        stack[0] = 0
+        n_stack = 1
+        E_0 = 0.0
+        E_1 = 0.0
+        E_2 = 0.0
+        V = 0.0
+        while n_stack > 0:
+            n_stack -= 1
+            node = stack[n_stack]
+            d_0 = points[p, 0] - centers[node, 0]
+            d_1 = points[p, 1] - centers[node, 1]
+            d_2 = points[p, 2] - centers[node, 2]
+            d_sq = d_0 * d_0 + d_1 * d_1 + d_2 * d_2
+            if radii[node] * radii[node] < theta * theta * d_sq:
+                # far enough, use the multipole expansion of the node
+                d_inv = 1.0 / np.sqrt(d_sq)
+                d_inv_2 = d_inv * d_inv
+                d_inv_3 = d_inv * d_inv_2
+                d_inv_5 = d_inv_3 * d_inv_2
+                p_dot_d = dipole[node, 0] * d_0 + dipole[node, 1] * d_1 + dipole[node, 2] * d_2
+                # quadrupole stored as xx, yy, zz, xy, xz, yz
+                Qd_0 = quadrupole[node, 0] * d_0 + quadrupole[node, 3] * d_1 + quadrupole[node, 4] * d_2
+                Qd_1 = quadrupole[node, 3] * d_0 + quadrupole[node, 1] * d_1 + quadrupole[node, 5] * d_2
+                Qd_2 = quadrupole[node, 4] * d_0 + quadrupole[node, 5] * d_1 + quadrupole[node, 2] * d_2
+                dQd = Qd_0 * d_0 + Qd_1 * d_1 + Qd_2 * d_2
+                if potential:
+                    V += q_sum[node] * d_inv + p_dot_d * d_inv_3 + 0.5 * dQd * d_inv_5
+                else:
+                    radial = (
+                        q_sum[node] * d_inv_3
+                        + 3.0 * p_dot_d * d_inv_5
+                        + 2.5 * dQd * d_inv_5 * d_inv_2
+                    )
+                    E_0 += radial * d_0 - dipole[node, 0] * d_inv_3 - Qd_0 * d_inv_5
+                    E_1 += radial * d_1 - dipole[node, 1] * d_inv_3 - Qd_1 * d_inv_5
+                    E_2 += radial * d_2 - dipole[node, 2] * d_inv_3 - Qd_2 * d_inv_5
+            elif child_count[node] == 0:
+                for i in range(start[node], start[node] + count[node]):
+                    R_0 = points[p, 0] - x[i, 0]
+                    R_1 = points[p, 1] - x[i, 1]
+                    R_2 = points[p, 2] - x[i, 2]
+                    r_inv = 1.0 / np.sqrt(R_0 * R_0 + R_1 * R_1 + R_2 * R_2)
+                    if potential:
+                        V += Q[i] * r_inv
+                    else:
+                        weight = Q[i] * r_inv * r_inv * r_inv
+                        E_0 += weight * R_0
+                        E_1 += weight * R_1
+                        E_2 += weight * R_2
+            else:
+                for c in range(child_start[node], child_start[node] + child_count[node]):
+                    stack[n_stack] = c
+                    n_stack += 1
+        if potential:
+            out[p, 0] = V * 14.3996451
+        else:
+            out[p, 0] = E_0 * 14.3996451
+            out[p, 1] = E_1 * 14.3996451
+            out[p, 2] = E_2 * 14.3996451
+    return out
@@ -1,16 +1,601 @@
+import os
+import heapq
+import threading
+import itertools
+from contextlib import contextmanager
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict
 import numpy as np
+from functools import partial
+from multiprocessing import Pool, Value, shared_memory, resource_tracker
 
 from CPET.utils.calculator import (
+    Math,
     propagate_topo_dev,
     propagate_topo,
-    propagate_topo_dev_batch,
     Inside_Box,
     compute_curv_and_dist,
+    compute_curv_and_dist_central_batch,
+    clip_to_box_batch,
     calculate_thread_c_shared,
+    calculate_electric_field_base,
+    calculate_electric_field_dev_c_shared,
+    integrate_streamlines_batch,
+    compute_topo_field_batch,
+    calculate_electric_field_points,
+    calculate_field_gradient_points,
+    analytic_curvature_batch,
 )
 
 
-def task_base(x_0, n_iter, x, Q, step_size, dimensions):
+class SharedCharges:
+    """
+    Holds the positions and values of the charges of a structure in shared memory,
+    so that pool workers attach to a single copy instead of receiving the charges
+    pickled with every task
+    Takes
+        x(array) - positions of charges of shape (N,3)
+        Q(array) - magnitude and sign of charges of shape (N,1)
+    """
+
+    def __init__(self, x, Q):
+        self.blocks = []
+        self.descriptor = []
+        for arr in (x, Q):
+            arr = np.ascontiguousarray(arr)
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            self.blocks.append(shm)
+            self.descriptor.append((shm.name, arr.shape, arr.dtype.str))
+
+    def close(self):
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def parse_cpulist(cpulist):
+    """
+    Takes
+        cpulist(str) - cpu list in the kernel format, like 0-3,8-11
+    Returns
+        cpus(list) - cpu ids
+    """
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus):
+    """
+    Takes
+        cpus(list) - sorted cpu ids
+    Returns
+        cpulist(str) - cpu list in the kernel format
+    """
+    runs = []
+    for cpu in cpus:
+        if runs and cpu == runs[-1][1] + 1:
+            runs[-1][1] = cpu
+        else:
+            runs.append([cpu, cpu])
+    return ",".join(str(a) if a == b else "{}-{}".format(a, b) for a, b in runs)
+
+
+def numa_nodes(cpus):
+    """
+    Groups cpus by the NUMA node they belong to, as listed in sysfs. A single group
+    when the layout is not available
+    Takes
+        cpus(list) - cpu ids usable by this process
+    Returns
+        nodes(list) - sorted cpu ids of every node holding some of cpus
+    """
+    nodes = []
+    paths = glob("/sys/devices/system/node/node[0-9]*/cpulist")
+    for path in sorted(paths, key=lambda path: int(path.split("/node")[-1].split("/")[0])):
+        with open(path) as f:
+            node = sorted(set(parse_cpulist(f.read())) & set(cpus))
+        if node:
+            nodes.append(node)
+    if sum(len(node) for node in nodes) != len(cpus):
+        return [sorted(cpus)]
+    return nodes
+
+
+def parallel_layout(n_workers=None, omp_threads=None, pin=True):
+    """
+    Splits the cores of this process between pool workers and the OpenMP teams of
+    the native kernels, so that workers * threads does not exceed the cores. Workers
+    are spread over NUMA nodes in proportion to their cores and each gets a contiguous
+    set of cpus within one node
+    Takes
+        n_workers(int) - requested workers, capped at the number of cores, all cores if None
+        omp_threads(int) - OpenMP threads per worker, the cpus of a worker if None
+        pin(bool) - whether workers are pinned to their cpus
+    Returns
+        layout(dict) - cpus, nodes, workers, omp_threads, pin and the cpus and node of
+            every worker
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    nodes = numa_nodes(cpus)
+    n_workers = len(cpus) if n_workers is None else max(1, min(int(n_workers), len(cpus)))
+
+    # largest remainder share of the workers per node, never more than its cores
+    share = [n_workers * len(node) / len(cpus) for node in nodes]
+    counts = [int(s) for s in share]
+    for i in sorted(range(len(nodes)), key=lambda i: counts[i] - share[i])[: n_workers - sum(counts)]:
+        counts[i] += 1
+
+    worker_cpus = []
+    worker_nodes = []
+    for node_id, (node, count) in enumerate(zip(nodes, counts)):
+        for group in np.array_split(np.array(node), count) if count else []:
+            worker_cpus.append([int(cpu) for cpu in group])
+            worker_nodes.append(node_id)
+    if omp_threads is None:
+        omp_threads = min(len(group) for group in worker_cpus)
+    return {
+        "cpus": cpus,
+        "nodes": nodes,
+        "workers": n_workers,
+        "omp_threads": max(1, int(omp_threads)),
+        "pin": pin,
+        "worker_cpus": worker_cpus,
+        "worker_nodes": worker_nodes,
+    }
+
+
+def format_layout(layout, concurrency="processes"):
+    """
+    Takes
+        layout(dict) - layout from parallel_layout
+        concurrency(str) - processes or threads
+    Returns
+        report(str) - one line summary and the cpus of every worker
+    """
+    lines = [
+        "... > Parallel layout: {} cores on {} NUMA node(s), {} worker {} x {} OpenMP thread(s){}".format(
+            len(layout["cpus"]),
+            len(layout["nodes"]),
+            layout["workers"],
+            concurrency,
+            layout["omp_threads"],
+            ", pinned" if layout["pin"] else "",
+        )
+    ]
+    for i, (cpus, node) in enumerate(zip(layout["worker_cpus"], layout["worker_nodes"])):
+        lines.append("    worker {}: node {}, cpus {}".format(i, node, format_cpulist(cpus)))
+    return "\n".join(lines)
+
+
+def apply_layout(layout, index, native_threads=True):
+    """
+    Pins the calling process or thread to the cpus of worker index and sets the
+    OpenMP team size of the native kernels
+    Takes
+        layout(dict) - layout from parallel_layout
+        index(int) - worker index
+        native_threads(bool) - whether to set the team size, which holds for the
+            whole process and is left to thread_executor for threads
+    """
+    if layout["pin"] and hasattr(os, "sched_setaffinity"):
+        # on Linux, 0 is the calling thread
+        os.sched_setaffinity(0, layout["worker_cpus"][index % len(layout["worker_cpus"])])
+    if native_threads and Math is not None:
+        Math.set_native_threads(layout["omp_threads"])
+
+
+def init_layout_process(layout, counter):
+    # pool initializer, every worker takes the next worker index
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    apply_layout(layout, index)
+
+
+def init_layout_thread(layout, counter):
+    # thread pool initializer, next() of an itertools.count is atomic under the GIL
+    apply_layout(layout, next(counter), native_threads=False)
+
+
+# team size of the native kernels before the first open thread_executor, restored
+# when the last one closes
+native_threads_lock = threading.Lock()
+native_threads_state = {"open": 0, "previous": None}
+
+
+def lpt_chunks(n_iter, n_chunks, overhead=4):
+    """
+    Packs streamlines into chunks of near equal cost with the longest processing
+    time first rule: streamlines are taken longest first and each goes to the
+    cheapest chunk so far. The cost of a streamline is its number of steps plus
+    the extra field evaluations of its curvature
+    Takes:
+        n_iter(array) - number of iterations of propagation of each streamline
+        n_chunks(int) - number of chunks to pack
+        overhead(int) - steps added to every streamline for its curvature
+    Returns:
+        chunks(list) - index arrays of the chunks, costliest chunk first
+    """
+    cost = np.asarray(n_iter, dtype=np.int64).reshape(-1) + overhead
+    n_chunks = max(1, min(int(n_chunks), len(cost)))
+    heap = [(0, chunk) for chunk in range(n_chunks)]
+    owner = np.empty(len(cost), dtype=np.int64)
+    order = np.argsort(-cost, kind="stable")
+    for i, c in zip(order.tolist(), cost[order].tolist()):
+        load, chunk = heapq.heappop(heap)
+        owner[i] = chunk
+        heapq.heappush(heap, (load + c, chunk))
+    loads = np.bincount(owner, weights=cost, minlength=n_chunks)
+    # indices within a chunk stay in input order
+    chunks = [np.sort(np.nonzero(owner == chunk)[0]) for chunk in range(n_chunks)]
+    return [chunks[chunk] for chunk in np.argsort(-loads, kind="stable")]
+
+
+def streamline_chunk(task_fn, x_0, n_iter):
+    """
+    Runs a per-streamline task over every streamline of a chunk
+    Takes:
+        task_fn(callable) - task of a single streamline, called as task_fn(x_0, n_iter)
+        x_0(array) - (B, 3) array of box positions
+        n_iter(array) - (B,) number of iterations of propagation of each streamline
+    Returns:
+        results(list) - result of task_fn for every streamline
+    """
+    return [task_fn(point, steps) for point, steps in zip(x_0, n_iter)]
+
+
+def _run_chunk(args):
+    chunk_fn, indices, x_0, n_iter = args
+    return indices, chunk_fn(x_0, n_iter)
+
+
+def run_chunks_scheduled(pool, chunk_fn, x_0, n_iter, chunks_per_worker=8, n_workers=None):
+    """
+    Runs streamlines on a pool in cost balanced chunks. Chunks are handed out
+    costliest first, one at a time, so a worker that finishes early picks up the
+    next chunk instead of idling behind a few long streamlines
+    Takes:
+        pool(Pool) - worker pool
+        chunk_fn(callable) - picklable task of a chunk, called as chunk_fn(x_0, n_iter)
+            and returning one result per streamline
+        x_0(array) - (L, 3) array of box positions
+        n_iter(array) - (L,) number of iterations of propagation of each streamline
+        chunks_per_worker(int) - chunks packed per worker, more chunks balance better
+        n_workers(int) - number of workers of the pool, read from the pool if None
+    Returns:
+        results(list) - result of every streamline in input order
+    """
+    x_0 = np.asarray(x_0)
+    n_iter = np.asarray(n_iter).reshape(-1)
+    if n_workers is None:
+        n_workers = pool._processes
+    chunks = lpt_chunks(n_iter, n_workers * chunks_per_worker)
+    results = [None] * len(n_iter)
+    tasks = ((chunk_fn, indices, x_0[indices], n_iter[indices]) for indices in chunks)
+    for indices, chunk_results in pool.imap_unordered(_run_chunk, tasks):
+        for i, result in zip(indices, chunk_results):
+            results[i] = result
+    return results
+
+
+@contextmanager
+def thread_executor(n_threads, layout=None):
+    """
+    Thread pool whose threads are pinned by layout, if given, when they start. The
+    OpenMP team size of layout is set for the process while the pool is open, the
+    team size from before is restored once no thread_executor is open
+    Takes
+        n_threads(int) - number of threads
+        layout(dict) - layout from parallel_layout
+    """
+    if layout is None:
+        with ThreadPoolExecutor(n_threads) as executor:
+            yield executor
+        return
+    if Math is not None:
+        with native_threads_lock:
+            if native_threads_state["open"] == 0:
+                # 0 when unset, restored as left to OpenMP
+                native_threads_state["previous"] = Math.get_native_threads_setting()
+            native_threads_state["open"] += 1
+            Math.set_native_threads(layout["omp_threads"])
+    try:
+        with ThreadPoolExecutor(
+            n_threads, initializer=init_layout_thread, initargs=(layout, itertools.count())
+        ) as executor:
+            yield executor
+    finally:
+        if Math is not None:
+            with native_threads_lock:
+                native_threads_state["open"] -= 1
+                if native_threads_state["open"] == 0:
+                    Math.set_native_threads(native_threads_state["previous"])
+
+
+def run_chunks_threaded(chunk_fn, x_0, n_iter, n_threads, chunks_per_worker=8, layout=None):
+    """
+    run_chunks_scheduled on a thread pool, for tasks spending their time in native
+    kernels that release the GIL. The threads read the arrays of the calling
+    process, nothing is pickled or copied per worker
+    Takes:
+        chunk_fn(callable) - task of a chunk, called as chunk_fn(x_0, n_iter) and
+            returning one result per streamline
+        x_0(array) - (L, 3) array of box positions
+        n_iter(array) - (L,) number of iterations of propagation of each streamline
+        n_threads(int) - number of threads
+        chunks_per_worker(int) - chunks packed per thread
+        layout(dict) - layout from parallel_layout the threads are pinned by
+    Returns:
+        results(list) - result of every streamline in input order
+    """
+    x_0 = np.asarray(x_0)
+    n_iter = np.asarray(n_iter).reshape(-1)
+    results = [None] * len(n_iter)
+    # the executor hands out chunks in submission order, costliest first
+    with thread_executor(n_threads, layout) as executor:
+        futures = {
+            executor.submit(chunk_fn, x_0[indices], n_iter[indices]): indices
+            for indices in lpt_chunks(n_iter, n_threads * chunks_per_worker)
+        }
+        for future in as_completed(futures):
+            for i, result in zip(futures[future], future.result()):
+                results[i] = result
+    return results
+
+
+def map_points_threaded(points_fn, points, n_threads, chunks_per_worker=8, layout=None):
+    """
+    Evaluates a function of a set of points, like the field on a grid, on a thread
+    pool in contiguous chunks
+    Takes:
+        points_fn(callable) - returns an array with one row per point of a chunk
+        points(array) - (L, 3) array of positions
+        n_threads(int) - number of threads
+        chunks_per_worker(int) - chunks per thread
+        layout(dict) - layout from parallel_layout the threads are pinned by
+    Returns:
+        values(array) - rows of points_fn for all points in input order
+    """
+    chunks = np.array_split(
+        np.asarray(points), max(1, min(len(points), n_threads * chunks_per_worker))
+    )
+    with thread_executor(n_threads, layout) as executor:
+        return np.concatenate(list(executor.map(points_fn, chunks)))
+
+
+# per-process state of topology pool workers, filled once by init_topo_worker
+_worker_state = {}
+
+
+def init_topo_worker(
+    charges_descriptor, step_size, dimensions, integrator="euler", tol=1e-4, analytic_curvature=False
+):
+    """
+    Pool initializer that attaches a worker to the shared charges of a structure
+    Takes:
+        charges_descriptor(list) - SharedCharges.descriptor of the charges
+        step_size(float) - step size of each step
+        dimensions(array) - box limits
+        integrator(str) - euler, rk4 or rk45
+        tol(float) - local error tolerance of the rk45 integrator
+        analytic_curvature(bool) - curvature from the field gradient instead of extra steps
+    """
+    blocks = []
+    arrays = []
+    for name, shape, dtype in charges_descriptor:
+        shm = shared_memory.SharedMemory(name=name)
+        blocks.append(shm)
+        arrays.append(np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf))
+    _worker_state["blocks"] = blocks
+    _worker_state["x"], _worker_state["Q"] = arrays
+    _worker_state["step_size"] = step_size
+    _worker_state["dimensions"] = dimensions
+    _worker_state["integrator"] = integrator
+    _worker_state["tol"] = tol
+    _worker_state["analytic_curvature"] = analytic_curvature
+
+
+# attachments of a persistent worker to the structures it worked on last, most recent last
+_worker_frames = OrderedDict()
+
+
+def release_frame(state):
+    """
+    Detaches a worker from the shared charges held in an attachment state
+    """
+    blocks = state.pop("blocks", [])
+    # the arrays are views of the blocks and have to go before the blocks close
+    state.clear()
+    for shm in blocks:
+        shm.close()
+
+
+def frame_chunk(frame, chunk_fn, x_0, n_iter, max_frames=4):
+    """
+    Runs a chunk for a structure on a persistent worker. The worker attaches to
+    the charges of a structure the first time it sees it and keeps the last
+    max_frames attachments, so chunks of structures running side by side do not
+    reattach every time
+    Takes:
+        frame(tuple) - arguments of init_topo_worker for the structure
+        chunk_fn(callable) - task of a chunk, called as chunk_fn(x_0, n_iter)
+        x_0(array) - (B, 3) array of box positions
+        n_iter(array) - (B,) number of iterations of propagation of each streamline
+        max_frames(int) - attachments kept by the worker
+    Returns:
+        results(list) - result of chunk_fn
+    """
+    # the shared memory names are unique to the structure
+    key = tuple(name for name, _, _ in frame[0])
+    if key not in _worker_frames:
+        init_topo_worker(*frame)
+        _worker_frames[key] = dict(_worker_state)
+        while len(_worker_frames) > max_frames:
+            release_frame(_worker_frames.popitem(last=False)[1])
+    _worker_frames.move_to_end(key)
+    _worker_state.update(_worker_frames[key])
+    return chunk_fn(x_0, n_iter)
+
+
+class TopoPool:
+    """
+    Pool of topology workers kept alive across structures, so a run over many
+    frames starts its processes once. The charges of each structure are put in
+    shared memory for the duration of its streamlines and workers attach to them
+    on their first chunk of that structure. Several structures can run at once from
+    different threads, their chunks share the queue of the pool. The processes are
+    started on first use, pinned to the cpus given by parallel_layout
+    Takes
+        processes(int) - requested number of worker processes, capped at the cores
+        omp_threads(int) - OpenMP threads per worker, the cpus of a worker if None
+        pin(bool) - whether workers are pinned to their cpus
+    """
+
+    def __init__(self, processes, omp_threads=None, pin=True):
+        self.layout = parallel_layout(processes, omp_threads, pin)
+        self.processes = self.layout["workers"]
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def map_streamlines(
+        self,
+        chunk_fn,
+        x,
+        Q,
+        x_0,
+        n_iter,
+        step_size,
+        dimensions,
+        integrator="euler",
+        tol=1e-4,
+        analytic_curvature=False,
+        chunks_per_worker=8,
+    ):
+        """
+        Runs the streamlines of one structure in cost balanced chunks
+        Takes
+            chunk_fn(callable) - picklable task of a chunk reading the charges set up by
+                init_topo_worker, called as chunk_fn(x_0, n_iter)
+            x(array) - positions of charges of shape (N,3)
+            Q(array) - magnitude and sign of charges of shape (N,1)
+            x_0(array) - starting points of the streamlines of shape (L,3)
+            n_iter(array) - maximum number of steps of each streamline of shape (L,)
+            step_size(float) - step size of each step
+            dimensions(array) - box limits
+            integrator(str) - euler, rk4 or rk45
+            tol(float) - local error tolerance of the rk45 integrator
+            analytic_curvature(bool) - curvature from the field gradient instead of extra steps
+            chunks_per_worker(int) - chunks packed per worker
+        Returns
+            results(list) - result of every streamline in input order
+        """
+        with SharedCharges(x, Q) as charges:
+            self.start()
+            frame = (charges.descriptor, step_size, dimensions, integrator, tol, analytic_curvature)
+            return run_chunks_scheduled(
+                self.pool,
+                partial(frame_chunk, frame, chunk_fn),
+                x_0,
+                n_iter,
+                chunks_per_worker,
+                self.processes,
+            )
+
+    def start(self):
+        """
+        Starts the worker processes if they are not running yet. Called from the main
+        thread before other threads are started, so workers are not forked while
+        another thread holds a lock
+        """
+        with self.lock:
+            if self.pool is None:
+                # workers report to the resource tracker of this process instead of
+                # starting their own
+                resource_tracker.ensure_running()
+                self.pool = Pool(
+                    self.processes,
+                    initializer=init_layout_process,
+                    initargs=(self.layout, Value("i", 0)),
+                )
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def integrate_streamline_rk45(x_0, n_iter, field_fn, step_size, dimensions, tol):
+    """
+    Adaptive rk45 streamline from a single point
+    Takes:
+        x_0(array) - (3, 1) array of box position
+        n_iter(int) - number of fixed steps giving the arc length of the streamline
+        field_fn(callable) - returns the electric field at a single point
+        step_size(float) - step size of each fixed step
+        dimensions(array) - box limits
+        tol(float) - local error tolerance of each step
+    Returns:
+        x_0(array) - last point of the streamline
+    """
+    x_final = integrate_streamlines_batch(
+        np.reshape(x_0, (1, 3)),
+        [n_iter],
+        lambda points: np.array([field_fn(point) for point in points]),
+        step_size,
+        dimensions,
+        integrator="rk45",
+        tol=tol,
+    )[0]
+    return x_final.astype(np.asarray(x_0).dtype)
+
+
+def analytic_streamline_result(x_init, x_0, x, Q):
+    """
+    Distance and mean curvature of a streamline, with the curvature at both ends
+    taken from the field gradient
+    Takes:
+        x_init(array) - first point of the streamline
+        x_0(array) - last point of the streamline
+        x(np array) - positions of charges
+        Q(np array) - charge values
+    Returns:
+        result(tuple) - distance and mean curvature
+    """
+    curvature = analytic_curvature_batch(
+        *calculate_field_gradient_points(np.array([x_init, x_0]), x, Q)
+    )
+    dist = np.linalg.norm(np.asarray(x_0, dtype=np.float64) - x_init)
+    return dist, np.mean(curvature)
+
+
+def task_base(
+    x_0, n_iter, x, Q, step_size, dimensions, integrator="euler", tol=1e-4, analytic_curvature=False
+):
     """
     Takes:
         x_0(array) - (3, 1) array of box position
@@ -19,38 +604,79 @@ def task_base(x_0, n_iter, x, Q, step_size, dimensions):
         Q(np array) - charge values
         step_size(float) - step size of each step
         dimensions(array) - box limits
+        integrator(str) - euler, rk4 or rk45
+        tol(float) - local error tolerance of the rk45 integrator
+        analytic_curvature(bool) - curvature from the field gradient instead of extra steps
     """
 
     # print("start task")
     x_init = x_0
-    for j in range(n_iter):
-        # if j == 0:
-        #    debug=True
-        # else:
-        #    debug = False
-        # x_0 = propagate_topo_dev(x_0, self.x, self.Q, self.step_size)
-
-        x_0 = propagate_topo(x_0, x, Q, step_size)
-        if not Inside_Box(x_0, dimensions):
-            # count += 1
-            endtype = "box"
-            break
-        else:
-            endtype = "path"
-
-    x_init_plus = propagate_topo(x_init, x, Q, step_size)
-    x_init_plus_plus = propagate_topo(x_init_plus, x, Q, step_size)
-    x_0_plus = propagate_topo(x_0, x, Q, step_size)
-    x_0_plus_plus = propagate_topo(x_0_plus, x, Q, step_size)
-    init_points = np.array([x_init, x_init_plus, x_init_plus_plus])
-    final_points = np.array([x_0, x_0_plus, x_0_plus_plus])
-    result = compute_curv_and_dist(
-        x_init, x_init_plus, x_init_plus_plus, x_0, x_0_plus, x_0_plus_plus
-    )
+    if integrator == "rk45":
+        x_0 = integrate_streamline_rk45(
+            x_0,
+            n_iter,
+            lambda point: calculate_electric_field_base(point, x, Q),
+            step_size,
+            dimensions,
+            tol,
+        )
+        endtype = "path" if Inside_Box(x_0, dimensions) else "box"
+    else:
+        for j in range(n_iter):
+            # if j == 0:
+            #    debug=True
+            # else:
+            #    debug = False
+            # x_0 = propagate_topo_dev(x_0, self.x, self.Q, self.step_size)
+
+            x_prev = x_0
+            x_0 = propagate_topo(x_0, x, Q, step_size, integrator=integrator)
+            if not Inside_Box(x_0, dimensions):
+                # count += 1
+                endtype = "box"
+                if integrator != "euler":
+                    x_0 = clip_to_box_batch(x_prev, x_0, dimensions)
+                break
+            else:
+                endtype = "path"
+
+    if analytic_curvature:
+        init_points = np.array([x_init])
+        final_points = np.array([x_0])
+        result = analytic_streamline_result(x_init, x_0, x, Q)
+    elif integrator == "euler":
+        x_init_plus = propagate_topo(x_init, x, Q, step_size)
+        x_init_plus_plus = propagate_topo(x_init_plus, x, Q, step_size)
+        x_0_plus = propagate_topo(x_0, x, Q, step_size)
+        x_0_plus_plus = propagate_topo(x_0_plus, x, Q, step_size)
+        init_points = np.array([x_init, x_init_plus, x_init_plus_plus])
+        final_points = np.array([x_0, x_0_plus, x_0_plus_plus])
+        result = compute_curv_and_dist(
+            x_init, x_init_plus, x_init_plus_plus, x_0, x_0_plus, x_0_plus_plus
+        )
+    else:
+        # central curvature stencil, second order like the integrator
+        init_points = np.array(
+            [
+                propagate_topo(x_init, x, Q, -step_size, integrator="rk4"),
+                x_init,
+                propagate_topo(x_init, x, Q, step_size, integrator="rk4"),
+            ]
+        )
+        final_points = np.array(
+            [
+                propagate_topo(x_0, x, Q, -step_size, integrator="rk4"),
+                x_0,
+                propagate_topo(x_0, x, Q, step_size, integrator="rk4"),
+            ]
+        )
+        result = compute_curv_and_dist_central_batch(*init_points, *final_points)
     return result[0], result[1], init_points, final_points, endtype
 
 
-def task(x_0, n_iter, x, Q, step_size, dimensions):
+def task(
+    x_0, n_iter, x, Q, step_size, dimensions, integrator="euler", tol=1e-4, analytic_curvature=False
+):
     """
     Takes:
         x_0(array) - (3, 1) array of box position
@@ -59,36 +685,67 @@ def task(x_0, n_iter, x, Q, step_size, dimensions):
         Q(np array) - charge values
         step_size(float) - step size of each step
         dimensions(array) - box limits
+        integrator(str) - euler, rk4 or rk45
+        tol(float) - local error tolerance of the rk45 integrator
+        analytic_curvature(bool) - curvature from the field gradient instead of extra steps
     """
 
     # print("start task")
     x_init = x_0
-    for j in range(n_iter):
-        # if j == 0:
-        #    debug=True
-        # else:
-        #    debug = False
-        # x_0 = propagate_topo_dev(x_0, self.x, self.Q, self.step_size)
-
-        x_0 = propagate_topo_dev(x_0, x, Q, step_size)
-        if not Inside_Box(x_0, dimensions):
-            # count += 1
-            break
+    if integrator == "rk45":
+        x_0 = integrate_streamline_rk45(
+            x_0,
+            n_iter,
+            lambda point: calculate_electric_field_dev_c_shared(point, x, Q),
+            step_size,
+            dimensions,
+            tol,
+        )
+    else:
+        for j in range(n_iter):
+            # if j == 0:
+            #    debug=True
+            # else:
+            #    debug = False
+            # x_0 = propagate_topo_dev(x_0, self.x, self.Q, self.step_size)
+
+            x_prev = x_0
+            x_0 = propagate_topo_dev(x_0, x, Q, step_size, integrator=integrator)
+            if not Inside_Box(x_0, dimensions):
+                # count += 1
+                if integrator != "euler":
+                    x_0 = clip_to_box_batch(x_prev, x_0, dimensions)
+                break
     #print(x_0 - x_init)
     #print("step size {} n_iter {} norm {}".format(step_size, n_iter, np.linalg.norm(x_0 - x_init)))
 
-    x_init_plus = propagate_topo_dev(x_init, x, Q, step_size)
-    x_init_plus_plus = propagate_topo_dev(x_init_plus, x, Q, step_size)
-    x_0_plus = propagate_topo_dev(x_0, x, Q, step_size)
-    x_0_plus_plus = propagate_topo_dev(x_0_plus, x, Q, step_size)
+    if analytic_curvature:
+        result = analytic_streamline_result(x_init, x_0, x, Q)
+    elif integrator == "euler":
+        x_init_plus = propagate_topo_dev(x_init, x, Q, step_size)
+        x_init_plus_plus = propagate_topo_dev(x_init_plus, x, Q, step_size)
+        x_0_plus = propagate_topo_dev(x_0, x, Q, step_size)
+        x_0_plus_plus = propagate_topo_dev(x_0_plus, x, Q, step_size)
 
-    result = compute_curv_and_dist(
-        x_init, x_init_plus, x_init_plus_plus, x_0, x_0_plus, x_0_plus_plus
-    )
+        result = compute_curv_and_dist(
+            x_init, x_init_plus, x_init_plus_plus, x_0, x_0_plus, x_0_plus_plus
+        )
+    else:
+        # central curvature stencil, second order like the integrator
+        result = compute_curv_and_dist_central_batch(
+            propagate_topo_dev(x_init, x, Q, -step_size, integrator="rk4"),
+            x_init,
+            propagate_topo_dev(x_init, x, Q, step_size, integrator="rk4"),
+            propagate_topo_dev(x_0, x, Q, -step_size, integrator="rk4"),
+            x_0,
+            propagate_topo_dev(x_0, x, Q, step_size, integrator="rk4"),
+        )
     return result
 
 
-def task_complete_thread(x_0, n_iter, x, Q, step_size, dimensions):
+def task_complete_thread(
+    x_0, n_iter, x, Q, step_size, dimensions, integrator="euler", tol=1e-4, analytic_curvature=False
+):
     """
     Takes:
         x_0(array) - (3, 1) array of box position
@@ -97,65 +754,209 @@ def task_complete_thread(x_0, n_iter, x, Q, step_size, dimensions):
         Q(np array) - charge values
         step_size(float) - step size of each step
         dimensions(array) - box limits
+        integrator(str) - euler, rk4 or rk45
+        tol(float) - local error tolerance of the rk45 integrator
+        analytic_curvature(bool) - curvature from the field gradient instead of extra steps
     """
 
     result = calculate_thread_c_shared(
-        x_0=x_0, n_iter=n_iter, x=x, Q=Q, step_size=step_size, dimensions=dimensions
+        x_0=x_0,
+        n_iter=n_iter,
+        x=x,
+        Q=Q,
+        step_size=step_size,
+        dimensions=dimensions,
+        integrator=integrator,
+        tol=tol,
+        analytic_curvature=analytic_curvature,
     )
     # print("result: ", result)
     return result
 
 
-def task_batch(x_0_list, n_iter, x, Q, step_size, dimensions):
-    x_init = x_0_list
-    mask_list = None
-    n_iter_max = np.max(n_iter)
-    for j in range(n_iter_max):
-        # print("mask list {}".format(mask_list))
-        # x_0 = propagate_topo_dev(x_0, self.x, self.Q, self.step_size)
+def task_batch(
+    x_0_list, n_iter, x, Q, step_size, dimensions, integrator="euler", tol=1e-4, analytic_curvature=False
+):
+    """
+    Pure NumPy topology of a batch of streamlines, advanced together on an active
+    set with finished streamlines compacted out every step
+    Takes:
+        x_0_list(array) - (B, 3) array of box positions
+        n_iter(array) - (B,) number of iterations of propagation of each streamline
+        x(np array) - positions of charges
+        Q(np array) - charge values
+        step_size(float) - step size of each step
+        dimensions(array) - box limits
+        integrator(str) - euler, rk4 or rk45
+        tol(float) - local error tolerance of the rk45 integrator
+        analytic_curvature(bool) - curvature from the field gradient instead of extra steps
+    Returns:
+        hist(array) - (B, 2) distance and mean curvature of each streamline
+    """
+    return compute_topo_field_batch(
+        x_0_list,
+        n_iter,
+        lambda points: calculate_electric_field_points(points, x, Q),
+        step_size,
+        dimensions,
+        integrator,
+        tol,
+        field_gradient_fn=(
+            (lambda points: calculate_field_gradient_points(points, x, Q))
+            if analytic_curvature
+            else None
+        ),
+    )
 
-        x_0_list = propagate_topo_dev_batch(
-            x_0_list, x, Q, step_size, mask_list=mask_list
-        )
-        # print("passed first iter")
-        inside_box_list = [bool(Inside_Box(x, dimensions)) for x in x_0_list]
-        # filter list consists of indicies where n_iter[i] < j
-        rand_stop_cond = [bool(j <= n_iter[i]) for i in range(len(n_iter))]
-
-        # print("inside box: {}".format(inside_box_list))
-        # print("rand stop: {}".format(rand_stop_cond))
-        # create mask list where it's true is inside_box or filter_list
-        mask_list_contra = [
-            bool(rand_stop_cond[i] and inside_box_list[i]) for i in range(len(n_iter))
-        ]
-        mask_list = [not temp for temp in mask_list_contra]
-
-        # print("mask list: ", mask_list)
-        # print("mask list contra: ", mask_list_contra)
-        if all(mask_list):
-            # print("breaking")
-            break
-
-    x_init_plus = propagate_topo_dev_batch(x_init, x, Q, step_size)
-    x_init_plus_plus = propagate_topo_dev_batch(x_init_plus, x, Q, step_size)
-    x_0_plus = propagate_topo_dev_batch(x_0_list, x, Q, step_size)
-    x_0_plus_plus = propagate_topo_dev_batch(x_0_plus, x, Q, step_size)
-
-    # result_list = compute_curv_and_dist(
-    #    x_init, x_init_plus, x_init_plus_plus, x_0, x_0_plus, x_0_plus_plus
-    # )
-
-    result_list = []
-    # not currently batched
-    for ind in range(len(x_0_plus)):
-        result = compute_curv_and_dist(
-            x_init[ind],
-            x_init_plus[ind],
-            x_init_plus_plus[ind],
-            x_0_list[ind],
-            x_0_plus[ind],
-            x_0_plus_plus[ind],
-        )
-        result_list.append(result)
 
-    return result_list
+def task_base_shared(x_0, n_iter):
+    """
+    task_base on the charges attached by init_topo_worker
+    """
+    return task_base(
+        x_0,
+        n_iter,
+        _worker_state["x"],
+        _worker_state["Q"],
+        _worker_state["step_size"],
+        _worker_state["dimensions"],
+        _worker_state["integrator"],
+        _worker_state["tol"],
+        _worker_state["analytic_curvature"],
+    )
+
+
+def task_shared(x_0, n_iter):
+    """
+    task on the charges attached by init_topo_worker
+    """
+    return task(
+        x_0,
+        n_iter,
+        _worker_state["x"],
+        _worker_state["Q"],
+        _worker_state["step_size"],
+        _worker_state["dimensions"],
+        _worker_state["integrator"],
+        _worker_state["tol"],
+        _worker_state["analytic_curvature"],
+    )
+
+
+def task_complete_thread_shared(x_0, n_iter):
+    """
+    task_complete_thread on the charges attached by init_topo_worker
+    """
+    return task_complete_thread(
+        x_0,
+        n_iter,
+        _worker_state["x"],
+        _worker_state["Q"],
+        _worker_state["step_size"],
+        _worker_state["dimensions"],
+        _worker_state["integrator"],
+        _worker_state["tol"],
+        _worker_state["analytic_curvature"],
+    )
+
+
+def task_batch_shared(x_0_list, n_iter):
+    """
+    task_batch on the charges attached by init_topo_worker
+    """
+    return task_batch(
+        x_0_list,
+        n_iter,
+        _worker_state["x"],
+        _worker_state["Q"],
+        _worker_state["step_size"],
+        _worker_state["dimensions"],
+        _worker_state["integrator"],
+        _worker_state["tol"],
+        _worker_state["analytic_curvature"],
+    )
+
+
+def run_frames(
+    frames,
+    load_fn,
+    compute_fn,
+    write_fn,
+    frames_in_flight=2,
+    compute_slots=1,
+    memory_budget=None,
+    size_fn=None,
+):
+    """
+    Two level scheduler over the structures of a run: every structure goes through
+    load, compute and write on its own thread, with up to frames_in_flight of them
+    in progress, so the parsing and writing of some overlap the computation of
+    others. Within a structure the computation is parallel over streamlines or
+    grid points as usual
+    Takes
+        frames(iterable) - structures to process, each passed to the three stages
+        load_fn(callable) - parses and prepares a structure, called as load_fn(frame)
+        compute_fn(callable) - computes a loaded structure, called as compute_fn(frame, state)
+        write_fn(callable) - writes the results, called as write_fn(frame, state, results)
+        frames_in_flight(int) - most structures loaded and not yet written
+        compute_slots(int) - most structures computing at once, more than one is
+            only useful when the computation waits on a shared pool
+        memory_budget(float) - bytes the structures in flight may hold, None for no limit.
+            A structure is admitted when the budget holds it at the size of the largest
+            one loaded so far, and always when nothing else is in flight
+        size_fn(callable) - bytes held by a loaded structure, called as size_fn(state)
+    """
+    compute_lock = threading.BoundedSemaphore(max(1, compute_slots))
+    # woken whenever a structure is loaded or finished
+    changed = threading.Condition()
+    sizes = {}
+    largest = [0]
+
+    def process(index, frame):
+        state = load_fn(frame)
+        if size_fn is not None:
+            with changed:
+                sizes[index] = size_fn(state)
+                largest[0] = max(largest[0], sizes[index])
+                changed.notify()
+        with compute_lock:
+            results = compute_fn(frame, state)
+        write_fn(frame, state, results)
+
+    def notify(future):
+        with changed:
+            changed.notify()
+
+    def admit():
+        if not running:
+            return True
+        if len(running) >= frames_in_flight:
+            return False
+        if memory_budget is None:
+            return True
+        if largest[0] == 0:
+            # no structure measured yet
+            return False
+        held = sum(sizes.get(index, largest[0]) for index in running.values())
+        return held + largest[0] <= memory_budget
+
+    frames = iter(enumerate(frames))
+    running = {}
+    exhausted = False
+    with ThreadPoolExecutor(max(1, frames_in_flight)) as executor, changed:
+        while True:
+            while not exhausted and admit():
+                item = next(frames, None)
+                if item is None:
+                    exhausted = True
+                    break
+                future = executor.submit(process, *item)
+                running[future] = item[0]
+                future.add_done_callback(notify)
+            if not running:
+                break
+            changed.wait()
+            for future in [future for future in running if future.done()]:
+                sizes.pop(running.pop(future), None)
+                # errors of a structure stop the run like in the sequential loop
+                future.result()
@@ -2,6 +2,7 @@ import numpy as np
 from glob import glob
 import warnings
 import math
+from CPET.utils.io import is_volume, read_volume
 
 """
 Overall script for all visualization functions and visualization-affiliates.
@@ -43,9 +44,9 @@ def visualize_fields(fields_path, output_path, options):
 
 def process_field_file(file_path):
     '''
-    This function processes all data from the field file
+    This function processes all data from the field file, binary volume files are memory-mapped
     Inputs:
-        file_path: Path to the field file
+        file_path: Path to the field file, text or binary
     Outputs:
         sample_density: Sample density
         volume_box: Volume of the box in Angstroms
@@ -53,6 +54,12 @@ def process_field_file(file_path):
         basis_matrix: Basis matrix used for rotation
         field: Electric field values
     '''
+    if is_volume(file_path):
+        meta_data, field = read_volume(file_path)
+        sample_density = ((meta_data["num_steps"] - 1) // 2).astype(float)
+        check_field(field, sample_density)
+        return sample_density, meta_data["dimensions"], meta_data["center"], meta_data["basis"], field.astype(np.float32, copy=False)
+
     # Initialize variables
     sample_density = []
     volume_box = []
@@ -116,8 +123,8 @@ def check_field(field_array, sample_density_array):
     '''
     #print(sample_density_array)
     #print(field_array.shape)
-    if field_array.shape[0] != np.product(np.concatenate([(2*sample_density_array+1)[0:2],np.expand_dims(2*sample_density_array[2]+1, axis=0)])):
-        raise ValueError(f"Field provided does not match sample density, field of shape {field_array.shape[0]} does not match expected sample amount of {np.product(np.concatenate([(2*sample_density_array+1)[0:2],np.expand_dims(sample_density_array[2], axis=0)]))}")
+    if field_array.shape[0] != np.prod(np.concatenate([(2*sample_density_array+1)[0:2],np.expand_dims(2*sample_density_array[2]+1, axis=0)])):
+        raise ValueError(f"Field provided does not match sample density, field of shape {field_array.shape[0]} does not match expected sample amount of {np.prod(np.concatenate([(2*sample_density_array+1)[0:2],np.expand_dims(sample_density_array[2], axis=0)]))}")
     else:
         print("Field matches sample density, check passed, continuing...")
 
@@ -0,0 +1,88 @@
+import time
+import json
+import argparse
+import numpy as np
+from CPET.source.calculator import calculator
+from CPET.utils.parallel import TopoPool
+
+"""
+Benchmark of the process pool against threads driving the native kernels
+
+Times the streamlines of one structure (compute_topo_complete_c_shared) and the
+field on the volume grid (compute_box) with concurrency set to processes and to
+threads, for a range of worker counts. The grid has no process path, its processes
+column is the serial loop over grid points. Process timings use a pool started
+beforehand, as in a run over many frames, so the cost measured is the per
+structure one: shared memory setup and transfers for processes, GIL contention
+between the native calls for threads.
+"""
+
+default_options = {
+    "center": {"method": "first", "atoms": {"CD": 2}},
+    "x": {"method": "mean", "atoms": {"CG": 1, "CB": 1}},
+    "y": {"method": "inverse", "atoms": {"CA": 3, "CB": 3}},
+    "n_samples": 1000,
+    "dimensions": [1.5, 1.5, 1.5],
+    "step_size": 0.05,
+    "filter_radius": 20.0,
+    "filter_in_box": True,
+    "initializer": "uniform",
+    "CPET_method": "topo",
+    "max_streamline_init": "fixed_rand",
+    "dtype": "float32",
+}
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start_time = time.time()
+        result = fn()
+        timings.append(time.time() - start_time)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process pool against thread pool")
+    parser.add_argument("-p", type=str, help="pdb file", default="./test_files/test_large.pdb")
+    parser.add_argument("-o", type=json.loads, help="Options for CPET", default=default_options)
+    parser.add_argument(
+        "--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="worker counts to time"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="timings kept as the best of repeat")
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'task':>6} {'processes (s)':>14} {'threads (s)':>12} {'max diff':>10}")
+    for n_workers in args.workers:
+        options = dict(args.o)
+        options["concur_slip"] = n_workers
+        timings = {}
+        results = {}
+        with TopoPool(n_workers) as pool:
+            pool.start()
+            for concurrency in ["processes", "threads"]:
+                options["concurrency"] = concurrency
+                options["CPET_method"] = "topo"
+                topo = calculator(options, path_to_pdb=args.p, pool=pool)
+                timings[concurrency, "topo"], results[concurrency, "topo"] = best_of(
+                    topo.compute_topo_complete_c_shared, args.repeat
+                )
+                options["CPET_method"] = "volume"
+                box = calculator(options, path_to_pdb=args.p)
+                timings[concurrency, "box"], (results[concurrency, "box"], _) = best_of(
+                    box.compute_box, args.repeat
+                )
+        for task in ["topo", "box"]:
+            diff = np.max(
+                np.abs(
+                    np.asarray(results["processes", task], dtype=np.float64)
+                    - np.asarray(results["threads", task], dtype=np.float64)
+                )
+            )
+            print(
+                f"{n_workers:>8} {task:>6} {timings['processes', task]:>14.4f}"
+                f" {timings['threads', task]:>12.4f} {diff:>10.2e}"
+            )
+
+
+main()
@@ -0,0 +1,77 @@
+import time
+import json
+import argparse
+import numpy as np
+from CPET.source.calculator import calculator
+from CPET.utils.calculator import (
+    Math,
+    calculate_electric_field_points,
+    charges_to_soa,
+    calculate_electric_field_soa,
+)
+
+"""
+Micro-benchmark of the native Coulomb kernels
+
+Reports charges * evaluations per second of the single point kernels
+(calc_field_base and calc_field, called once per point) and of the
+structure-of-arrays kernel (calc_field_soa_batch) with and without Morton
+ordering of the charges, together with the largest relative error against the
+float64 NumPy sum.
+"""
+
+default_options = {
+    "center": {"method": "first", "atoms": {"CD": 2}},
+    "x": {"method": "mean", "atoms": {"CG": 1, "CB": 1}},
+    "y": {"method": "inverse", "atoms": {"CA": 3, "CB": 3}},
+    "n_samples": 100,
+    "dimensions": [1.5, 1.5, 1.5],
+    "step_size": 0.05,
+    "initializer": "uniform",
+    "CPET_method": "topo",
+    "dtype": "float32",
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the native field kernels")
+    parser.add_argument("-p", type=str, help="pdb file", default="./test_files/test_large.pdb")
+    parser.add_argument("-o", type=json.loads, help="Options for CPET", default=default_options)
+    parser.add_argument("--n_points", type=int, default=2000, help="number of field evaluations")
+    parser.add_argument("--repeat", type=int, default=3, help="timings kept as the best of repeat")
+    args = parser.parse_args()
+
+    topo = calculator(args.o, path_to_pdb=args.p)
+    x = np.ascontiguousarray(topo.x, dtype=np.float32)
+    Q = np.ascontiguousarray(topo.Q, dtype=np.float32).reshape(-1)
+    rng = np.random.default_rng(0)
+    points = np.ascontiguousarray(
+        rng.uniform(-1, 1, (args.n_points, 3)) * topo.dimensions, dtype=np.float32
+    )
+    reference = calculate_electric_field_points(points, x, Q)
+
+    x_soa, Q_soa = charges_to_soa(x, Q, sort=False)
+    x_morton, Q_morton = charges_to_soa(x, Q, sort=True)
+    kernels = {
+        "calc_field_base": lambda: np.array([Math.calc_field_base(p, x, Q) for p in points]),
+        "calc_field": lambda: np.array([Math.calc_field(p, x, Q) for p in points]),
+        "soa": lambda: calculate_electric_field_soa(points, x_soa, Q_soa),
+        "soa_morton": lambda: calculate_electric_field_soa(points, x_morton, Q_morton),
+    }
+
+    print(f"{len(Q)} charges, {len(points)} points")
+    print(f"{'kernel':>16} {'time (s)':>10} {'charges*evals/s':>16} {'max rel err':>12}")
+    for name, kernel in kernels.items():
+        timings = []
+        for _ in range(args.repeat):
+            start_time = time.time()
+            E = kernel()
+            timings.append(time.time() - start_time)
+        best = min(timings)
+        err = np.max(
+            np.linalg.norm(E - reference, axis=1) / np.linalg.norm(reference, axis=1)
+        )
+        print(f"{name:>16} {best:>10.4f} {len(Q) * len(points) / best:>16.3e} {err:>12.2e}")
+
+
+main()
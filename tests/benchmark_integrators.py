@@ -0,0 +1,109 @@
+import time
+import json
+import argparse
+import numpy as np
+from CPET.source.calculator import calculator
+from CPET.utils.calculator import (
+    calculate_electric_field_points,
+    calculate_thread_batch_c_shared,
+    compute_topo_field_batch,
+)
+
+"""
+Benchmarks the streamline integrators against an Euler reference
+
+Every streamline keeps the same start point and arc length for all step sizes.
+The reference is forward Euler at a fine step in float64. For each integrator and
+step size the script reports the number of field evaluations, the time of the
+vectorized and native engines and the median relative error of the distances and
+curvatures against the reference.
+"""
+
+default_options = {
+    "center": {"method": "first", "atoms": {"CD": 2}},
+    "x": {"method": "mean", "atoms": {"CG": 1, "CB": 1}},
+    "y": {"method": "inverse", "atoms": {"CA": 3, "CB": 3}},
+    "n_samples": 100,
+    "dimensions": [1.5, 1.5, 1.5],
+    "step_size": 0.05,
+    "filter_radius": 20.0,
+    "filter_in_box": True,
+    "initializer": "uniform",
+    "CPET_method": "topo",
+    "max_streamline_init": "fixed_rand",
+    "dtype": "float32",
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the streamline integrators")
+    parser.add_argument("-p", type=str, help="pdb file", default="./test_files/test_large.pdb")
+    parser.add_argument("-o", type=json.loads, help="Options for CPET", default=default_options)
+    parser.add_argument("--steps", type=float, nargs="+", default=[0.1, 0.05, 0.02, 0.01])
+    parser.add_argument("--reference_step", type=float, default=0.001)
+    parser.add_argument("--tol", type=float, default=1e-4, help="rk45 local error tolerance")
+    parser.add_argument("--out", type=str, default=None, help="json file for the results")
+    args = parser.parse_args()
+
+    topo = calculator(args.o, path_to_pdb=args.p)
+    x_0 = topo.random_start_points
+    lengths = topo.random_max_samples * topo.step_size
+    n_evaluations = [0]
+
+    def field_fn(points):
+        n_evaluations[0] += len(points)
+        return calculate_electric_field_points(points, topo.x, topo.Q)
+
+    def n_iter(step):
+        return np.maximum(np.round(lengths / step).astype(int), 1)
+
+    start_time = time.time()
+    reference = compute_topo_field_batch(
+        x_0, n_iter(args.reference_step), field_fn, args.reference_step, topo.dimensions
+    )
+    print(
+        f"Euler reference at step {args.reference_step}: {n_evaluations[0]} field evaluations "
+        f"in {time.time() - start_time:.2f} seconds"
+    )
+
+    results = []
+    print(
+        f"{'integrator':>10} {'step':>6} {'evaluations':>12} {'numpy (s)':>10} "
+        f"{'native (s)':>10} {'dist err':>10} {'curv err':>10}"
+    )
+    for integrator in ["euler", "rk4", "rk45"]:
+        for step in args.steps:
+            n_evaluations[0] = 0
+            start_time = time.time()
+            hist = compute_topo_field_batch(
+                x_0, n_iter(step), field_fn, step, topo.dimensions, integrator, args.tol
+            )
+            time_numpy = time.time() - start_time
+            start_time = time.time()
+            calculate_thread_batch_c_shared(
+                x_0, n_iter(step), topo.x, topo.Q, step, topo.dimensions, integrator, args.tol
+            )
+            time_native = time.time() - start_time
+            err = np.median(np.abs(hist - reference) / np.abs(reference), axis=0)
+            results.append(
+                {
+                    "integrator": integrator,
+                    "step_size": step,
+                    "field_evaluations": n_evaluations[0],
+                    "time_numpy": time_numpy,
+                    "time_native": time_native,
+                    "dist_rel_error": float(err[0]),
+                    "curv_rel_error": float(err[1]),
+                }
+            )
+            print(
+                f"{integrator:>10} {step:>6} {n_evaluations[0]:>12} {time_numpy:>10.2f} "
+                f"{time_native:>10.2f} {err[0]:>10.2e} {err[1]:>10.2e}"
+            )
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+main()
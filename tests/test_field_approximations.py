@@ -0,0 +1,94 @@
+import numpy as np
+from CPET.source.calculator import calculator
+from CPET.utils.calculator import (
+    calculate_electric_field_points,
+    calculate_esp_points,
+    compare_fields,
+)
+from CPET.utils.octree import Octree
+from CPET.utils.lattice import FieldLattice
+import warnings
+warnings.filterwarnings(action='ignore')
+
+
+class Test_field_approximations:
+    options = {
+        "center": {
+                "method": "first",
+                "atoms": {
+                        "CD": 2
+                }
+        },
+        "x": {
+                "method": "mean",
+                "atoms": {
+                        "CG": 1,
+                        "CB": 1
+                }
+        },
+        "y": {
+                "method": "inverse",
+                "atoms": {
+                        "CA": 3,
+                        "CB": 3
+                }
+        },
+        "n_samples": 300,
+        "dimensions": [1.5, 1.5, 1.5],
+        "step_size": 0.05,
+        "filter_radius": 30.0,
+        "filter_in_box": True,
+        "initializer": "uniform",
+        "CPET_method": "topo",
+        "max_streamline_init": "fixed_rand",
+        "dtype": "float32",
+    }
+    topo = calculator(options, path_to_pdb="./test_files/test_large.pdb")
+    points = topo.random_start_points[::5]
+    reference_field = calculate_electric_field_points(points, topo.x, topo.Q)
+    reference_hist = topo.compute_topo_complete_c_batch()
+
+    def test_vectorized_exact(self):
+        hist = self.topo.compute_topo_vectorized()
+        np.testing.assert_allclose(self.reference_hist, hist, rtol=1e-2, atol=1e-2)
+
+    def test_octree_zero_angle(self):
+        # with a zero opening angle every charge is summed directly
+        tree = Octree(self.topo.x, self.topo.Q, theta=0.0)
+        np.testing.assert_allclose(tree.field(self.points), self.reference_field, rtol=1e-6)
+        np.testing.assert_allclose(
+            tree.esp(self.points),
+            calculate_esp_points(self.points, self.topo.x, self.topo.Q),
+            rtol=1e-6,
+        )
+
+    def test_octree_error_report(self):
+        tree = Octree(self.topo.x, self.topo.Q, theta=0.3)
+        report = tree.error_report(self.points, self.topo.x, self.topo.Q)
+        assert report["n_points"] == len(self.points)
+        assert report["mean_rel_error"] < 2e-2, "octree field too far from the exact sum"
+
+    def test_multipole_far_field(self):
+        options = dict(self.options)
+        options["field_method"] = "multipole"
+        options["multipole_tol"] = 1e-3
+        topo = calculator(options, path_to_pdb="./test_files/test_large.pdb")
+        assert len(topo.Q_near) < len(topo.Q)
+        report = topo.field_error_report()
+        assert report["max_rel_error"] < 1e-2, "far-field expansion too far from the exact sum"
+        hist = topo.compute_topo_vectorized()
+        np.testing.assert_allclose(self.reference_hist, hist, rtol=1e-2, atol=1e-2)
+
+    def test_field_lattice(self):
+        lattice = FieldLattice(
+            lambda p: calculate_electric_field_points(p, self.topo.x, self.topo.Q),
+            np.asarray(self.topo.dimensions) + 3 * self.topo.step_size,
+            spacing=0.2,
+            tol=1e-4,
+        )
+        report = compare_fields(lattice.field(self.points), self.reference_field)
+        assert report["max_rel_error"] < 1e-3, "lattice interpolation too far from the exact sum"
+        # visited cells are cached, a second pass evaluates no new nodes
+        n_evaluations = lattice.n_field_evaluations
+        lattice.field(self.points)
+        assert lattice.n_field_evaluations == n_evaluations
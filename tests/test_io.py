@@ -1,4 +1,23 @@
-from CPET.utils.io import parse_pqr
+import os
+import gzip
+import shutil
+import struct
+import tarfile
+import CPET.utils.io as io
+from CPET.utils.io import (
+    parse_pqr,
+    parse_pdb,
+    parse_structure,
+    Trajectory,
+    DCDTrajectory,
+    archive_members,
+    save_numpy_as_dat,
+    save_volume,
+    read_volume,
+    volume_to_dat,
+    read_mat,
+)
+from CPET.utils.calculator import make_fields
 
 import numpy as np
 
@@ -55,3 +74,224 @@ def test_pqr_parser_resid():
     assert resid[-10] == "HEM", "resid parse is wrong"
     assert resid[10] == "ARG", "resid parse is wrong"
     assert resid[16492] == "THR", "resid parse is wrong"
+
+
+def test_pqr_six_digit_serials(tmp_path):
+    """Test atom numbers of 100000 and above, which run into the record name"""
+    lines = [
+        "ATOM  99999  N   ARG A   1      78.012  97.787 135.684 -0.239  1.550",
+        "ATOM 100000  CA  ALA A   1      77.939  98.010 134.247 -0.035  1.700",
+        "ATOM 123456  C   ALA A1234      78.162  99.503 133.902  0.199  1.700",
+        "HETATM100001 FE   FE1 E   1     104.785 113.388 117.966  0.426  1.390",
+        "HETATM 31357 FE   FE2 E   2      88.947  90.302  82.037  0.418  1.390",
+    ]
+    path = str(tmp_path / "serials.pqr")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    x, Q, atom_number, residue_name, residue_number, atom_type = parse_structure(path)
+    assert list(atom_number) == [99999, 100000, 123456, 100001, 31357]
+    assert list(residue_number) == [1, 1, 1234, 1, 2]
+    assert list(residue_name) == ["ARG", "ALA", "ALA", "FE1", "FE2"]
+    assert list(atom_type) == ["N", "CA", "C", "FE", "FE"]
+    assert np.allclose(x[2], [78.162, 99.503, 133.902])
+    assert np.allclose(Q[:, 0], [-0.239, -0.035, 0.199, 0.426, 0.418])
+
+    # the serial is the first token after the record name, as in the whitespace parser
+    serials = []
+    with open("./test_files/test_large.pqr") as f:
+        for line in f:
+            if line.startswith("ATOM") or line.startswith("HETATM"):
+                token = line.split()[0]
+                serials.append(int(token[6:]) if len(token) > 6 else int(line.split()[1]))
+    assert np.array_equal(parse_structure("./test_files/test_large.pqr")[2], serials)
+
+
+def test_parse_structure_cache(tmp_path, monkeypatch):
+    """Test the sidecar cache of parsed structures"""
+    for name in ["test_large.pqr", "test_large.pdb"]:
+        path = str(tmp_path / name)
+        shutil.copy("./test_files/" + name, path)
+        parsed = parse_structure(path, cache=True)
+        assert os.path.exists(path + ".cpet.npz"), "sidecar not written"
+        if name.endswith(".pqr"):
+            reference = parse_pqr(path)
+        else:
+            reference = parse_pdb(path, get_charges=True)
+        for a, b in zip(parsed, reference):
+            assert np.array_equal(a, b), "parse_structure differs from the parser"
+
+        # unchanged contents are read from the sidecar, also after a touch
+        with monkeypatch.context() as m:
+            m.setattr(io, "atom_records", None)
+            for a, b in zip(parse_structure(path, cache=True), parsed):
+                assert np.array_equal(a, b), "cached arrays differ"
+            os.utime(path, ns=(0, 0))
+            for a, b in zip(parse_structure(path, cache=True), parsed):
+                assert np.array_equal(a, b), "cached arrays differ after touch"
+
+        # same size, different contents
+        with open(path, "r+b") as f:
+            data = f.read()
+            f.seek(0)
+            f.write(data.replace(b"ATOM", b"REMK", 1))
+        x = parse_structure(path, cache=True)[0]
+        assert len(x) == len(parsed[0]) - 1, "changed file read from the sidecar"
+
+
+def write_models(source, path, shifts):
+    """Writes the atoms of source as one model per shift, translated by it"""
+    with open(source) as f:
+        atoms = [line for line in f if line.startswith(("ATOM", "HETATM"))]
+    with open(path, "w") as f:
+        for model, shift in enumerate(shifts, start=1):
+            f.write("MODEL     {:>4}\n".format(model))
+            for line in atoms:
+                xyz = [float(line[30 + 8 * i : 38 + 8 * i]) + shift[i] for i in range(3)]
+                f.write(line[:30] + "".join("{:8.3f}".format(c) for c in xyz) + line[54:])
+            f.write("ENDMDL\n")
+
+
+def test_trajectory(tmp_path):
+    """Test streaming the models of a multi-MODEL pdb"""
+    path = str(tmp_path / "traj.pdb")
+    shifts = [(0.0, 0.0, 0.0), (1.0, -2.0, 0.5), (-3.0, 0.25, 4.0)]
+    write_models("./test_files/test_large.pdb", path, shifts)
+    reference = parse_pdb("./test_files/test_large.pdb", get_charges=True)
+    with Trajectory(path) as trajectory:
+        assert trajectory.n_atoms == len(reference[0])
+        for a, b in zip(
+            (trajectory.Q, trajectory.residue_name, trajectory.residue_number, trajectory.atom_type),
+            (reference[1], reference[3], reference[4], reference[5]),
+        ):
+            assert np.array_equal(a, b), "atom information differs from parse_pdb"
+        frames = list(trajectory.frames())
+    assert [frame for frame, _ in frames] == [1, 2, 3]
+    for (_, x), shift in zip(frames, shifts):
+        assert np.allclose(x, reference[0] + np.array(shift), atol=1e-3), "coordinates of a model"
+
+    # a file without MODEL records is one frame
+    with Trajectory("./test_files/test_large.pqr") as trajectory:
+        frames = list(trajectory.frames())
+    assert len(frames) == 1
+    assert np.array_equal(frames[0][1], parse_pqr("./test_files/test_large.pqr")[0])
+
+
+def write_dcd(path, frames, endian="<", cell=True):
+    """Writes frames of shape (F,N,3) as a CHARMM dcd file"""
+
+    def record(data):
+        return struct.pack(endian + "i", len(data)) + data + struct.pack(endian + "i", len(data))
+
+    icntrl = np.zeros(20, dtype=endian + "i4")
+    icntrl[0] = len(frames)
+    icntrl[10] = int(cell)
+    icntrl[19] = 24
+    with open(path, "wb") as f:
+        f.write(record(b"CORD" + icntrl.tobytes()))
+        f.write(record(np.array([1], dtype=endian + "i4").tobytes() + b"test".ljust(80)))
+        f.write(record(np.array([frames.shape[1]], dtype=endian + "i4").tobytes()))
+        for frame in frames:
+            if cell:
+                f.write(record(np.array([50, 90, 50, 90, 90, 50], dtype=endian + "f8").tobytes()))
+            for axis in range(3):
+                f.write(record(frame[:, axis].astype(endian + "f4").tobytes()))
+
+
+def test_dcd_trajectory(tmp_path):
+    """Test the memory-mapped dcd reader paired with a pqr topology"""
+    pqr = "./test_files/test_large.pqr"
+    reference = parse_pqr(pqr)
+    frames = np.stack([reference[0], reference[0] + np.array([1.0, -2.0, 0.5])])
+    for endian, cell in [("<", True), (">", False)]:
+        path = str(tmp_path / "traj.dcd")
+        write_dcd(path, frames, endian, cell)
+        # a frame cut short is left out
+        with open(path, "ab") as f:
+            f.write(b"\0" * 100)
+        with DCDTrajectory(path, pqr) as trajectory:
+            assert np.array_equal(trajectory.Q, reference[1]), "charges of the topology"
+            read = list(trajectory.frames())
+        assert [frame for frame, _ in read] == [1, 2]
+        for (_, x), expected in zip(read, frames):
+            assert np.allclose(x, expected, atol=1e-4), "coordinates of a frame"
+
+
+def test_compressed_input(tmp_path):
+    """Test reading gzip compressed structures and tar archives of them"""
+    reference = parse_pdb("./test_files/test_large.pdb", get_charges=True)
+    with open("./test_files/test_large.pdb", "rb") as f:
+        data = f.read()
+    path = str(tmp_path / "a.pdb.gz")
+    with gzip.open(path, "wb") as f:
+        f.write(data)
+    for a, b in zip(parse_structure(path), reference):
+        assert np.array_equal(a, b), "compressed pdb parses differently"
+
+    archive = str(tmp_path / "ensemble.tar.gz")
+    with tarfile.open(archive, "w:gz") as t:
+        t.add("./test_files/test_large.pdb", arcname="frames/b.pdb")
+        t.add(path, arcname="frames/c.pdb.gz")
+        t.add("./test_files/test_large.pqr", arcname="frames/d.pqr")
+        t.add("./test_files/test_large.pdb", arcname="notes.txt")
+    members = list(archive_members(archive))
+    assert [name for name, _ in members] == ["frames/b.pdb", "frames/c.pdb.gz", "frames/d.pqr"]
+    for name, contents in members[:2]:
+        for a, b in zip(parse_structure(name, data=contents), reference):
+            assert np.array_equal(a, b), "archive member parses differently"
+    assert np.array_equal(
+        parse_structure(members[2][0], data=members[2][1])[0], parse_pqr("./test_files/test_large.pqr")[0]
+    )
+    # skipped members are not read
+    assert [name for name, _ in archive_members(archive, keep=lambda name: "c" in name)] == [
+        "frames/c.pdb.gz"
+    ]
+
+    # a compressed multi-MODEL file is a trajectory
+    write_models("./test_files/test_large.pdb", str(tmp_path / "traj.pdb"), [(0.0, 0.0, 0.0), (1.0, 1.0, 1.0)])
+    with open(str(tmp_path / "traj.pdb"), "rb") as f, gzip.open(str(tmp_path / "traj.pdb.gz"), "wb") as g:
+        g.write(f.read())
+    with Trajectory(str(tmp_path / "traj.pdb.gz")) as trajectory:
+        frames = list(trajectory.frames())
+    assert len(frames) == 2
+    assert np.allclose(frames[1][1], reference[0] + 1.0, atol=1e-3)
+
+
+def test_volume_format(tmp_path):
+    """Test binary volume files against the text field files"""
+    num_steps = [5, 7, 9]
+    grid = np.stack(
+        np.meshgrid(*[np.linspace(-1.5, 1.5, n) for n in num_steps], indexing="ij"), axis=-1
+    ).reshape(-1, 3)
+    rng = np.random.default_rng(0)
+    field = np.concatenate((grid, rng.normal(0, 50, (len(grid), 3))), axis=1).astype(np.half)
+    meta_data = {
+        "dimensions": [1.5, 1.5, 1.5],
+        "step_size": [0.375, 0.375, 0.375],
+        "num_steps": num_steps,
+        "transformation_matrix": np.linalg.qr(rng.normal(size=(3, 3)))[0],
+        "center": [10.0, -2.5, 3.25],
+    }
+    text, binary = str(tmp_path / "a_efield.dat"), str(tmp_path / "b_efield.dat")
+    save_numpy_as_dat(meta_data, field, text)
+    save_volume(meta_data, field, binary)
+
+    volume, mapped = read_volume(binary)
+    assert isinstance(mapped, np.memmap) and mapped.dtype == np.float16
+    assert np.array_equal(mapped, field)
+    assert np.array_equal(volume["num_steps"], num_steps)
+    assert np.allclose(volume["basis"], meta_data["transformation_matrix"].T)
+
+    # exported text is the text file
+    volume_to_dat(binary, str(tmp_path / "c_efield.dat"))
+    with open(text) as a, open(str(tmp_path / "c_efield.dat")) as b:
+        assert a.read() == b.read()
+
+    mat_text, mat_binary = read_mat(text), read_mat(binary)
+    assert mat_binary.shape == mat_text.shape == (5, 7, 9, 3)
+    assert np.allclose(mat_binary, mat_text, atol=1e-3)
+    assert np.allclose(mat_text[1, 2, 3], field[1 * 63 + 2 * 9 + 3, 3:].astype(float), atol=1e-3)
+    meta_text, meta_binary = read_mat(text, meta_data=True), read_mat(binary, meta_data=True)
+    assert meta_text == meta_binary
+
+    fields = make_fields([text, binary])
+    assert np.allclose(fields[0], fields[1], atol=1e-3)
@@ -0,0 +1,335 @@
+import os
+import sys
+import subprocess
+import threading
+import time
+import numpy as np
+from CPET.source.calculator import calculator
+from CPET.utils.calculator import (
+    calculate_electric_field_points,
+    calculate_electric_field_c_shared_full,
+    calculate_field_gradient_points,
+    calculate_thread_batch_c_shared,
+    compute_topo_field_batch,
+    charges_to_soa,
+    calculate_electric_field_soa,
+    calculate_electric_field_native_points,
+    Math,
+)
+import CPET.utils.parallel as parallel
+from CPET.utils.parallel import lpt_chunks, TopoPool, run_frames, map_points_threaded, parallel_layout
+from CPET.utils.io import Trajectory
+from test_io import write_models
+import warnings
+warnings.filterwarnings(action='ignore')
+
+
+def worker_layout(_):
+    return sorted(os.sched_getaffinity(0)), Math.get_native_threads()
+
+
+class Test_native_kernels:
+    options = {
+        "center": {
+                "method": "first",
+                "atoms": {
+                        "CD": 2
+                }
+        },
+        "x": {
+                "method": "mean",
+                "atoms": {
+                        "CG": 1,
+                        "CB": 1
+                }
+        },
+        "y": {
+                "method": "inverse",
+                "atoms": {
+                        "CA": 3,
+                        "CB": 3
+                }
+        },
+        "n_samples": 300,
+        "dimensions": [1.5, 1.5, 1.5],
+        "step_size": 0.05,
+        "concur_slip": 4,
+        "filter_radius": 20.0,
+        "filter_in_box": True,
+        "initializer": "uniform",
+        "CPET_method": "topo",
+        "max_streamline_init": "fixed_rand",
+        "dtype": "float32",
+    }
+    topo = calculator(options, path_to_pdb="./test_files/test_large.pdb")
+    reference_hist = topo.compute_topo_complete_c_shared()
+
+    def test_topo_c_batch(self):
+        hist = self.topo.compute_topo_complete_c_batch()
+        assert hist.shape == (self.topo.n_samples, 2)
+        # the batched kernel keeps the streamlines in input order
+        np.testing.assert_allclose(self.reference_hist, hist, rtol=1e-2, atol=1e-2)
+
+    def test_field_soa(self):
+        points = self.topo.random_start_points
+        reference = calculate_electric_field_points(points, self.topo.x, self.topo.Q)
+        # Morton order only changes the summation order
+        for sort in [False, True]:
+            E = calculate_electric_field_soa(points, *charges_to_soa(self.topo.x, self.topo.Q, sort))
+            np.testing.assert_allclose(E, reference, rtol=1e-3, atol=1e-3)
+
+    def test_field_reduction(self, tmp_path):
+        # a million charges used to overflow the stack of calc_field_base
+        rng = np.random.default_rng(0)
+        x = rng.uniform(-60, 60, (1000000, 3)).astype(np.float32)
+        Q = rng.uniform(-1, 1, (1000000, 1)).astype(np.float32)
+        points = rng.uniform(-1, 1, (4, 3)).astype(np.float32)
+        np.save(tmp_path / "x.npy", x)
+        np.save(tmp_path / "Q.npy", Q)
+        np.save(tmp_path / "points.npy", points)
+        reference = calculate_electric_field_points(points, x, Q)
+        E = np.array([calculate_electric_field_c_shared_full(p, x, Q) for p in points])
+        np.testing.assert_allclose(E, reference, rtol=1e-4, atol=1e-4)
+
+        # the block order of the reduction is fixed, so the field is the same for any number of threads
+        script = (
+            "import sys, numpy as np; from CPET.utils.c_ops import Math_ops; "
+            "m = Math_ops(sys.argv[1]); d = sys.argv[2]; "
+            "x, Q, p = (np.load(d + f) for f in ('/x.npy', '/Q.npy', '/points.npy')); "
+            "np.save(d + '/E_' + sys.argv[3] + '.npy', [m.calc_field_base(i, x, Q) for i in p])"
+        )
+        so = os.path.join(os.path.dirname(sys.modules["CPET.utils.c_ops"].__file__), "math_module.so")
+        for n_threads in ["1", "8"]:
+            subprocess.run(
+                [sys.executable, "-c", script, so, str(tmp_path), n_threads],
+                env=dict(os.environ, OMP_NUM_THREADS=n_threads),
+                check=True,
+            )
+        np.testing.assert_array_equal(np.load(tmp_path / "E_1.npy"), E)
+        np.testing.assert_array_equal(np.load(tmp_path / "E_8.npy"), E)
+
+    def test_topo_numba(self):
+        hist = self.topo.compute_topo_numba()
+        assert hist.shape == (self.topo.n_samples, 2)
+        # double precision numba engine, same streamlines as the native kernel
+        np.testing.assert_allclose(self.reference_hist, hist, rtol=1e-2, atol=1e-2)
+
+    def test_topo_batched(self):
+        hist = self.topo.compute_topo_batched()
+        assert hist.shape == (self.topo.n_samples, 2)
+        # the NumPy active set engine keeps the streamlines in input order
+        np.testing.assert_allclose(self.reference_hist, hist, rtol=1e-2, atol=1e-2)
+
+    def test_lpt_chunks(self):
+        n_iter = np.random.default_rng(0).integers(1, 5000, 10000)
+        chunks = lpt_chunks(n_iter, 32)
+        # every streamline lands in exactly one chunk, costliest chunk first
+        np.testing.assert_array_equal(np.sort(np.concatenate(chunks)), np.arange(len(n_iter)))
+        loads = np.array([np.sum(n_iter[c] + 4) for c in chunks])
+        assert np.all(np.diff(loads) <= 0)
+        assert loads[0] - loads[-1] <= np.max(n_iter) + 4
+
+    def test_persistent_pool(self):
+        # one pool serves structures with different charges, workers swap over between them
+        options = dict(self.options)
+        options["filter_radius"] = 15.0
+        with TopoPool(self.options["concur_slip"]) as pool:
+            hists = []
+            pids = []
+            for frame_options in [self.options, options, self.options]:
+                topo = calculator(frame_options, path_to_pdb="./test_files/test_large.pdb", pool=pool)
+                hists.append(topo.compute_topo_complete_c_shared())
+                pids.append(sorted(p.pid for p in pool.pool._pool))
+            assert pids[0] == pids[1] == pids[2]
+        np.testing.assert_array_equal(hists[0], self.reference_hist)
+        np.testing.assert_array_equal(hists[2], self.reference_hist)
+        topo = calculator(options, path_to_pdb="./test_files/test_large.pdb")
+        np.testing.assert_array_equal(hists[1], topo.compute_topo_complete_c_shared())
+
+    def test_concurrency_threads(self):
+        options = dict(self.options)
+        options["concurrency"] = "threads"
+        topo = calculator(options, path_to_pdb="./test_files/test_large.pdb")
+        native_threads = Math.get_native_threads_setting()
+        # threads run the same native task per streamline as the process pool
+        np.testing.assert_array_equal(topo.compute_topo_complete_c_shared(), self.reference_hist)
+        points = topo.random_start_points
+        E = map_points_threaded(
+            lambda p: calculate_electric_field_native_points(p, topo.x, topo.Q), points, 4
+        )
+        reference = calculate_electric_field_points(points, topo.x, topo.Q)
+        np.testing.assert_allclose(E, reference, rtol=1e-3, atol=1e-3)
+        # the team size of the thread workers holds while their executors are open only
+        layout = parallel_layout(2, omp_threads=1)
+        Math.set_native_threads(3)
+        try:
+            with parallel.thread_executor(2, layout):
+                with parallel.thread_executor(2, layout):
+                    assert Math.get_native_threads() == 1
+                assert Math.get_native_threads() == 1
+            assert Math.get_native_threads() == 3
+        finally:
+            Math.set_native_threads(native_threads)
+        # an unset team size is restored as unset
+        with parallel.thread_executor(2, layout):
+            assert Math.get_native_threads_setting() == 1
+        assert Math.get_native_threads_setting() == native_threads
+
+    def test_parallel_layout(self, monkeypatch):
+        # two nodes of 10 and 6 cores
+        monkeypatch.setattr(parallel.os, "sched_getaffinity", lambda pid: set(range(16)), raising=False)
+        monkeypatch.setattr(
+            parallel, "numa_nodes", lambda cpus: [list(range(10)), list(range(10, 16))]
+        )
+        for n_workers in [1, 3, 5, 16, 64]:
+            layout = parallel_layout(n_workers)
+            workers = layout["worker_cpus"]
+            assert len(workers) == layout["workers"] == min(n_workers, 16)
+            # every worker stays on one node and no core is shared
+            cpus = np.concatenate(workers)
+            assert len(np.unique(cpus)) == len(cpus)
+            for group, node in zip(workers, layout["worker_nodes"]):
+                assert set(group) <= set(layout["nodes"][node])
+            assert layout["workers"] * layout["omp_threads"] <= 16
+        assert parallel_layout(4, omp_threads=2)["omp_threads"] == 2
+
+    def test_pool_layout(self):
+        # workers are pinned inside the cores of this process and use the team size of the layout
+        with TopoPool(self.options["concur_slip"]) as pool:
+            pool.start()
+            seen = pool.pool.map(
+                worker_layout, range(4 * pool.processes), chunksize=1
+            )
+        allowed = set(pool.layout["cpus"])
+        for cpus, omp_threads in seen:
+            assert set(cpus) <= allowed
+            assert omp_threads == pool.layout["omp_threads"]
+
+    def test_trajectory_frames(self, tmp_path):
+        path = str(tmp_path / "traj.pdb")
+        write_models("./test_files/test_large.pdb", path, [(0.0, 0.0, 0.0), (2.0, -1.0, 3.0)])
+        options = dict(self.options)
+        options["filter_resids"] = ["HOH"]
+        topo = calculator(options, path_to_pdb="./test_files/test_large.pdb")
+        with Trajectory(path) as trajectory:
+            frames = [calculator(options, frame=(trajectory, x)) for _, x in trajectory.frames()]
+            # masks and selections of the atom information are computed for the first frame only
+            assert len(trajectory.cache) == 5
+        np.testing.assert_array_equal(frames[0].x, topo.x)
+        np.testing.assert_array_equal(frames[0].Q, topo.Q)
+        # the box moves with the translated model
+        np.testing.assert_allclose(frames[1].x, topo.x, atol=1e-3)
+        np.testing.assert_allclose(frames[1].center, topo.center + np.array([2.0, -1.0, 3.0]), atol=1e-3)
+
+    def test_run_frames(self):
+        in_flight = [0]
+        peak = {}
+        written = []
+        lock = threading.Lock()
+
+        def load(frame):
+            with lock:
+                in_flight[0] += 1
+                peak[frame] = in_flight[0]
+            time.sleep(0.02)
+            return frame
+
+        def write(frame, state, results):
+            written.append(results)
+            with lock:
+                in_flight[0] -= 1
+
+        # frames of 1 GB, the budget holds two of them
+        run_frames(
+            range(12),
+            load,
+            lambda frame, state: frame * 2,
+            write,
+            frames_in_flight=4,
+            memory_budget=2e9,
+            size_fn=lambda state: 1e9,
+        )
+        assert sorted(written) == [frame * 2 for frame in range(12)]
+        assert max(peak.values()) == 2
+        run_frames(range(12), load, lambda frame, state: frame, write, frames_in_flight=3)
+        assert max(peak.values()) == 3
+
+    def test_topo_torch_cpu(self):
+        options = dict(self.options)
+        options["device"] = "cpu"
+        options["GPU_batch_freq"] = 100
+        topo = calculator(options, path_to_pdb="./test_files/test_large.pdb")
+        hist = topo.compute_topo_GPU_batch_filter()
+        assert hist.shape == (topo.n_samples, 2)
+        # the path matrix engine returns streamlines in input order
+        np.testing.assert_allclose(self.reference_hist, hist, rtol=1e-2, atol=1e-2)
+        # rk4 steps out of the box end on the wall and curvatures use the central stencil, as with the cpu engines
+        options["integrator"] = "rk4"
+        topo = calculator(options, path_to_pdb="./test_files/test_large.pdb")
+        hist = topo.compute_topo_GPU_batch_filter()
+        hist_numpy = compute_topo_field_batch(
+            topo.random_start_points,
+            topo.random_max_samples,
+            lambda p: calculate_electric_field_points(p, topo.x, topo.Q),
+            topo.step_size,
+            topo.dimensions,
+            "rk4",
+        )
+        np.testing.assert_allclose(hist, hist_numpy, rtol=1e-3, atol=1e-4)
+
+    def test_integrators(self):
+        x_0 = self.topo.random_start_points[::4]
+        n_iter = self.topo.random_max_samples[::4]
+        for integrator in ["rk4", "rk45"]:
+            hist = calculate_thread_batch_c_shared(
+                x_0, n_iter, self.topo.x, self.topo.Q, self.topo.step_size,
+                self.topo.dimensions, integrator, 1e-4,
+            )
+            # the native kernel and the vectorized engine integrate the same way
+            hist_numpy = compute_topo_field_batch(
+                x_0,
+                n_iter,
+                lambda p: calculate_electric_field_points(p, self.topo.x, self.topo.Q),
+                self.topo.step_size,
+                self.topo.dimensions,
+                integrator,
+                1e-4,
+            )
+            np.testing.assert_allclose(hist, hist_numpy, rtol=1e-2, atol=1e-2)
+
+    def test_analytic_curvature(self):
+        x_0 = self.topo.random_start_points[::4]
+        n_iter = self.topo.random_max_samples[::4]
+        field_fn = lambda p: calculate_electric_field_points(p, self.topo.x, self.topo.Q)
+        hist = calculate_thread_batch_c_shared(
+            x_0, n_iter, self.topo.x, self.topo.Q, self.topo.step_size,
+            self.topo.dimensions, "rk4", 1e-4, analytic_curvature=True,
+        )
+        hist_numpy = compute_topo_field_batch(
+            x_0,
+            n_iter,
+            field_fn,
+            self.topo.step_size,
+            self.topo.dimensions,
+            "rk4",
+            field_gradient_fn=lambda p: calculate_field_gradient_points(p, self.topo.x, self.topo.Q),
+        )
+        np.testing.assert_allclose(hist, hist_numpy, rtol=1e-4, atol=1e-4)
+        # the central stencil converges to the analytic curvature
+        hist_stencil = compute_topo_field_batch(
+            x_0, n_iter, field_fn, self.topo.step_size, self.topo.dimensions, "rk4"
+        )
+        assert np.median(np.abs(hist_stencil[:, 1] - hist_numpy[:, 1]) / hist_numpy[:, 1]) < 1e-3
+
+    def test_topo_converged(self):
+        options = dict(self.options)
+        options["convergence_round_size"] = 1000
+        options["convergence_tol"] = 1e-2
+        options["convergence_max_samples"] = 50000
+        topo = calculator(options, path_to_pdb="./test_files/test_large.pdb")
+        hist = topo.compute_topo_converged()
+        assert hist.shape == (topo.n_samples, 2)
+        # stops at the first round under the tolerance, well before the cap
+        assert topo.convergence[-1][1] < 1e-2
+        assert all(distance >= 1e-2 for _, distance in topo.convergence[:-1])
+        assert len(hist) < options["convergence_max_samples"]